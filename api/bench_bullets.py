@@ -0,0 +1,113 @@
+# bench_bullets.py
+#
+# Micro-benchmark for read_pdfs.parse_bullet_points.
+# Collects the section text of the sample PDFs and times the compiled tokenizer
+# against the previous regex-per-call implementation, checking that both agree.
+#
+# Usage: python bench_bullets.py [--repeat N] [pdf ...]
+
+import argparse
+import asyncio
+import re
+import time
+import read_pdfs
+
+SAMPLE_PDFS = [
+    'data/data_ver1.pdf',
+    'data/data_ver2.pdf',
+    'data/example1.pdf',
+    'data/example3.pdf',
+]
+
+
+def legacy_parse_bullet_points(text):
+    """
+    The original implementation, kept as the reference for correctness and speed.
+    """
+    bullet_patterns = [
+        r'(\s*[-]\s+)',
+        r'(\s*•\s+)',
+        r'(\s*○\s+)',
+        r'(\s*▪\s+)',
+        r'(\s*●\s+)',
+        r'(\s*\d+\.\s+)',
+        r'(\s*⁃\s+)'
+    ]
+    combined_bullet_pattern = '|'.join(bullet_patterns)
+    segments = re.split(combined_bullet_pattern, text)
+    segments = [segment.strip() for segment in segments if segment and segment.strip()]
+
+    parsed_sections = []
+    current_entry = ''
+    for segment in segments:
+        if re.match(r'^[-•○▪●⁃]|^\d+\.', segment):
+            if current_entry:
+                parsed_sections.append(current_entry.strip())
+                current_entry = ''
+            current_entry = segment
+        else:
+            current_entry += ' ' + segment
+    if current_entry:
+        parsed_sections.append(current_entry.strip())
+
+    parsed_sections = [re.sub(r'^\s*-\s*', '', entry) for entry in parsed_sections]
+    unicode_bullet_removal = r'[•○▪●⁃]'
+    parsed_sections = [re.sub(unicode_bullet_removal, '', entry) for entry in parsed_sections]
+    parsed_sections = [entry for entry in parsed_sections if entry.strip()]
+    return parsed_sections
+
+
+def collect_section_texts(pdf_paths):
+    """
+    Runs the extraction once and records every text passed to parse_bullet_points.
+    """
+    texts = []
+    parse = read_pdfs.parse_bullet_points
+
+    def recording_parse(text):
+        texts.append(text)
+        return parse(text)
+
+    read_pdfs.parse_bullet_points = recording_parse
+    try:
+        for pdf_path in pdf_paths:
+            asyncio.run(read_pdfs.process_pdf(pdf_path))
+    finally:
+        read_pdfs.parse_bullet_points = parse
+    return texts
+
+
+def time_parser(parser, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            parser(text)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parse_bullet_points on sample PDFs.")
+    parser.add_argument('pdfs', nargs='*', default=SAMPLE_PDFS)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    texts = collect_section_texts(args.pdfs)
+    total_chars = sum(len(text) for text in texts)
+
+    mismatches = sum(
+        1 for text in texts if read_pdfs.parse_bullet_points(text) != legacy_parse_bullet_points(text)
+    )
+
+    legacy_time = time_parser(legacy_parse_bullet_points, texts, args.repeat)
+    compiled_time = time_parser(read_pdfs.parse_bullet_points, texts, args.repeat)
+
+    print(f"Sections: {len(texts)} ({total_chars} characters), repeated {args.repeat} times")
+    print(f"Mismatches against legacy parser: {mismatches}")
+    for name, elapsed in (("legacy", legacy_time), ("compiled", compiled_time)):
+        rate = total_chars * args.repeat / elapsed / 1e6
+        print(f"{name:>9}: {elapsed:.4f} seconds ({rate:.2f} M chars/s)")
+    print(f"Speedup: {legacy_time / compiled_time:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# bench_index.py
+#
+# Recall-vs-latency report for the FAISS index types offered by faiss_util.
+# Builds a synthetic set of unit vectors with clusters of near-duplicates (like repeated
+# bullets across notes), then compares each approximate index against exact search.
+#
+# Usage: python bench_index.py [--vectors N] [--queries Q] [--threshold T] [--dimension D]
+
+import argparse
+import numpy as np
+from faiss_util import recall_latency_report
+
+CONFIGS = [
+    ('hnsw ef=16', {'kind': 'hnsw', 'ef_search': 16}),
+    ('hnsw ef=64', {'kind': 'hnsw', 'ef_search': 64}),
+    ('hnsw ef=256', {'kind': 'hnsw', 'ef_search': 256}),
+    ('ivf nprobe=1', {'kind': 'ivf', 'nprobe': 1}),
+    ('ivf nprobe=8', {'kind': 'ivf', 'nprobe': 8}),
+    ('ivf nprobe=32', {'kind': 'ivf', 'nprobe': 32}),
+]
+
+
+def synthetic_vectors(count, dimension, cluster_size=4, noise=0.35, seed=0):
+    """
+    Unit vectors in clusters of near-duplicates around random centers.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((count // cluster_size + 1, dimension)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    vectors = centers[np.arange(count) // cluster_size]
+    vectors = vectors + noise * rng.standard_normal((count, dimension)).astype(np.float32) / np.sqrt(dimension)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return rng.permutation(vectors).astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare approximate FAISS indexes against exact search.")
+    parser.add_argument('--vectors', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--dimension', type=int, default=768)
+    args = parser.parse_args()
+
+    vectors = synthetic_vectors(args.vectors + args.queries, args.dimension)
+    vectors, queries = vectors[:args.vectors], vectors[args.vectors:]
+
+    report = recall_latency_report(vectors, queries, args.threshold, CONFIGS)
+    flat_ms = report[0]['query_ms']
+    print(f"Vectors: {args.vectors}, queries: {args.queries}, dimension: {args.dimension}, threshold: {args.threshold}")
+    print(f"{'index':>14} {'build s':>9} {'query ms':>9} {'speedup':>8} {'recall':>7}")
+    for row in report:
+        speedup = flat_ms / row['query_ms'] if row['query_ms'] else float('inf')
+        print(f"{row['name']:>14} {row['build_seconds']:>9.2f} {row['query_ms']:>9.3f} "
+              f"{speedup:>7.1f}x {row['recall']:>7.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# bench_merge.py
+#
+# Benchmark suite for the merge pipeline on synthetic corpora (see synthetic_notes.py).
+# Each scenario times the stages separately (loading, preprocessing, embedding, header
+# grouping, bullet deduplication, output writing) and the whole merge, after an untimed
+# warm-up run and with caches cleared before every run. The merge output is checked against
+# a golden digest to catch behavior changes, and results are saved per commit so
+# regressions show up against the previous run.
+#
+# Golden digests are kept in bench_golden.json, keyed by scenario, seed, embedding model and a
+# fingerprint of the text preprocessing (the NLTK lemmatizer and stopwords), since each of
+# these changes the output. They are only written with --update-golden; a run without a
+# golden digest for its environment reports it as missing.
+#
+# Usage: python bench_merge.py [--scenarios small medium ...] [--repeats R] [--update-golden]
+#                              [--results-dir DIR] [--compare RESULTS_FILE]
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+# The persistent embedding cache would make embedding times depend on earlier runs
+os.environ['EMBEDDING_CACHE_DIR'] = ''
+
+import merge_logic
+import preprocess
+from merge_logic import (load_notes_from_files, merge_multiple_notes, build_embedding_matrix,
+                         format_merged_results)
+from preprocess import preprocess_sentence, preprocess_header
+from header_grouping import linked_name_pairs, connected_header_groups
+from deduplication import deduplicate_sentences
+from embedding import set_embedding_backend
+from merge_output import MergedResultsJSONWriter, MergedTextWriter, write_merge_stream
+from synthetic_notes import generate_notes, write_corpus, load_seed_text
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_RESULTS_DIR = os.path.join(HERE, 'bench_results')
+DEFAULT_GOLDEN_FILE = os.path.join(HERE, 'bench_golden.json')
+
+# name: (notes, headers per note, bullets per header, duplicate rate)
+SCENARIOS = {
+    'small': (20, 6, 5, 0.3),
+    'medium': (200, 8, 6, 0.3),
+    'large': (1000, 10, 8, 0.3),
+    'duplicates': (200, 8, 6, 0.8),
+    'wide': (50, 40, 4, 0.3),
+}
+STAGES = ['load', 'preprocess', 'embedding', 'header_grouping', 'deduplication', 'output', 'merge']
+# Thresholds of merge_multiple_notes
+SIMILARITY_THRESHOLD = 0.7
+OVERLAP_THRESHOLD = 0.4
+HEADER_SIMILARITY_THRESHOLD = 0.75
+HEADER_OVERLAP_THRESHOLD = 0.3
+
+
+def clear_caches():
+    preprocess.preprocess_cache.clear()
+    preprocess.lemma_cache.clear()
+    merge_logic.embedding_cache.clear()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def run_stages(directory, output_dir):
+    """
+    Runs every stage once from cold caches and returns (seconds per stage, merged output).
+    The stages reproduce the steps of merge_multiple_notes on their own so each can be timed.
+    """
+    timings = {}
+    clear_caches()
+    timings['load'], notes = timed(load_notes_from_files, directory)
+
+    headers = [(note['note_num'], header) for note in notes for header in note['headers']]
+
+    def preprocess_all():
+        for _, header in headers:
+            preprocess_header(header['header_name'].strip().strip(':'))
+        return {bullet: preprocess_sentence(bullet) for _, header in headers for bullet in header['bullets']}
+    timings['preprocess'], preprocessed = timed(preprocess_all)
+
+    names = [header['header_name'].strip().strip(':').strip() for _, header in headers]
+    header_texts = list(dict.fromkeys(names))
+    texts = list(dict.fromkeys(header_texts + [pre for pre, _ in preprocessed.values()]))
+    rows = {text: row for row, text in enumerate(texts)}
+    timings['embedding'], embeddings = timed(build_embedding_matrix, texts)
+
+    def group_headers():
+        pairs = linked_name_pairs(header_texts, embeddings[:len(header_texts)],
+                                  HEADER_SIMILARITY_THRESHOLD, HEADER_OVERLAP_THRESHOLD)
+        return connected_header_groups([rows[name] for name in names], len(header_texts), pairs[0], pairs[1])
+    timings['header_grouping'], groups = timed(group_headers)
+
+    def deduplicate_all():
+        for group in groups:
+            bullets_info = []
+            for note_num, header in sorted((headers[idx] for idx in group), key=lambda h: h[0]):
+                for bullet_idx, bullet in enumerate(header['bullets'], 1):
+                    pre_bullet, avg_word_length = preprocessed[bullet]
+                    bullets_info.append((note_num, bullet_idx, bullet, pre_bullet, avg_word_length, rows[pre_bullet]))
+            deduplicate_sentences(bullets_info, SIMILARITY_THRESHOLD, OVERLAP_THRESHOLD, embeddings=embeddings)
+    timings['deduplication'], _ = timed(deduplicate_all)
+
+    clear_caches()
+    timings['merge'], (merged_text, merged_headers, _) = timed(merge_multiple_notes, notes)
+
+    def write_outputs():
+        with open(os.path.join(output_dir, 'merged_results.json'), 'w', encoding='utf-8') as results_f, \
+                open(os.path.join(output_dir, 'defaultmerge.txt'), 'w', encoding='utf-8') as text_f:
+            write_merge_stream(merged_headers, [MergedResultsJSONWriter(results_f), MergedTextWriter(text_f)])
+    timings['output'], _ = timed(write_outputs)
+    return timings, (notes, merged_text, merged_headers)
+
+
+def output_digest(notes, merged_text, merged_headers):
+    """
+    Summary of a merge result: sizes and a digest of the full output.
+    """
+    results = json.dumps(format_merged_results(merged_headers), sort_keys=True)
+    return {
+        'headers_in': sum(len(note['headers']) for note in notes),
+        'bullets_in': sum(len(header['bullets']) for note in notes for header in note['headers']),
+        'headers_out': len(merged_headers),
+        'bullets_out': sum(len(header['bullets']) for header in merged_headers),
+        'sha256': hashlib.sha256((results + '\0' + merged_text).encode('utf-8')).hexdigest(),
+    }
+
+
+def preprocessing_fingerprint():
+    """
+    Short digest of how the sample bullets preprocess, which differs between NLTK data versions.
+    """
+    _, bullets = load_seed_text()
+    preprocessed = '\n'.join(preprocess_sentence(bullet)[0] for bullet in bullets)
+    return hashlib.sha256(preprocessed.encode('utf-8')).hexdigest()[:12]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def latest_results(results_dir):
+    if not os.path.isdir(results_dir):
+        return None
+    files = sorted(name for name in os.listdir(results_dir) if name.endswith('.json'))
+    return os.path.join(results_dir, files[-1]) if files else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the merge stages on synthetic note corpora.")
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=['small', 'medium'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='hashing', help="Embedding backend (default: %(default)s)")
+    parser.add_argument('--golden', default=DEFAULT_GOLDEN_FILE)
+    parser.add_argument('--update-golden', action='store_true', help="Replace golden digests with this run's output")
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR)
+    parser.add_argument('--compare', default=None, help="Results file to compare against (default: latest saved)")
+    parser.add_argument('--regression', type=float, default=1.25, help="Slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    model_id = set_embedding_backend(args.backend).model_id
+    fingerprint = preprocessing_fingerprint()
+    golden = {}
+    if os.path.exists(args.golden):
+        with open(args.golden, 'r', encoding='utf-8') as f:
+            golden = json.load(f)
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'model_id': model_id,
+        'preprocessing': fingerprint,
+        'repeats': args.repeats,
+        'scenarios': {}
+    }
+    drift = []
+    missing = []
+    for name in args.scenarios:
+        num_notes, headers_per_note, bullets_per_header, duplicate_rate = SCENARIOS[name]
+        with tempfile.TemporaryDirectory() as directory:
+            corpus_dir = os.path.join(directory, 'notes')
+            write_corpus(corpus_dir, generate_notes(num_notes, headers_per_note, bullets_per_header,
+                                                    duplicate_rate, args.seed))
+            # Untimed first run, which pays for lazy imports (NLTK, FAISS, scipy)
+            run_stages(corpus_dir, directory)
+            runs = []
+            for _ in range(args.repeats):
+                timings, output = run_stages(corpus_dir, directory)
+                runs.append(timings)
+        digest = output_digest(*output)
+        key = f"{name}/seed{args.seed}/{model_id}/{fingerprint}"
+        if args.update_golden:
+            status = 'recorded'
+            golden[key] = digest
+        elif key not in golden:
+            status = 'missing'
+            missing.append(key)
+        elif golden[key] != digest:
+            status = 'DRIFT'
+            drift.append(key)
+        else:
+            status = 'ok'
+        results['scenarios'][name] = {
+            'seconds': {stage: statistics.median(run[stage] for run in runs) for stage in STAGES},
+            'output': digest,
+            'golden': status
+        }
+        print(f"{name}: {digest['bullets_in']} bullets in {digest['headers_in']} headers -> "
+              f"{digest['bullets_out']} bullets in {digest['headers_out']} groups, golden {status}")
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_file = os.path.join(args.results_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{results['commit']}.json")
+    previous_file = args.compare or latest_results(args.results_dir)
+    previous = {}
+    if previous_file:
+        with open(previous_file, 'r', encoding='utf-8') as f:
+            previous = json.load(f).get('scenarios', {})
+    with open(results_file, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    if args.update_golden:
+        with open(args.golden, 'w', encoding='utf-8') as f:
+            json.dump(golden, f, indent=4, sort_keys=True)
+
+    print(f"\n{'scenario':>12} {'stage':>16} {'seconds':>9} {'previous':>9} {'ratio':>6}")
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        for stage in STAGES:
+            seconds = scenario['seconds'][stage]
+            before = previous.get(name, {}).get('seconds', {}).get(stage)
+            ratio = seconds / before if before else None
+            flag = ''
+            if ratio is not None and ratio > args.regression:
+                flag = ' slower'
+                regressions.append(f"{name}/{stage}")
+            print(f"{name:>12} {stage:>16} {seconds:>9.4f} "
+                  f"{before if before is not None else float('nan'):>9.4f} "
+                  f"{ratio if ratio is not None else float('nan'):>6.2f}{flag}")
+    print(f"\nResults saved to {results_file}" + (f", compared with {previous_file}" if previous_file else ""))
+    if regressions:
+        print(f"Slower than the previous run by more than {args.regression}x: {', '.join(regressions)}")
+    if missing:
+        print(f"No golden digest for {', '.join(missing)}; record one with --update-golden after checking the output.")
+    if drift:
+        print(f"Output differs from the golden digest: {', '.join(drift)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# bench_notes.py
+#
+# Load-time benchmark for note files: JSON against the columnar .notes format. Copies the
+# files in test_files many times into a temporary directory in both formats and times
+# load_notes_from_files on each. --pdfs-per-file repeats the PDFs inside each file to
+# model larger extraction outputs.
+#
+# Usage: python bench_notes.py [--copies N] [--pdfs-per-file P] [--repeats R]
+
+import os
+import json
+import time
+import argparse
+import tempfile
+import statistics
+from merge_logic import load_notes_from_files, load_notes_from_file
+from note_format import NOTE_FILE_EXTENSION, notes_to_json_data, write_note_table
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_corpus(directory, copies, pdfs_per_file=1):
+    """
+    Writes copies of every test file to directory/json and directory/notes.
+    """
+    sources = sorted(name for name in os.listdir(os.path.join(HERE, 'test_files')) if name.endswith('.json'))
+    for kind in ('json', 'notes'):
+        os.makedirs(os.path.join(directory, kind))
+    for name in sources:
+        notes = load_notes_from_file(os.path.join(HERE, 'test_files', name))
+        # Number the repeated bullets so the string table cannot share them between PDFs
+        notes = [
+            {**note, 'pdf_id': f"{note['pdf_id']}_{k}", 'headers': [
+                {**header, 'bullets': [f"{bullet} ({k})" for bullet in header['bullets']]} for header in note['headers']
+            ]}
+            for k in range(pdfs_per_file) for note in notes
+        ]
+        data = notes_to_json_data(notes)
+        stem = os.path.splitext(name)[0]
+        for copy in range(copies):
+            with open(os.path.join(directory, 'json', f"{stem}_{copy}.json"), 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+            write_note_table(os.path.join(directory, 'notes', f"{stem}_{copy}{NOTE_FILE_EXTENSION}"), notes)
+    return len(sources) * copies
+
+
+def time_load(directory, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        notes = load_notes_from_files(directory)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), len(notes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare loading JSON and .notes files.")
+    parser.add_argument('--copies', type=int, default=1000)
+    parser.add_argument('--pdfs-per-file', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = make_corpus(directory, args.copies, args.pdfs_per_file)
+        print(f"Files per format: {files}")
+        print(f"{'format':>8} {'load s':>8} {'notes':>7} {'MB':>7}")
+        for kind in ('json', 'notes'):
+            path = os.path.join(directory, kind)
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 1e6
+            seconds, count = time_load(path, args.repeats)
+            print(f"{kind:>8} {seconds:>8.3f} {count:>7} {size:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# bench_startup.py
+#
+# Import-time benchmark. server.js starts a fresh Python process per merge, so the cost of
+# importing the merging modules is paid on every request. Each measurement runs in a new
+# interpreter and reports the median over several runs.
+#
+# Usage: python bench_startup.py [--repeats N]
+
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Each snippet prints the seconds it took, measured inside the child process
+SNIPPETS = [
+    ('import merge_logic', "import merge_logic"),
+    ('import + merge test_files', (
+        "from merge_logic import load_notes_from_files, merge_multiple_notes\n"
+        "merge_multiple_notes(load_notes_from_files('test_files'))"
+    )),
+]
+TIMER = "import time\nstart = time.perf_counter()\n{code}\nprint(time.perf_counter() - start)\n"
+
+
+def time_snippet(code, repeats):
+    """
+    Runs code in fresh interpreters and returns (median seconds in the child, median seconds
+    for the whole process including interpreter startup).
+    """
+    inner, total = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', TIMER.format(code=code)],
+            cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout
+        total.append(time.perf_counter() - start)
+        inner.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(inner), statistics.median(total)
+
+
+def loaded_modules():
+    """
+    Heavy modules left in sys.modules after importing merge_logic.
+    """
+    code = "import sys, json, merge_logic\nprint(json.dumps(sorted(m for m in ('nltk', 'faiss', 'scipy', 'torch') if m in sys.modules)))"
+    output = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True, check=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import and cold-merge time in fresh processes.")
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"Heavy modules loaded by 'import merge_logic': {loaded_modules() or 'none'}")
+    print(f"{'step':>26} {'in-process s':>13} {'process s':>10}")
+    for name, code in SNIPPETS:
+        try:
+            inner, total = time_snippet(code, args.repeats)
+        except subprocess.CalledProcessError as e:
+            # e.g. the NLTK corpora have not been seeded (see seed_nltk_data.py)
+            lines = [line.strip() for line in e.stderr.splitlines() if any(c.isalnum() for c in line)]
+            print(f"{name:>26} failed: {next((line for line in reversed(lines) if 'Error' in line or 'not found' in line), e)}")
+            continue
+        print(f"{name:>26} {inner:>13.3f} {total:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# convert_notes.py
+#
+# Converts note files between JSON (as written by read_pdfs) and the columnar .notes format
+# (see note_format.py). With --precompute, .notes files also store each bullet's preprocessed
+# text and the embeddings of header names and preprocessed bullets for the active embedding
+# backend, so merges that load them skip preprocessing and embedding.
+#
+# Usage: python convert_notes.py [--precompute] [--output-dir DIR] file.json|file.notes ...
+
+import os
+import json
+import argparse
+from note_format import NOTE_FILE_EXTENSION, notes_to_json_data, write_note_table, read_note_table
+from merge_logic import load_notes_from_file, build_embedding_matrix
+from preprocess import preprocess_sentence
+from embedding import get_embedding_backend
+
+
+def precompute_note_data(notes):
+    """
+    Preprocesses every bullet and embeds every header name and preprocessed bullet the way
+    merge_multiple_notes does.
+
+    Returns:
+        preprocessed (dict): Bullet text -> (preprocessed text, average word length).
+        embeddings (dict): Text -> normalized float32 embedding.
+        model_id (str): Model id of the embedding backend.
+    """
+    preprocessed = {}
+    texts = []
+    for note in notes:
+        for header in note['headers']:
+            texts.append(header['header_name'].strip().strip(':').strip())
+            for bullet in header['bullets']:
+                if bullet not in preprocessed:
+                    preprocessed[bullet] = preprocess_sentence(bullet)
+                texts.append(preprocessed[bullet][0])
+    texts = list(dict.fromkeys(texts))
+    matrix = build_embedding_matrix(texts)
+    return preprocessed, dict(zip(texts, matrix)), get_embedding_backend().model_id
+
+
+def convert_file(path, output_dir=None, precompute=False):
+    """
+    Converts one file to the other format and returns the output path.
+    """
+    stem, extension = os.path.splitext(os.path.basename(path))
+    output_dir = output_dir or os.path.dirname(path)
+    if extension == NOTE_FILE_EXTENSION:
+        output_path = os.path.join(output_dir, stem + '.json')
+        notes = read_note_table(path).to_notes(os.path.basename(path))
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(notes_to_json_data(notes), f, indent=4)
+        return output_path
+
+    output_path = os.path.join(output_dir, stem + NOTE_FILE_EXTENSION)
+    notes = load_notes_from_file(path)
+    if precompute:
+        preprocessed, embeddings, model_id = precompute_note_data(notes)
+        write_note_table(output_path, notes, preprocessed, embeddings, model_id)
+    else:
+        write_note_table(output_path, notes)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert note files between JSON and the columnar .notes format.")
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--output-dir', default=None, help="Directory for converted files (default: next to the input)")
+    parser.add_argument('--precompute', action='store_true',
+                        help="Store preprocessed text and embeddings in .notes output")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        print(f"{path} -> {convert_file(path, args.output_dir, args.precompute)}")
+
+
+if __name__ == "__main__":
+    main()
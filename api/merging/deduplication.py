@@ -2,7 +2,9 @@
 
 import logging
 import numpy as np
-from faiss_util import create_faiss_index_inner_product, add_embeddings_to_index
+from faiss_util import (create_faiss_index_inner_product, create_faiss_index, resolve_index_kind,
+                        add_embeddings_to_index, search_above_threshold, range_search_block)
+from tracing import tracer_for, DEBUG, INFO
 
 def calculate_overlap_ratio(pre_sentence1, pre_sentence2):
     """
@@ -14,7 +16,187 @@ def calculate_overlap_ratio(pre_sentence1, pre_sentence2):
     ratio = len(overlap) / max(len(words1), len(words2)) if max(len(words1), len(words2)) > 0 else 0
     return ratio
 
-def deduplicate_sentences(sentences_info, similarity_threshold=0.7, overlap_threshold=0.3):
+def sources_by_text(retained_sources):
+    """
+    Maps retained sentence texts to their source records. Sources and conflicts are kept per
+    slot, since two slots can end up holding the same text (a replacement can bring in a text
+    another slot already holds); such a text gets one record with the conflicts of all its slots.
+    """
+    sentence_to_sources = {}
+    for record in retained_sources:
+        existing = sentence_to_sources.get(record["text"])
+        if existing is None:
+            sentence_to_sources[record["text"]] = record
+        else:
+            sentence_to_sources[record["text"]] = {**existing, "conflicts": existing["conflicts"] + record["conflicts"]}
+    return sentence_to_sources
+
+def create_retained_index(sentences_info, embeddings, dimension, index_kind='flat', index_options=None):
+    """
+    Creates the index of retained sentences, sized for the number of incoming sentences.
+    An IVF index is trained on the incoming sentences themselves.
+    """
+    kind = resolve_index_kind(index_kind, len(sentences_info))
+    training_vectors = None
+    if kind == 'ivf':
+        if embeddings is not None:
+            training_vectors = embeddings[[info[5] for info in sentences_info]]
+        else:
+            training_vectors = np.vstack([info[5] for info in sentences_info])
+    return create_faiss_index(dimension, len(sentences_info), kind, training_vectors, **(index_options or {}))
+
+class SentenceDeduplicator:
+    """
+    Greedy deduplication state that sentences can be added to over time. Adding sentences
+    in several calls gives the same result as adding them all at once, which lets the
+    incremental merge keep one deduplicator per header group.
+
+    Attributes:
+        retained_sentences (list of tuples): (note_num, sentence_idx, sentence, avg_word_length) per slot.
+        retained_preprocessed (list): Preprocessed text of each retained sentence.
+        retained_sources (list): Source record (note_id, bullet_id, text, conflicts) of each slot.
+        faiss_index: Index whose i-th vector belongs to slot i.
+    """
+    def __init__(self, faiss_index, similarity_threshold=0.7, overlap_threshold=0.3, neighbor_search='range'):
+        self.faiss_index = faiss_index
+        self.similarity_threshold = similarity_threshold
+        self.overlap_threshold = overlap_threshold
+        self.neighbor_search = neighbor_search
+        self.retained_sentences = []
+        self.retained_preprocessed = []
+        self.retained_sources = []  # Sources and conflicts of each slot
+
+    @property
+    def sentence_to_sources(self):
+        """
+        Mapping of retained sentences to their sources and conflicts (see sources_by_text).
+        """
+        return sources_by_text(self.retained_sources)
+
+    def add(self, sentences_info, embeddings=None):
+        """
+        Deduplicates sentences against everything added so far.
+
+        Parameters:
+            sentences_info (list of tuples): As in deduplicate_sentences.
+            embeddings (numpy array): Optional float32 matrix the row ids refer to.
+        """
+        retained_sentences = self.retained_sentences
+        retained_preprocessed = self.retained_preprocessed
+        retained_sources = self.retained_sources
+        faiss_index = self.faiss_index
+        similarity_threshold = self.similarity_threshold
+        overlap_threshold = self.overlap_threshold
+
+        if embeddings is not None:
+            def as_query(row):
+                return embeddings[row:row + 1]  # A 1-row view of the shared matrix
+        else:
+            def as_query(vector):
+                return np.asarray(vector, dtype=np.float32).reshape(1, -1)
+
+        # Per-sentence decisions go to the trace (see tracing.py), not the log
+        trace = tracer_for('deduplication', DEBUG)
+        trace_decision = tracer_for('deduplication', INFO)
+
+        for idx, (note_num, sentence_idx, sentence, pre_sentence, avg_word_length, embedding) in enumerate(sentences_info):
+            query = as_query(embedding)
+            sentence_clean = sentence.strip('.')
+            if trace:
+                trace('sentence', index=idx + 1, text=sentence_clean, note_id=note_num, bullet_id=sentence_idx)
+        
+            if faiss_index.ntotal == 0:
+                # Retain the first sentence
+                retained_sentences.append((note_num, sentence_idx, sentence_clean, avg_word_length))
+                retained_preprocessed.append(pre_sentence)
+                add_embeddings_to_index(faiss_index, query)
+                retained_sources.append({
+                    "note_id": note_num,
+                    "bullet_id": sentence_idx,
+                    "text": sentence_clean,
+                    "conflicts": []
+                })
+                if trace_decision:
+                    trace_decision('retain', text=sentence_clean)
+                continue
+        
+            # Query FAISS for the retained sentences above the similarity threshold, most similar first
+            similarities, indices = search_above_threshold(faiss_index, query, similarity_threshold, self.neighbor_search)
+        
+            is_duplicate = False
+        
+            for sim, idx_retained in zip(similarities, indices):
+                if sim >= similarity_threshold:
+                    # Calculate overlap ratio
+                    retained_sentence_tuple = retained_sentences[idx_retained]
+                    retained_avg_word_length = retained_sentence_tuple[3]
+                    retained_sentence = retained_sentence_tuple[2]
+                    retained_note_num = retained_sentence_tuple[0]
+                    retained_sentence_idx = retained_sentence_tuple[1]
+                    retained_pre_sentence = retained_preprocessed[idx_retained]
+                    overlap_ratio = calculate_overlap_ratio(pre_sentence, retained_pre_sentence)
+                
+                    if trace:
+                        trace('compare', text=sentence_clean, retained=retained_sentence,
+                              similarity=sim, overlap_ratio=overlap_ratio)
+                
+                    if overlap_ratio >= overlap_threshold:
+                        if avg_word_length > retained_avg_word_length:
+                            # Replace the retained sentence with the current one
+                            if trace_decision:
+                                trace_decision('replace', text=sentence_clean, avg_word_length=avg_word_length,
+                                               retained=retained_sentence, retained_avg_word_length=retained_avg_word_length)
+                            # Collect all conflicts from the old retained sentence, including itself
+                            old_conflicts = retained_sources[idx_retained]["conflicts"]
+                            old_conflicts.append({
+                                "note_id": retained_note_num,
+                                "bullet_id": retained_sentence_idx,
+                                "text": retained_sentence,
+                                "similarity": float(sim),
+                                "overlap_ratio": float(overlap_ratio)
+                            })
+                            # Add the old conflicts to the new retained sentence's conflicts
+                            retained_sources[idx_retained] = {
+                                "note_id": note_num,
+                                "bullet_id": sentence_idx,
+                                "text": sentence_clean,
+                                "conflicts": old_conflicts
+                            }
+                            # Update retained_sentences and retained_preprocessed
+                            retained_sentences[idx_retained] = (note_num, sentence_idx, sentence_clean, avg_word_length)
+                            retained_preprocessed[idx_retained] = pre_sentence
+                        else:
+                            # Current sentence is a duplicate and will be discarded
+                            if trace_decision:
+                                trace_decision('discard', text=sentence_clean, avg_word_length=avg_word_length,
+                                               retained=retained_sentence, retained_avg_word_length=retained_avg_word_length)
+                            conflict_info = {
+                                "note_id": note_num,
+                                "bullet_id": sentence_idx,
+                                "text": sentence_clean,
+                                "similarity": float(sim),
+                                "overlap_ratio": float(overlap_ratio)
+                            }
+                            retained_sources[idx_retained]["conflicts"].append(conflict_info)
+                        is_duplicate = True
+                        break  # No need to check further
+        
+            if not is_duplicate:
+                # Retain the sentence
+                retained_sentences.append((note_num, sentence_idx, sentence_clean, avg_word_length))
+                retained_preprocessed.append(pre_sentence)
+                add_embeddings_to_index(faiss_index, query)
+                retained_sources.append({
+                    "note_id": note_num,
+                    "bullet_id": sentence_idx,
+                    "text": sentence_clean,
+                    "conflicts": []
+                })
+                if trace_decision:
+                    trace_decision('retain', text=sentence_clean)
+
+def deduplicate_sentences(sentences_info, similarity_threshold=0.7, overlap_threshold=0.3, embeddings=None,
+                          neighbor_search='range', index_kind='flat', index_options=None):
     """
     Deduplicates sentences based on cosine similarity and overlap ratio.
     When duplicates are found, keeps the sentence with the highest average word length.
@@ -23,8 +205,19 @@ def deduplicate_sentences(sentences_info, similarity_threshold=0.7, overlap_thre
     Parameters:
         sentences_info (list of tuples): Each tuple contains:
             (note_num, sentence_idx, sentence, pre_sentence, avg_word_length, embedding)
+            where embedding is a vector, or a row id into embeddings when that is given.
         similarity_threshold (float): Cosine similarity threshold to consider duplicates.
         overlap_threshold (float): Overlap ratio threshold to consider duplicates.
+        embeddings (numpy array): Optional float32 matrix the row ids refer to. Rows are
+            passed to FAISS as views, without copies or dtype conversions.
+        neighbor_search (str): How retained neighbors are retrieved: 'range' (only those above
+            similarity_threshold, via FAISS range search), 'topk' (bounded top-k that grows until
+            it passes the threshold) or 'full' (rank every retained sentence, the original search).
+            'range' and 'topk' visit retained sentences with exactly equal similarity in id order,
+            while 'full' keeps FAISS's order for them, so results can differ on such ties.
+        index_kind (str): Index of retained sentences: 'flat' (exact), 'hnsw', 'ivf', or 'auto'
+            to pick one by the number of sentences. Approximate indexes may miss a few duplicates.
+        index_options (dict): Tunables passed to faiss_util.create_faiss_index, e.g. nprobe or ef_search.
     
     Returns:
         retained_sentences (list of tuples): Sentences retained after deduplication.
@@ -32,112 +225,137 @@ def deduplicate_sentences(sentences_info, similarity_threshold=0.7, overlap_thre
     """
     if not sentences_info:
         return [], {}
-    
-    retained_sentences = []
-    retained_preprocessed = []
-    sentence_to_sources = {}  # Maps kept sentences to their conflicts
-    
+
+    if embeddings is not None:
+        dimension = embeddings.shape[1]
+    else:
+        dimension = sentences_info[0][5].shape[0]  # embeddings are in index 5
+
     # Initialize FAISS index for Inner Product
-    dimension = sentences_info[0][5].shape[0]  # embeddings are in index 5
-    faiss_index = create_faiss_index_inner_product(dimension)
-    
-    for idx, (note_num, sentence_idx, sentence, pre_sentence, avg_word_length, embedding) in enumerate(sentences_info):
-        sentence_clean = sentence.strip('.')
-        logging.debug(f"Processing sentence {idx+1}: '{sentence_clean}' from note {note_num}, sentence {sentence_idx}")
-        
-        if faiss_index.ntotal == 0:
-            # Retain the first sentence
-            retained_sentences.append((note_num, sentence_idx, sentence_clean, avg_word_length))
-            retained_preprocessed.append(pre_sentence)
-            add_embeddings_to_index(faiss_index, embedding.reshape(1, -1))
-            sentence_to_sources[sentence_clean] = {
-                "note_id": note_num,
-                "bullet_id": sentence_idx,
-                "text": sentence_clean,
-                "conflicts": []
-            }
-            logging.info(f"Retained sentence: '{sentence_clean}'")
-            continue
-        
-        # Query FAISS for all similar sentences
-        top_k = faiss_index.ntotal  # Retrieve all to compare with every retained sentence
-        D, I = faiss_index.search(embedding.reshape(1, -1), top_k)
-        similarities = D[0]
-        indices = I[0]
-        
-        is_duplicate = False
-        
-        for sim, idx_retained in zip(similarities, indices):
-            if sim >= similarity_threshold:
-                # Calculate overlap ratio
-                retained_sentence_tuple = retained_sentences[idx_retained]
-                retained_avg_word_length = retained_sentence_tuple[3]
-                retained_sentence = retained_sentence_tuple[2]
-                retained_note_num = retained_sentence_tuple[0]
-                retained_sentence_idx = retained_sentence_tuple[1]
-                retained_pre_sentence = retained_preprocessed[idx_retained]
-                overlap_ratio = calculate_overlap_ratio(pre_sentence, retained_pre_sentence)
-                
-                logging.debug(
-                    f"Comparing with retained sentence: '{retained_sentence}' | "
-                    f"Similarity: {sim:.4f} | Overlap Ratio: {overlap_ratio:.4f}"
-                )
-                
-                if overlap_ratio >= overlap_threshold:
-                    if avg_word_length > retained_avg_word_length:
-                        # Replace the retained sentence with the current one
-                        logging.info(
-                            f"Replacing retained sentence '{retained_sentence}' (avg word length {retained_avg_word_length:.2f}) "
-                            f"with '{sentence_clean}' (avg word length {avg_word_length:.2f}) due to higher average word length."
-                        )
-                        # Collect all conflicts from the old retained sentence, including itself
-                        old_conflicts = sentence_to_sources.pop(retained_sentence)["conflicts"]
-                        old_conflicts.append({
-                            "note_id": retained_note_num,
-                            "bullet_id": retained_sentence_idx,
-                            "text": retained_sentence,
-                            "similarity": float(sim),
-                            "overlap_ratio": float(overlap_ratio)
-                        })
-                        # Add the old conflicts to the new retained sentence's conflicts
-                        sentence_to_sources[sentence_clean] = {
-                            "note_id": note_num,
-                            "bullet_id": sentence_idx,
-                            "text": sentence_clean,
-                            "conflicts": old_conflicts
-                        }
-                        # Update retained_sentences and retained_preprocessed
-                        retained_sentences[idx_retained] = (note_num, sentence_idx, sentence_clean, avg_word_length)
-                        retained_preprocessed[idx_retained] = pre_sentence
-                    else:
-                        # Current sentence is a duplicate and will be discarded
-                        logging.info(
-                            f"Discarding sentence '{sentence_clean}' (avg word length {avg_word_length:.2f}) due to duplication with "
-                            f"retained sentence '{retained_sentence}' (avg word length {retained_avg_word_length:.2f})."
-                        )
-                        conflict_info = {
-                            "note_id": note_num,
-                            "bullet_id": sentence_idx,
-                            "text": sentence_clean,
-                            "similarity": float(sim),
-                            "overlap_ratio": float(overlap_ratio)
-                        }
-                        sentence_to_sources[retained_sentence]["conflicts"].append(conflict_info)
-                    is_duplicate = True
-                    break  # No need to check further
-        
-        if not is_duplicate:
-            # Retain the sentence
-            retained_sentences.append((note_num, sentence_idx, sentence_clean, avg_word_length))
-            retained_preprocessed.append(pre_sentence)
-            add_embeddings_to_index(faiss_index, embedding.reshape(1, -1))
-            sentence_to_sources[sentence_clean] = {
-                "note_id": note_num,
-                "bullet_id": sentence_idx,
-                "text": sentence_clean,
-                "conflicts": []
-            }
-            logging.info(f"Retained sentence: '{sentence_clean}'")
-    
+    faiss_index = create_retained_index(sentences_info, embeddings, dimension, index_kind, index_options)
+    deduplicator = SentenceDeduplicator(faiss_index, similarity_threshold, overlap_threshold, neighbor_search)
+    deduplicator.add(sentences_info, embeddings)
+
+    logging.info(f"Total retained sentences after deduplication: {len(deduplicator.retained_sentences)}")
+    return deduplicator.retained_sentences, deduplicator.sentence_to_sources
+
+def deduplicate_sentences_batched(sentences_info, similarity_threshold=0.7, overlap_threshold=0.3, embeddings=None,
+                                  block_size=128, index_kind='flat', index_options=None):
+    """
+    Block-wise engine with the same results as deduplicate_sentences.
+
+    Incoming sentences are processed in blocks. For each block, similarities against every
+    sentence retained before the block, and between sentences of the block itself, are
+    computed with two batched FAISS range searches, which drop everything below
+    similarity_threshold in bulk. The greedy keep/replace order is then resolved in one
+    tight loop over the block using precomputed word sets for the overlap ratio.
+
+    Parameters:
+        sentences_info (list of tuples): Same as deduplicate_sentences.
+        similarity_threshold (float): Cosine similarity threshold to consider duplicates.
+        overlap_threshold (float): Overlap ratio threshold to consider duplicates.
+        embeddings (numpy array): Optional float32 matrix the row ids in sentences_info refer to.
+        block_size (int): Number of incoming sentences scored together.
+        index_kind (str): Index of retained sentences, as in deduplicate_sentences.
+        index_options (dict): Tunables passed to faiss_util.create_faiss_index.
+
+    Returns:
+        retained_sentences (list of tuples): Sentences retained after deduplication.
+        sentence_to_sources (dict): Mapping of retained sentences to their sources and conflicts.
+    """
+    if not sentences_info:
+        return [], {}
+
+    if embeddings is not None:
+        rows = np.array([info[5] for info in sentences_info], dtype=np.intp)
+        def block_vectors(start, end):
+            return embeddings[rows[start:end]]  # One gather per block
+        dimension = embeddings.shape[1]
+    else:
+        def block_vectors(start, end):
+            return np.ascontiguousarray(np.vstack([info[5] for info in sentences_info[start:end]]), dtype=np.float32)
+        dimension = sentences_info[0][5].shape[0]
+
+    retained_sentences = []
+    retained_word_sets = []
+    retained_sources = []  # Per slot, as in SentenceDeduplicator
+    # Like the sequential engine, each retained slot keeps the embedding of the sentence that created it
+    faiss_index = create_retained_index(sentences_info, embeddings, dimension, index_kind, index_options)
+
+    for start in range(0, len(sentences_info), block_size):
+        end = min(start + block_size, len(sentences_info))
+        block = block_vectors(start, end)
+        retained_hits = range_search_block(faiss_index, block, similarity_threshold)
+        block_index = create_faiss_index_inner_product(dimension)
+        add_embeddings_to_index(block_index, block)
+        block_hits = range_search_block(block_index, block, similarity_threshold)
+
+        new_slots = {}  # block offset -> slot id, for sentences retained within this block
+        for offset in range(end - start):
+            note_num, sentence_idx, sentence, pre_sentence, avg_word_length, _ = sentences_info[start + offset]
+            sentence_clean = sentence.strip('.')
+            words = set(pre_sentence.split())
+
+            similarities, slots = retained_hits[offset]
+            block_sims, block_offsets = block_hits[offset]
+            earlier = [(sim, new_slots[k]) for sim, k in zip(block_sims, block_offsets) if k in new_slots]
+            if earlier:
+                similarities = np.concatenate([similarities, np.array([e[0] for e in earlier], dtype=np.float32)])
+                slots = np.concatenate([slots, np.array([e[1] for e in earlier], dtype=np.int64)])
+                order = np.lexsort((slots, -similarities))
+                similarities, slots = similarities[order], slots[order]
+
+            is_duplicate = False
+            for sim, slot in zip(similarities.tolist(), slots.tolist()):
+                retained_words = retained_word_sets[slot]
+                longest = max(len(words), len(retained_words))
+                overlap_ratio = len(words & retained_words) / longest if longest > 0 else 0
+                if overlap_ratio < overlap_threshold:
+                    continue
+                retained_note_num, retained_sentence_idx, retained_sentence, retained_avg_word_length = retained_sentences[slot]
+                if avg_word_length > retained_avg_word_length:
+                    # Replace the retained sentence, moving it and its conflicts to the new one
+                    old_conflicts = retained_sources[slot]["conflicts"]
+                    old_conflicts.append({
+                        "note_id": retained_note_num,
+                        "bullet_id": retained_sentence_idx,
+                        "text": retained_sentence,
+                        "similarity": float(sim),
+                        "overlap_ratio": float(overlap_ratio)
+                    })
+                    retained_sources[slot] = {
+                        "note_id": note_num,
+                        "bullet_id": sentence_idx,
+                        "text": sentence_clean,
+                        "conflicts": old_conflicts
+                    }
+                    retained_sentences[slot] = (note_num, sentence_idx, sentence_clean, avg_word_length)
+                    retained_word_sets[slot] = words
+                else:
+                    retained_sources[slot]["conflicts"].append({
+                        "note_id": note_num,
+                        "bullet_id": sentence_idx,
+                        "text": sentence_clean,
+                        "similarity": float(sim),
+                        "overlap_ratio": float(overlap_ratio)
+                    })
+                is_duplicate = True
+                break
+
+            if not is_duplicate:
+                new_slots[offset] = len(retained_sentences)
+                retained_sentences.append((note_num, sentence_idx, sentence_clean, avg_word_length))
+                retained_word_sets.append(words)
+                retained_sources.append({
+                    "note_id": note_num,
+                    "bullet_id": sentence_idx,
+                    "text": sentence_clean,
+                    "conflicts": []
+                })
+
+        # Slots were created in offset order, so their FAISS ids stay aligned with retained_sentences
+        if new_slots:
+            add_embeddings_to_index(faiss_index, block[sorted(new_slots)])
+
     logging.info(f"Total retained sentences after deduplication: {len(retained_sentences)}")
-    return retained_sentences, sentence_to_sources
+    return retained_sentences, sources_by_text(retained_sources)
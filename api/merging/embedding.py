@@ -1,12 +1,227 @@
 # embedding.py
 
-import numpy as np
+import os
+import re
+import zlib
+import hashlib
 import logging
+import numpy as np
+from embedding_cache import EmbeddingCache
+
+DEFAULT_DIMENSION = 768
+
+# Persistent embedding cache location; set EMBEDDING_CACHE_DIR to '' to disable it
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.embedding_cache')
+
+
+class RandomBackend:
+    """
+    Placeholder backend - draws a pseudo-random vector per text, seeded from a stable
+    hash of the text so the same text gets the same vector in every process.
+    Does not capture meaning; kept as the default so existing merges behave the same.
+    """
+    def __init__(self, dimension=DEFAULT_DIMENSION, batch_size=256):
+        self.dimension = dimension
+        self.batch_size = batch_size
+        self.model_id = f"random-{dimension}"
+
+    def encode(self, texts):
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float64)
+        for row, text in enumerate(texts):
+            # Python's hash() is randomized per process, so seed from a content hash instead
+            seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=4).digest(), 'little')
+            embeddings[row] = np.random.RandomState(seed % (2**32 - 1)).rand(self.dimension)
+        return embeddings
+
+
+class HashingBackend:
+    """
+    Offline lexical backend - hashes word unigrams and bigrams into a fixed number of
+    signed buckets with sublinear term frequency weighting. Needs no model files and
+    is stable across processes, so it is suitable for tests and air-gapped machines.
+    """
+    token_pattern = re.compile(r'\b\w+\b')
+
+    def __init__(self, dimension=DEFAULT_DIMENSION, batch_size=1024, ngram_range=(1, 2)):
+        self.dimension = dimension
+        self.batch_size = batch_size
+        self.ngram_range = ngram_range
+        self.model_id = f"hashing-{dimension}-{ngram_range[0]}-{ngram_range[1]}"
+
+    def features(self, text):
+        tokens = self.token_pattern.findall(text.lower())
+        for n in range(self.ngram_range[0], self.ngram_range[1] + 1):
+            for i in range(len(tokens) - n + 1):
+                yield ' '.join(tokens[i:i + n])
+
+    def encode(self, texts):
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            for feature in self.features(text):
+                rows.append(row)
+                hashes.append(zlib.crc32(feature.encode('utf-8')))
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float64)
+        if not rows:
+            return embeddings
+        hashes = np.array(hashes, dtype=np.uint64)
+        cols = (hashes % self.dimension).astype(np.intp)
+        signs = np.where((hashes >> np.uint64(31)) & np.uint64(1), -1.0, 1.0)
+        np.add.at(embeddings, (np.array(rows, dtype=np.intp), cols), signs)
+        # Sublinear term frequency keeps repeated words from dominating
+        return np.sign(embeddings) * np.log1p(np.abs(embeddings))
+
+
+class SentenceTransformerBackend:
+    """
+    sentence-transformers model loaded from a local path (no downloads at run time).
+    The only backend with num_threads, which limits the threads torch uses to encode.
+    """
+    def __init__(self, model_path=None, batch_size=32, num_threads=None, device='cpu'):
+        model_path = model_path or os.environ.get('EMBEDDING_MODEL_PATH')
+        if not model_path:
+            raise ValueError("SentenceTransformerBackend needs model_path or EMBEDDING_MODEL_PATH.")
+        if num_threads is not None:
+            import torch
+            torch.set_num_threads(num_threads)
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_path, device=device, local_files_only=True)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.model_id = f"sentence-transformers:{os.path.basename(os.path.normpath(model_path))}"
+
+    def encode(self, texts):
+        return self.model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+
+
+# Registry of available backends by name
+EMBEDDING_BACKENDS = {
+    'random': RandomBackend,
+    'hashing': HashingBackend,
+    'sentence-transformers': SentenceTransformerBackend,
+}
+
+_active_backend = None
+_embedding_caches = {}
+
+
+def register_backend(name, backend_class):
+    """
+    Registers a backend class. It must provide dimension, model_id and encode(texts) -> 2D array.
+    """
+    EMBEDDING_BACKENDS[name] = backend_class
+
+
+def set_embedding_backend(name, **options):
+    """
+    Selects the backend used by generate_embeddings.
+
+    Parameters:
+        name (str): Name of a registered backend ('random', 'hashing', 'sentence-transformers').
+        **options: Backend options such as batch_size, dimension or model_path. num_threads is
+            only accepted by 'sentence-transformers'; the other backends encode on one thread.
+
+    Returns:
+        backend: The new active backend instance.
+    """
+    global _active_backend
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}'. Available: {sorted(EMBEDDING_BACKENDS)}")
+    _active_backend = EMBEDDING_BACKENDS[name](**options)
+    logging.info(f"Using embedding backend '{_active_backend.model_id}'")
+    return _active_backend
+
+
+def get_embedding_backend():
+    """
+    Returns the active backend, creating it from the EMBEDDING_BACKEND environment
+    variable (default 'random') on first use.
+    """
+    if _active_backend is None:
+        set_embedding_backend(os.environ.get('EMBEDDING_BACKEND', 'random'))
+    return _active_backend
+
+
+def embed_texts(texts, normalize=True, backend=None):
+    """
+    Generates embeddings for a batch of texts in chunks of the backend's batch_size.
+
+    Parameters:
+        texts (list): List of text strings to generate embeddings for.
+        normalize (bool): Whether to L2-normalize the embeddings.
+        backend: Backend instance to use; defaults to the active backend.
+
+    Returns:
+        embeddings (numpy array): float32 matrix of shape (len(texts), dimension).
+    """
+    backend = backend or get_embedding_backend()
+    if not texts:
+        return np.zeros((0, backend.dimension), dtype=np.float32)
+    chunks = [
+        np.asarray(backend.encode(texts[start:start + backend.batch_size]))
+        for start in range(0, len(texts), backend.batch_size)
+    ]
+    embeddings = np.concatenate(chunks, axis=0) if len(chunks) > 1 else chunks[0]
+    if normalize:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings / np.where(norms == 0, 1, norms)
+    logging.debug(f"Generated {len(texts)} embeddings with backend '{backend.model_id}'")
+    # Converted once here so the rest of the pipeline works on float32 without further copies
+    return embeddings.astype(np.float32, copy=False)
+
+
+def get_embedding_cache(backend=None, normalize=True):
+    """
+    Returns the persistent cache for a backend, or None if EMBEDDING_CACHE_DIR is set to ''.
+    Cache size is limited by EMBEDDING_CACHE_MAX_ENTRIES (default 200000).
+    """
+    backend = backend or get_embedding_backend()
+    cache_dir = os.environ.get('EMBEDDING_CACHE_DIR', DEFAULT_CACHE_DIR)
+    if not cache_dir:
+        return None
+    model_id = backend.model_id if normalize else f"{backend.model_id}-unnormalized"
+    if (cache_dir, model_id) not in _embedding_caches:
+        max_entries = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 200000))
+        _embedding_caches[(cache_dir, model_id)] = EmbeddingCache(
+            cache_dir, model_id, backend.dimension, max_entries=max_entries
+        )
+    return _embedding_caches[(cache_dir, model_id)]
+
+
+def cached_embed_texts(texts, normalize=True, backend=None):
+    """
+    Like embed_texts, but serves texts from the persistent cache when possible and
+    stores newly generated embeddings in it.
+
+    Returns:
+        embeddings (numpy array): float32 matrix of shape (len(texts), dimension).
+    """
+    backend = backend or get_embedding_backend()
+    cache = get_embedding_cache(backend, normalize)
+    if cache is None:
+        return embed_texts(texts, normalize, backend)
+
+    embeddings = np.empty((len(texts), backend.dimension), dtype=np.float32)
+    positions, cached, missing = cache.lookup(texts)
+    if positions:
+        embeddings[positions] = cached
+    if missing:
+        missing_texts = [texts[position] for position in missing]
+        new_embeddings = embed_texts(missing_texts, normalize, backend)
+        embeddings[missing] = new_embeddings
+        cache.put_many(missing_texts, new_embeddings)
+    logging.debug(f"Embedding cache: {len(positions)} hits, {len(missing)} misses")
+    return embeddings
+
 
 def generate_embeddings(texts, normalize=True):
     """
-    Generates embeddings for a list of texts.
-    Placeholder function - in real implementation, you would use a pre-trained model like BERT.
+    Generates embeddings for a list of texts with the active backend.
 
     Parameters:
         texts (list): List of text strings to generate embeddings for.
@@ -15,13 +230,4 @@ def generate_embeddings(texts, normalize=True):
     Returns:
         embeddings (list of numpy arrays): Embeddings for the texts.
     """
-    # Placeholder: generate random embeddings
-    embeddings = []
-    for text in texts:
-        np.random.seed(hash(text) % (2**32 - 1))  # Seed to get consistent embeddings per text
-        embedding = np.random.rand(768)  # Assuming embedding dimension is 768
-        if normalize:
-            embedding = embedding / np.linalg.norm(embedding)
-        embeddings.append(embedding)
-        logging.debug(f"Generated embedding for text: '{text[:30]}...'")
-    return embeddings
+    return list(embed_texts(list(texts), normalize=normalize))
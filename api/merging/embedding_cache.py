@@ -0,0 +1,244 @@
+# embedding_cache.py
+
+import os
+import json
+import fcntl
+import hashlib
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+
+INITIAL_CAPACITY = 1024
+
+
+def cache_key(text, model_id):
+    """
+    Stable content hash of the text and the model that embedded it. The text is hashed
+    exactly as the backend receives it, since backends may embed any difference.
+    """
+    data = f"{model_id}\0{text}".encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk embedding cache for one model, shared between processes.
+
+    Vectors are stored as rows of a memory-mapped float32 matrix (vectors.npy) and
+    index.json maps each key to its row in least-recently-used order. New entries are
+    appended to index.log as "key row" lines, and the log is folded into index.json once
+    it holds more lines than the index has entries. When the cache holds max_entries
+    vectors, the least recently used rows are reused for new ones.
+    """
+    def __init__(self, cache_dir, model_id, dimension, max_entries=200000, max_bytes=None):
+        safe_model_id = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in model_id)
+        self.directory = os.path.join(cache_dir, safe_model_id)
+        self.index_path = os.path.join(self.directory, 'index.json')
+        self.log_path = os.path.join(self.directory, 'index.log')
+        self.vectors_path = os.path.join(self.directory, 'vectors.npy')
+        self.lock_path = os.path.join(self.directory, '.lock')
+        self.model_id = model_id
+        self.dimension = dimension
+        if max_bytes is not None:
+            max_entries = min(max_entries, max(1, max_bytes // (dimension * 4)))
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock():
+            self._load()
+
+    @contextmanager
+    def _lock(self, shared=False):
+        # Writers hold the lock exclusively; readers share it, so no row is reused while they read it
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        self.entries = OrderedDict()  # key -> row, oldest first
+        self.row_keys = {}  # row -> key, to drop keys whose row another process reused
+        self.next_row = 0
+        self.vectors = None
+        self.vectors_inode = None
+        self.index_mtime = None
+        self.log_offset = 0
+        self.log_lines = 0
+        if os.path.exists(self.index_path) and os.path.exists(self.vectors_path):
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('dimension') == self.dimension and index.get('model_id') == self.model_id:
+                self.entries = OrderedDict(index['entries'])
+                self.row_keys = {row: key for key, row in self.entries.items()}
+                self.next_row = index['next_row']
+                self._open_vectors()
+                self.index_mtime = os.path.getmtime(self.index_path)
+                self._read_log()
+            else:
+                logging.info(f"Discarding embedding cache in {self.directory}: model or dimension changed.")
+
+    def _open_vectors(self):
+        self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+        self.vectors_inode = os.stat(self.vectors_path).st_ino
+
+    def _read_log(self):
+        # Applies the entries other processes appended since this process last read the log
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(self.log_offset)
+            data = f.read()
+        self.log_offset += len(data)
+        for line in data.decode('utf-8').splitlines():
+            key, row = line.split()
+            self._set_entry(key, int(row))
+            self.next_row = max(self.next_row, int(row) + 1)
+            self.log_lines += 1
+
+    def _set_entry(self, key, row):
+        # A row holds one key, so a key whose row was reused is no longer cached
+        previous_key = self.row_keys.get(row)
+        if previous_key is not None and self.entries.get(previous_key) == row:
+            del self.entries[previous_key]
+        previous_row = self.entries.get(key)
+        if previous_row is not None and self.row_keys.get(previous_row) == key:
+            del self.row_keys[previous_row]
+        self.entries[key] = row
+        self.entries.move_to_end(key)
+        self.row_keys[row] = key
+
+    def _append_log(self, added):
+        lines = ''.join(f"{key} {row}\n" for key, row in added)
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+        self.log_offset += len(lines.encode('utf-8'))
+        self.log_lines += len(added)
+
+    def _save(self):
+        index = {
+            'model_id': self.model_id,
+            'dimension': self.dimension,
+            'next_row': self.next_row,
+            'entries': list(self.entries.items()),
+        }
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+        self.index_mtime = os.path.getmtime(self.index_path)
+        # The log is folded into the index now
+        open(self.log_path, 'w').close()
+        self.log_offset = 0
+        self.log_lines = 0
+
+    def _refresh(self):
+        # Pick up entries written by other processes since the index was loaded,
+        # keeping the entries this process used as the most recent ones
+        if not os.path.exists(self.index_path):
+            return
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        if os.path.getmtime(self.index_path) != self.index_mtime or log_size < self.log_offset:
+            recent = list(self.entries)
+            self._load()
+            for key in recent:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+            return
+        if log_size > self.log_offset:
+            self._read_log()
+        if self.vectors is not None and os.stat(self.vectors_path).st_ino != self.vectors_inode:
+            # Another process grew the matrix and replaced the file
+            self._open_vectors()
+
+    def _ensure_capacity(self, rows):
+        capacity = 0 if self.vectors is None else self.vectors.shape[0]
+        if rows <= capacity:
+            return
+        new_capacity = max(INITIAL_CAPACITY, capacity * 2)
+        while new_capacity < rows:
+            new_capacity *= 2
+        new_capacity = min(new_capacity, max(self.max_entries, rows))
+        tmp_path = f"{self.vectors_path}.{os.getpid()}.tmp.npy"
+        grown = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                          shape=(new_capacity, self.dimension))
+        if capacity:
+            grown[:capacity] = self.vectors
+        grown.flush()
+        del grown
+        self.vectors = None
+        os.replace(tmp_path, self.vectors_path)
+        self._open_vectors()
+
+    def _allocate_row(self):
+        if len(self.entries) >= self.max_entries:
+            # Evict the least recently used entry and reuse its row
+            _, row = self.entries.popitem(last=False)
+            return row
+        row = self.next_row
+        self.next_row += 1
+        self._ensure_capacity(self.next_row)
+        return row
+
+    def lookup(self, texts):
+        """
+        Looks up texts in the cache and reads the cached vectors.
+
+        Returns:
+            positions (list): Positions in texts that are cached.
+            vectors (numpy array): float32 vector of each cached text, aligned with positions.
+            missing (list): Positions in texts that are not cached.
+        """
+        # Another process's eviction may reuse a row, so the index is refreshed and the rows
+        # are read under the lock
+        with self._lock(shared=True):
+            self._refresh()
+            positions, rows, missing = [], [], []
+            for position, text in enumerate(texts):
+                key = cache_key(text, self.model_id)
+                row = self.entries.get(key)
+                if row is None or self.vectors is None:
+                    missing.append(position)
+                    continue
+                self.entries.move_to_end(key)
+                positions.append(position)
+                rows.append(row)
+            vectors = self.vectors[rows] if rows else np.empty((0, self.dimension), dtype=np.float32)
+        self.hits += len(positions)
+        self.misses += len(missing)
+        return positions, vectors, missing
+
+    def put_many(self, texts, vectors):
+        """
+        Stores vectors for texts and appends their entries to the index log.
+        """
+        if not texts:
+            return
+        with self._lock():
+            self._refresh()
+            added = []
+            for text, vector in zip(texts, vectors):
+                key = cache_key(text, self.model_id)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    continue
+                row = self._allocate_row()
+                self.vectors[row] = vector
+                self._set_entry(key, row)
+                added.append((key, row))
+            self.vectors.flush()
+            if self.index_mtime is None or self.log_lines + len(added) > max(INITIAL_CAPACITY, len(self.entries)):
+                self._save()
+            elif added:
+                self._append_log(added)
+
+    def flush(self):
+        """
+        Folds the log into index.json and persists the current least-recently-used order.
+        """
+        with self._lock():
+            self._refresh()
+            self._save()
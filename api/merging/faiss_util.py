@@ -1,16 +1,253 @@
 # faiss_util.py
 
-import faiss
+import time
+import threading
 import numpy as np
 import logging
+import tracing
+
+# FAISS is imported on first use through get_faiss, so importing this module stays cheap
+faiss = None
+
+# Index sizes used by kind='auto': exact search below FLAT_MAX_VECTORS, HNSW below
+# IVF_MIN_VECTORS, and IVF above that (when training vectors are available)
+FLAT_MAX_VECTORS = 20000
+IVF_MIN_VECTORS = 1000000
+
+# FAISS searches issued by each thread, read before and after a piece of work to count its searches
+search_counts = threading.local()
+
+# Function to record one FAISS search call and the number of queries in it
+def count_search(num_queries):
+    search_counts.calls = getattr(search_counts, 'calls', 0) + 1
+    search_counts.queries = getattr(search_counts, 'queries', 0) + num_queries
+
+# Function to read this thread's (calls, queries) search totals
+def thread_search_counts():
+    return getattr(search_counts, 'calls', 0), getattr(search_counts, 'queries', 0)
+
+# Function to import FAISS the first time an index is needed
+def get_faiss():
+    global faiss
+    if faiss is None:
+        import faiss as faiss_module
+        faiss = faiss_module
+    return faiss
 
 # Function to create a FAISS index for Inner Product (to use with normalized embeddings)
 def create_faiss_index_inner_product(dimension):
-    index = faiss.IndexFlatIP(dimension)  # Inner Product for cosine similarity
+    index = get_faiss().IndexFlatIP(dimension)  # Inner Product for cosine similarity
     logging.debug(f"FAISS IndexFlatIP created for dimension: {dimension}.")
     return index
 
+# Function to pick an index type from the number of vectors it will hold
+def resolve_index_kind(kind, expected_size, has_training_vectors=True):
+    """
+    Resolves kind='auto' to 'flat', 'hnsw' or 'ivf'; other kinds are returned unchanged.
+    """
+    if kind != 'auto':
+        if kind not in ('flat', 'hnsw', 'ivf'):
+            raise ValueError(f"Unknown index kind '{kind}'. Use 'auto', 'flat', 'hnsw' or 'ivf'.")
+        return kind
+    if expected_size < FLAT_MAX_VECTORS:
+        return 'flat'
+    if expected_size < IVF_MIN_VECTORS or not has_training_vectors:
+        return 'hnsw'
+    return 'ivf'
+
+# Function to create an exact or approximate inner product index sized for the data
+def create_faiss_index(dimension, expected_size=0, kind='auto', training_vectors=None,
+                       nlist=None, nprobe=16, hnsw_m=32, ef_construction=80, ef_search=64):
+    """
+    Creates an inner product index suited to the number of vectors it will hold.
+
+    Parameters:
+        dimension (int): Vector dimension.
+        expected_size (int): Number of vectors the index is expected to hold.
+        kind (str): 'flat' (exact), 'hnsw', 'ivf', or 'auto' to choose by expected_size.
+        training_vectors (numpy array): Sample used to train the IVF coarse quantizer.
+        nlist (int): Number of IVF lists; defaults to 4 * sqrt(expected_size).
+        nprobe (int): IVF lists scanned per query. Higher is slower and more accurate.
+        hnsw_m (int): Neighbors per HNSW node.
+        ef_construction (int): HNSW candidate list size while adding vectors.
+        ef_search (int): HNSW candidate list size while searching. Higher is slower and more accurate.
+
+    Returns:
+        index: An empty (but trained, for IVF) FAISS index.
+    """
+    kind = resolve_index_kind(kind, expected_size, training_vectors is not None)
+    if kind == 'flat':
+        return create_faiss_index_inner_product(dimension)
+
+    faiss_module = get_faiss()
+    if kind == 'hnsw':
+        index = faiss_module.IndexHNSWFlat(dimension, hnsw_m, faiss_module.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        logging.debug(f"FAISS IndexHNSWFlat created for dimension: {dimension} (M={hnsw_m}, efSearch={ef_search}).")
+        return index
+
+    if training_vectors is None:
+        raise ValueError("An IVF index needs training_vectors.")
+    training_vectors = np.ascontiguousarray(training_vectors, dtype=np.float32)
+    if nlist is None:
+        # About 4 * sqrt(n) lists, with the 39 training points per list k-means asks for
+        nlist = min(int(4 * np.sqrt(max(expected_size, training_vectors.shape[0]))), training_vectors.shape[0] // 39)
+    nlist = max(1, min(nlist, training_vectors.shape[0]))
+    quantizer = faiss_module.IndexFlatIP(dimension)
+    index = faiss_module.IndexIVFFlat(quantizer, dimension, nlist, faiss_module.METRIC_INNER_PRODUCT)
+    index.train(training_vectors)
+    index.nprobe = min(nprobe, nlist)
+    logging.debug(f"FAISS IndexIVFFlat created for dimension: {dimension} (nlist={nlist}, nprobe={index.nprobe}).")
+    return index
+
+# Function to limit the OpenMP threads FAISS uses in this process
+def set_faiss_threads(num_threads):
+    get_faiss().omp_set_num_threads(num_threads)
+    logging.debug(f"FAISS limited to {num_threads} threads.")
+
 # Function to add embeddings to the FAISS index
 def add_embeddings_to_index(index, embeddings):
-    index.add(embeddings.astype(np.float32))  # Add embeddings to the FAISS index
-    logging.debug(f"Added {embeddings.shape[0]} embeddings to FAISS index. Total embeddings: {index.ntotal}.")
+    # FAISS needs C-contiguous float32; this is a no-op for rows of a float32 matrix
+    index.add(np.ascontiguousarray(embeddings, dtype=np.float32))  # Add embeddings to the FAISS index
+    # Called once per retained sentence, so this is traced rather than logged
+    if tracing.active:
+        tracing.trace_event('faiss', 'add', count=embeddings.shape[0], total=index.ntotal)
+
+# Function to retrieve only the neighbors whose inner product reaches the threshold
+def search_above_threshold(index, query, threshold, mode='range', initial_k=16):
+    """
+    Finds the indexed vectors with inner product >= threshold for a single query.
+
+    Parameters:
+        index: FAISS inner product index.
+        query (numpy array): float32 query of shape (1, dimension).
+        threshold (float): Minimum inner product to return.
+        mode (str): 'range' uses FAISS range search (falling back to 'topk' for indexes
+            that do not support it), 'topk' doubles a bounded top-k search until the
+            k-th result drops below the threshold, 'full' ranks every indexed vector
+            with one search over the whole index, as deduplication originally did.
+        initial_k (int): First k tried by the 'topk' mode.
+
+    Returns:
+        similarities (numpy array): Similarities in descending order. 'range' and 'topk'
+            order equal similarities by id, so they return the same sequence; 'full' keeps
+            the order FAISS ranks them in, which can differ only among exactly equal similarities.
+        indices (numpy array): Ids of the matching vectors, aligned with similarities.
+    """
+    if index.ntotal == 0:
+        return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+    if mode == 'range':
+        # Range search keeps scores strictly above the radius; step down one float32 ulp for >=
+        radius = float(np.nextafter(np.float32(threshold), np.float32(-np.inf)))
+        try:
+            count_search(1)
+            lims, D, I = index.range_search(query, radius)
+        except RuntimeError:
+            mode = 'topk'  # e.g. HNSW indexes do not implement range search
+        else:
+            return sort_by_similarity(D, I)
+
+    if mode == 'topk':
+        k = min(initial_k, index.ntotal)
+        while True:
+            count_search(1)
+            D, I = index.search(query, k)
+            D, I = D[0], I[0]
+            valid = I >= 0
+            D, I = D[valid], I[valid]
+            if k >= index.ntotal or len(D) < k or D[-1] < threshold:
+                keep = D >= threshold
+                return sort_by_similarity(D[keep], I[keep])
+            k = min(k * 2, index.ntotal)
+
+    count_search(1)
+    D, I = index.search(query, index.ntotal)
+    # Already ranked by FAISS; not re-sorted, so ties keep the original order
+    keep = D[0] >= threshold
+    return D[0][keep], I[0][keep]
+
+def sort_by_similarity(similarities, indices):
+    # Highest similarity first; FAISS leaves the order of ties unspecified, so break them by id
+    order = np.lexsort((indices, -similarities))
+    return similarities[order], indices[order]
+
+# Function to run a threshold search for a whole block of queries at once
+def range_search_block(index, queries, threshold):
+    """
+    Finds, for every query in a block, the indexed vectors with inner product >= threshold.
+
+    Queries are sent to FAISS in chunks whose size (queries x dimension) stays below
+    distance_compute_blas_threshold, so FAISS scores each pair with the same kernel it
+    uses for single-query searches. The
+    similarities are therefore bit-identical to search_above_threshold, which a plain
+    BLAS matrix multiply does not guarantee.
+
+    Returns:
+        results (list of tuples): (similarities, indices) per query, ordered like
+            search_above_threshold.
+    """
+    results = []
+    if index.ntotal == 0:
+        empty = (np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64))
+        return [empty] * queries.shape[0]
+    radius = float(np.nextafter(np.float32(threshold), np.float32(-np.inf)))
+    chunk = max(1, (get_faiss().cvar.distance_compute_blas_threshold - 1) // index.d)
+    for start in range(0, queries.shape[0], chunk):
+        block = np.ascontiguousarray(queries[start:start + chunk])
+        try:
+            count_search(block.shape[0])
+            lims, D, I = index.range_search(block, radius)
+        except RuntimeError:
+            # e.g. HNSW indexes do not implement range search
+            results.extend(search_above_threshold(index, block[q:q + 1], threshold, 'topk')
+                           for q in range(block.shape[0]))
+            continue
+        for q in range(len(lims) - 1):
+            results.append(sort_by_similarity(D[lims[q]:lims[q + 1]], I[lims[q]:lims[q + 1]]))
+    return results
+
+# Function to measure how much recall approximate indexes give up for speed
+def recall_latency_report(vectors, queries, threshold, configs):
+    """
+    Compares index configurations against exact search on the same data.
+
+    Parameters:
+        vectors (numpy array): float32 vectors to index.
+        queries (numpy array): float32 queries.
+        threshold (float): Similarity threshold, as used by deduplication.
+        configs (list of tuples): (name, options) pairs passed to create_faiss_index.
+
+    Returns:
+        report (list of dicts): Per configuration: name, build_seconds, query_ms (mean per
+            query) and recall (share of the exact above-threshold neighbors that were found).
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    dimension = vectors.shape[1]
+
+    exact_index = create_faiss_index_inner_product(dimension)
+    add_embeddings_to_index(exact_index, vectors)
+    exact = [set(I.tolist()) for _, I in range_search_block(exact_index, queries, threshold)]
+    total = sum(len(ids) for ids in exact)
+
+    report = []
+    for name, options in [('flat', {'kind': 'flat'})] + list(configs):
+        start = time.perf_counter()
+        index = create_faiss_index(dimension, vectors.shape[0], training_vectors=vectors, **options)
+        add_embeddings_to_index(index, vectors)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [search_above_threshold(index, queries[q:q + 1], threshold)[1] for q in range(queries.shape[0])]
+        query_seconds = time.perf_counter() - start
+
+        hits = sum(len(exact[q].intersection(ids.tolist())) for q, ids in enumerate(found))
+        report.append({
+            'name': name,
+            'build_seconds': build_seconds,
+            'query_ms': 1000 * query_seconds / max(1, queries.shape[0]),
+            'recall': hits / total if total else 1.0
+        })
+    return report
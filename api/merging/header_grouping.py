@@ -0,0 +1,173 @@
+# header_grouping.py
+
+import logging
+import numpy as np
+
+# Bytes of similarity scores computed at once when comparing header names
+DEFAULT_SIMILARITY_MEMORY = 256 * 1024 * 1024
+# Smallest number of rows and columns compared per block
+MIN_BLOCK_SIZE = 64
+
+def header_token_matrix(names):
+    """
+    Builds a sparse binary matrix with a row per header name and a column per lowercased word.
+
+    Returns:
+        tokens (scipy.sparse.csr_matrix): tokens[i, w] is 1 if word w occurs in names[i].
+        sizes (numpy array): Number of distinct words in each name.
+    """
+    from scipy.sparse import csr_matrix  # imported on first use, scipy.sparse is slow to import
+    vocabulary = {}
+    rows, cols = [], []
+    for row, name in enumerate(names):
+        for word in set(name.lower().split()):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(word, len(vocabulary)))
+    tokens = csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(names), max(1, len(vocabulary)))
+    )
+    return tokens, np.diff(tokens.indptr)
+
+def overlap_ratios(tokens, sizes, rows, cols):
+    """
+    Word overlap ratio of each (rows[k], cols[k]) pair of names, as calculate_overlap_ratio_headers
+    computes it: shared words divided by the larger word count, or 0 for two empty names.
+    """
+    shared = np.asarray(tokens[rows].multiply(tokens[cols]).sum(axis=1)).ravel()
+    longest = np.maximum(sizes[rows], sizes[cols])
+    ratios = np.zeros(len(rows), dtype=np.float64)
+    np.divide(shared, longest, out=ratios, where=longest > 0)
+    return ratios
+
+def similar_name_pairs(vectors, threshold, max_memory=DEFAULT_SIMILARITY_MEMORY, keep=None):
+    """
+    Finds the pairs of vectors with inner product >= threshold without building the full
+    similarity matrix. The upper triangle is compared in square blocks sized to max_memory.
+    With keep, each block's pairs are filtered before they are collected, so only the pairs
+    that pass it are held across blocks.
+
+    Scores are accumulated in float64 and rounded to float32. A float32 matrix product
+    rounds differently depending on the shape BLAS is given, so blocks of different sizes
+    could disagree at the threshold; rounding the float64 result makes every score
+    independent of the block size, so all memory limits give the same pairs.
+
+    Parameters:
+        vectors (numpy array): float32 matrix with a row per unique header name.
+        threshold (float): Minimum inner product.
+        max_memory (int): Approximate bytes used for one block of scores.
+        keep (function): Optional keep(rows, cols) -> boolean mask over a block's pairs.
+
+    Returns:
+        rows, cols (numpy arrays): Pairs with rows <= cols.
+        similarities (numpy array): float32 inner product of each pair.
+    """
+    count = vectors.shape[0]
+    # float64 and float32 score, mask and two int64 indices per pair when every pair passes
+    block_size = max(MIN_BLOCK_SIZE, int(np.sqrt(max_memory / 29)))
+    found_rows, found_cols, found_similarities = [], [], []
+    for start in range(0, count, block_size):
+        block = vectors[start:start + block_size].astype(np.float64)
+        for col_start in range(start, count, block_size):
+            columns = vectors[col_start:col_start + block_size].astype(np.float64)
+            scores = (block @ columns.T).astype(np.float32)
+            rows, cols = np.nonzero(scores >= threshold)
+            if col_start == start:
+                upper = cols >= rows
+                rows, cols = rows[upper], cols[upper]
+            rows += start
+            cols += col_start
+            if keep is not None:
+                kept = keep(rows, cols)
+                rows, cols = rows[kept], cols[kept]
+            found_rows.append(rows)
+            found_cols.append(cols)
+            found_similarities.append(scores[rows - start, cols - col_start])
+    if not found_rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    return np.concatenate(found_rows), np.concatenate(found_cols), np.concatenate(found_similarities)
+
+def linked_name_pairs(names, vectors, similarity_threshold, overlap_threshold, max_memory=DEFAULT_SIMILARITY_MEMORY):
+    """
+    Finds the pairs of unique header names whose headers are merged.
+
+    Candidates are taken from the similarity scores first, so word overlap is only
+    computed for pairs that already pass the similarity threshold. Overlap is checked per
+    block of scores and in chunks of pairs, so memory stays near max_memory even when most
+    pairs pass the similarity threshold.
+
+    Parameters:
+        names (list): Unique header names.
+        vectors (numpy array): float32 embedding of each name.
+        similarity_threshold (float): Minimum cosine similarity.
+        overlap_threshold (float): Minimum word overlap ratio.
+        max_memory (int): Memory ceiling for similarity scores, see similar_name_pairs.
+
+    Returns:
+        rows, cols (numpy arrays): Linked pairs with rows <= cols. A pair (i, i) means
+            headers sharing name i are merged with each other.
+        similarities (numpy array): Similarity of each linked pair.
+    """
+    tokens, sizes = header_token_matrix(names)
+    # Selecting both rows of a pair from the sparse token matrix and multiplying them costs
+    # about three int32 index and value pairs per word of the longer name
+    pair_bytes = 24 * max(1, int(sizes.max(initial=0))) + 64
+    chunk = max(MIN_BLOCK_SIZE, max_memory // pair_bytes)
+    candidates = 0
+
+    def overlapping(rows, cols):
+        nonlocal candidates
+        candidates += len(rows)
+        kept = np.empty(len(rows), dtype=bool)
+        for start in range(0, len(rows), chunk):
+            end = start + chunk
+            kept[start:end] = overlap_ratios(tokens, sizes, rows[start:end], cols[start:end]) >= overlap_threshold
+        return kept
+
+    rows, cols, similarities = similar_name_pairs(vectors, similarity_threshold, max_memory, overlapping)
+    logging.debug(f"{candidates} header name pairs pass the similarity threshold, {len(rows)} also pass the overlap threshold")
+    return rows, cols, similarities
+
+def connected_header_groups(name_ids, num_names, rows, cols):
+    """
+    Groups headers into connected components, where two headers are connected if their
+    names are a linked pair.
+
+    The graph has a node per header and per name. A header is joined to its name only if
+    the name is linked to anything, so headers whose name links to nothing (not even
+    itself) stay on their own.
+
+    Parameters:
+        name_ids (list): Unique name index of each header.
+        num_names (int): Number of unique names.
+        rows, cols (numpy arrays): Linked name pairs from linked_name_pairs.
+
+    Returns:
+        groups (list of lists): Header indices per group, in ascending order, with groups
+            ordered by their first header.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    num_headers = len(name_ids)
+    name_ids = np.asarray(name_ids, dtype=np.int64)
+    # Names without headers must not connect anything
+    present = np.bincount(name_ids, minlength=num_names) > 0
+    used = present[rows] & present[cols]
+    rows, cols = rows[used], cols[used]
+    active = np.zeros(num_names, dtype=bool)
+    active[rows] = True
+    active[cols] = True
+    members = np.nonzero(active[name_ids])[0]
+    between = rows != cols
+    edge_from = np.concatenate([members, num_headers + rows[between]])
+    edge_to = np.concatenate([num_headers + name_ids[members], num_headers + cols[between]])
+    graph = coo_matrix(
+        (np.ones(len(edge_from), dtype=np.int8), (edge_from, edge_to)),
+        shape=(num_headers + num_names, num_headers + num_names)
+    )
+    _, labels = connected_components(graph, directed=False)
+
+    groups = {}
+    for idx, label in enumerate(labels[:num_headers].tolist()):
+        groups.setdefault(label, []).append(idx)
+    return list(groups.values())
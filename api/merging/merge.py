@@ -5,17 +5,8 @@ import json
 from embedding import generate_embeddings
 from faiss_util import create_faiss_index_inner_product, add_embeddings_to_index
 import numpy as np
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-
-# Download necessary NLTK data
-nltk.download('stopwords', quiet=True)
-nltk.download('wordnet', quiet=True)
-
-# Initialize lemmatizer and stopwords globally for efficiency
-lemmatizer = WordNetLemmatizer()
-stop_words = set(stopwords.words('english'))
+# NLTK corpora are loaded on first use from local data (see seed_nltk_data.py), not downloaded
+from preprocess import get_lemmatizer, load_stop_words
 
 # Caches to store preprocessed sentences and embeddings
 preprocess_cache = {}
@@ -32,6 +23,8 @@ def preprocess_sentence(sentence):
         return preprocess_cache[sentence]
 
     words = re.findall(r'\b\w+\b', sentence.lower())
+    lemmatizer = get_lemmatizer()
+    stop_words = load_stop_words()
     lemmatized_words = [lemmatizer.lemmatize(word) for word in words if word not in stop_words]
     preprocessed = ' '.join(lemmatized_words)
     # Calculate average word length
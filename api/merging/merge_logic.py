@@ -4,13 +4,20 @@ import logging
 import os
 import re
 import json
+import time
 import numpy as np
-from preprocess import preprocess_sentence, preprocess_header
-from deduplication import deduplicate_sentences
-from embedding import generate_embeddings
-from faiss_util import create_faiss_index_inner_product, add_embeddings_to_index
-
-# Caches to store embeddings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from preprocess import preprocess_sentence, preprocess_header, preprocess_cache
+from deduplication import deduplicate_sentences, deduplicate_sentences_batched
+from embedding import cached_embed_texts, get_embedding_backend, get_embedding_cache
+from faiss_util import create_faiss_index_inner_product, add_embeddings_to_index, set_faiss_threads, thread_search_counts
+from header_grouping import linked_name_pairs, connected_header_groups, DEFAULT_SIMILARITY_MEMORY
+from note_format import NOTE_FILE_EXTENSION, notes_from_json_data, read_note_table
+from pipeline_metrics import metrics_stage
+import tracing
+
+# Process-local cache of embeddings by text, in front of the persistent on-disk cache
 embedding_cache = {}
 
 def calculate_overlap_ratio_headers(header1, header2):
@@ -23,10 +30,176 @@ def calculate_overlap_ratio_headers(header1, header2):
     ratio = len(overlap) / max(len(words1), len(words2)) if max(len(words1), len(words2)) > 0 else 0
     return ratio
 
+def build_embedding_matrix(texts):
+    """
+    Builds one contiguous float32 matrix with a row per text. Rows are filled from the
+    process-local cache, and all missing texts are embedded in a single batch.
+
+    Parameters:
+        texts (list): Unique texts to embed.
+
+    Returns:
+        embeddings (numpy array): float32 matrix of shape (len(texts), dimension).
+    """
+    embeddings = np.empty((len(texts), get_embedding_backend().dimension), dtype=np.float32)
+    missing_rows = []
+    for row, text in enumerate(texts):
+        cached = embedding_cache.get(text)
+        if cached is None:
+            missing_rows.append(row)
+        else:
+            embeddings[row] = cached
+    if missing_rows:
+        embeddings[missing_rows] = cached_embed_texts([texts[row] for row in missing_rows], normalize=True)
+        for row in missing_rows:
+            embedding_cache[texts[row]] = embeddings[row].copy()  # Copy so the cache does not pin this matrix
+        logging.debug(f"Generated and cached embeddings for {len(missing_rows)} texts")
+    return embeddings
+
+def deduplicate_group(task):
+    """
+    Deduplicates the bullets of one header group. Module-level so a process pool can pickle it.
+
+    Parameters:
+        task (tuple): (deduplicate, bullets_info, embeddings, kwargs) where deduplicate is
+            deduplicate_sentences or deduplicate_sentences_batched.
+
+    Returns:
+        merged_bullets (list), bullet_to_sources (dict): As returned by deduplicate.
+        stats (dict): Wall and CPU seconds of this group and the FAISS searches it made,
+            measured in the thread that ran it.
+    """
+    deduplicate, bullets_info, embeddings, kwargs = task
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    calls_start, queries_start = thread_search_counts()
+    merged_bullets, bullet_to_sources = deduplicate(bullets_info, embeddings=embeddings, **kwargs)
+    if tracing.active:
+        tracing.flush_tracing()  # Process pool workers may exit without running exit handlers
+    calls, queries = thread_search_counts()
+    stats = {
+        'wall_seconds': time.perf_counter() - wall_start,
+        'cpu_seconds': time.thread_time() - cpu_start,
+        'faiss_searches': calls - calls_start,
+        'faiss_queries': queries - queries_start
+    }
+    return merged_bullets, bullet_to_sources, stats
+
+def init_group_worker():
+    # Every process deduplicates whole groups, so FAISS should not start threads of its own
+    set_faiss_threads(1)
+
+def local_group_task(task):
+    """
+    Narrows a task to the embedding rows its group refers to, renumbered from 0, so a process
+    pool does not pickle the whole matrix for every group.
+    """
+    deduplicate, bullets_info, embeddings, kwargs = task
+    rows = sorted({info[5] for info in bullets_info})
+    local_rows = {row: local_row for local_row, row in enumerate(rows)}
+    local_info = [info[:5] + (local_rows[info[5]],) for info in bullets_info]
+    return deduplicate, local_info, embeddings[rows], kwargs
+
+def iter_deduplicated_groups(tasks, group_workers=1, group_executor='thread'):
+    """
+    Runs deduplicate_group for every task, serially or in a pool, and yields the results in
+    task order whatever order the groups finish in, so the merge is the same as a serial run.
+    Tasks are read lazily and at most a few per worker are in flight, so finished results
+    do not pile up ahead of a slow consumer.
+
+    Parameters:
+        tasks (iterable): Tasks for deduplicate_group, in group order.
+        group_workers (int): Number of workers; 1 runs serially, None uses all cores.
+        group_executor (str): 'thread' (shares the embedding matrix) or 'process' (each task
+            carries only its group's rows).
+
+    Yields:
+        result (tuple): deduplicate_group result per task.
+    """
+    if group_workers is None:
+        group_workers = os.cpu_count() or 1
+    if group_workers <= 1:
+        for task in tasks:
+            yield deduplicate_group(task)
+        return
+
+    if group_executor == 'thread':
+        executor = ThreadPoolExecutor(max_workers=group_workers)
+    elif group_executor == 'process':
+        executor = ProcessPoolExecutor(max_workers=group_workers, initializer=init_group_worker)
+        tasks = map(local_group_task, tasks)
+    else:
+        raise ValueError(f"Unknown group_executor '{group_executor}'. Use 'thread' or 'process'.")
+    with executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(deduplicate_group, task))
+            if len(pending) >= group_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def deduplicate_groups(tasks, group_workers=1, group_executor='thread'):
+    """
+    Runs deduplicate_group for every task and returns the results as a list in task order
+    (see iter_deduplicated_groups).
+    """
+    return list(iter_deduplicated_groups(tasks, group_workers, group_executor))
+
+def load_notes_from_file(file_path):
+    """
+    Loads the notes in one JSON or .notes file. Each PDF in the file becomes a note, numbered by the file name.
+
+    A .notes file is memory-mapped instead of parsed (see note_format). Preprocessed text and
+    embeddings stored in it are added to the preprocessing and embedding caches, embeddings
+    only if they come from the active embedding backend.
+
+    Parameters:
+        file_path (str): Path to a JSON or .notes note file.
+
+    Returns:
+        notes (list): List of notes with headers and bullets.
+    """
+    logging.debug(f"Loading file: {os.path.basename(file_path)}")
+    note_num = os.path.basename(file_path)  # Or generate a note number
+    if file_path.endswith(NOTE_FILE_EXTENSION):
+        table = read_note_table(file_path)
+        preprocessed = table.preprocessed()
+        if preprocessed is not None:
+            for bullet, result in preprocessed.items():
+                preprocess_cache.put(bullet, result)
+        stored = table.embeddings()
+        if stored is not None and table.model_id == get_embedding_backend().model_id:
+            texts, vectors = stored
+            for text, vector in zip(texts, vectors):
+                embedding_cache.setdefault(text, np.array(vector))
+        return table.to_notes(note_num)
+    with open(file_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    # Now data is the dictionary with the structure shown in the sample
+    return notes_from_json_data(data, note_num)
+
+def is_note_file(file_path):
+    """
+    Whether a path is a note file that load_notes_from_file can read.
+    """
+    return file_path.endswith(('.json', NOTE_FILE_EXTENSION)) and os.path.isfile(file_path)
+
+def list_note_files(directory):
+    """
+    Names of the note files in a directory, sorted. A JSON file is skipped when a .notes file
+    with the same name exists, since that is its converted copy and would duplicate its notes.
+    """
+    file_names = sorted(file_name for file_name in os.listdir(directory)
+                        if is_note_file(os.path.join(directory, file_name)))
+    converted = {file_name[:-len(NOTE_FILE_EXTENSION)] for file_name in file_names
+                 if file_name.endswith(NOTE_FILE_EXTENSION)}
+    return [file_name for file_name in file_names
+            if not (file_name.endswith('.json') and file_name[:-len('.json')] in converted)]
+
 def load_notes_from_files(directory="test_files"):
     """
-    Loads notes from JSON files in the specified directory.
-    Parses the notes into headers and bullets.
+    Loads notes from the JSON and .notes files in the specified directory, preferring the
+    .notes file when both exist for the same name. Parses the notes into headers and bullets.
 
     Parameters:
         directory (str): Path to the directory containing JSON note files.
@@ -35,42 +208,22 @@ def load_notes_from_files(directory="test_files"):
         notes (list): List of notes with headers and bullets.
     """
     notes = []
-    for file_name in os.listdir(directory):
-        if file_name.endswith('.json') and os.path.isfile(os.path.join(directory, file_name)):
-            logging.debug(f"Loading file: {file_name}")
-            with open(os.path.join(directory, file_name), 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                note_num = file_name  # Or generate a note number
-                # Now data is the dictionary with the structure shown in the sample
-                for pdf_key, pdf_data in data.items():
-                    pdf_id = pdf_data.get('pdf_id', pdf_key)
-                    headers = []
-                    for header in pdf_data.get('headers', []):
-                        header_name = header.get('text', 'Default Header')
-                        bullets = header.get('section_text', [])
-                        if isinstance(bullets, list):
-                            bullets_list = bullets
-                        elif isinstance(bullets, str):
-                            bullets_list = [bullets]
-                        else:
-                            bullets_list = []
-                        bullets_list = [bullet.strip() for bullet in bullets_list if bullet.strip()]
-                        headers.append({
-                            'header_name': header_name,
-                            'bullets': bullets_list
-                        })
-                    notes.append({
-                        'note_num': note_num,
-                        'headers': headers
-                    })
+    for file_name in list_note_files(directory):
+        notes.extend(load_notes_from_file(os.path.join(directory, file_name)))
     # Sort notes based on note_num to maintain order
     notes.sort(key=lambda x: x['note_num'])
     return notes
 
-def merge_multiple_notes(notes, similarity_threshold=0.7, overlap_threshold=0.4,
-                         header_similarity_threshold=0.75, header_overlap_threshold=0.3):
+def iter_merged_headers(notes, similarity_threshold=0.7, overlap_threshold=0.4,
+                         header_similarity_threshold=0.75, header_overlap_threshold=0.3,
+                         dedup_engine='sequential', index_kind='flat', index_options=None,
+                         similarity_memory=DEFAULT_SIMILARITY_MEMORY, group_workers=1, group_executor='thread',
+                         metrics=None):
     """
-    Merges multiple notes by deduplicating their bullets under similar headers.
+    Merges multiple notes like merge_multiple_notes, yielding each merged header as soon as
+    its bullets are deduplicated. Headers come in the same order merge_multiple_notes returns
+    them. Header grouping still needs every note up front, but deduplicated bullets are not
+    accumulated, so the output held at once is one group (a few with group_workers > 1).
 
     Parameters:
         notes (list): List of notes with headers and bullets.
@@ -78,15 +231,26 @@ def merge_multiple_notes(notes, similarity_threshold=0.7, overlap_threshold=0.4,
         overlap_threshold (float): Overlap ratio threshold to consider duplicate bullets.
         header_similarity_threshold (float): Cosine similarity threshold to consider duplicate headers.
         header_overlap_threshold (float): Overlap ratio threshold to consider duplicate headers.
-
-    Returns:
-        merged_text (str): The merged text of all notes.
-        merged_headers (list): Detailed information about merged headers and bullets.
-        sentence_to_sources (dict): Mapping of retained sentences to their sources and conflicts.
+        dedup_engine (str): 'sequential' scores bullets one at a time; 'batched' scores them in
+            blocks (see deduplicate_sentences_batched). Both give the same result.
+        index_kind (str): FAISS index used for bullet deduplication: 'flat' (exact), 'hnsw', 'ivf',
+            or 'auto' to pick by group size. Approximate indexes trade a little recall for speed.
+        index_options (dict): Index tunables such as nprobe or ef_search (see faiss_util.create_faiss_index).
+        similarity_memory (int): Approximate bytes of header similarity scores held at once; header
+            names are compared in row blocks of this size instead of one dense matrix.
+        group_workers (int): Workers that deduplicate header groups in parallel; 1 (the default)
+            runs serially and None uses all cores. The result is the same as a serial run.
+        group_executor (str): 'thread' or 'process' pool for group_workers > 1.
+        metrics (PipelineMetrics): If given, receives stage timings, item counts, cache hits,
+            FAISS search counts and a record per header group (see pipeline_metrics.py).
+
+    Yields:
+        merged_header (dict): header_name, header_id, note_id, bullets, bullet_to_sources and
+            conflicts of one header group.
     """
     if not notes:
         logging.info("No notes to merge.")
-        return "", [], {}
+        return
 
     # First, collect all headers across all notes
     all_headers = []
@@ -104,181 +268,252 @@ def merge_multiple_notes(notes, similarity_threshold=0.7, overlap_threshold=0.4,
             })
             header_id += 1
 
-    # Preprocess header names and generate embeddings for all headers
-    header_embeddings_list = []
-    logging.info("Generating embeddings for headers...")
-    for header in all_headers:
-        header_name = header['header_name'].strip()
-        pre_header = preprocess_header(header_name)
-        header['preprocessed_name'] = pre_header  # May not be necessary if not used later
-        embedding_key = f"{header['note_num']}_{header_name}"
-        if embedding_key in embedding_cache:
-            embedding = embedding_cache[embedding_key]
-            logging.debug(f"Retrieved embedding from cache for header: '{header_name}' with key '{embedding_key}'")
-        else:
-            embedding = generate_embeddings([header_name], normalize=True)[0]  # Use header_name, not pre_header
-            embedding_cache[embedding_key] = embedding
-            logging.debug(f"Generated and cached embedding for header: '{header_name}' with key '{embedding_key}'")
-        header['embedding'] = embedding
-        header_embeddings_list.append(embedding)
-
-    if header_embeddings_list:
-        header_embeddings = np.vstack(header_embeddings_list)
-    else:
-        header_embeddings = np.array([])
-
-    if header_embeddings.size == 0:
+    # Preprocess header names and bullets once for the whole merge
+    preprocess_hits, preprocess_misses = preprocess_cache.hits, preprocess_cache.misses
+    with metrics_stage(metrics, 'preprocess'):
+        for header in all_headers:
+            header_name = header['header_name'].strip()
+            pre_header = preprocess_header(header_name)
+            header['preprocessed_name'] = pre_header  # May not be necessary if not used later
+            header['bullets_info'] = []
+            for bullet_idx, bullet in enumerate(header['bullets']):
+                pre_bullet, avg_word_length = preprocess_sentence(bullet)
+                header['bullets_info'].append((bullet_idx + 1, bullet, pre_bullet, avg_word_length))
+    if metrics is not None:
+        metrics.count('notes', len(notes))
+        metrics.count('headers', len(all_headers))
+        metrics.count('bullets', sum(len(header['bullets']) for header in all_headers))
+        metrics.count('preprocess_cache_hits', preprocess_cache.hits - preprocess_hits)
+        metrics.count('preprocess_cache_misses', preprocess_cache.misses - preprocess_misses)
+
+    # Give every unique header name and preprocessed bullet a row in one float32 matrix.
+    # Headers are keyed by their text alone (header_name, not pre_header) so the same header
+    # is embedded once across all notes.
+    header_texts = list(dict.fromkeys(header['header_name'].strip() for header in all_headers))
+    bullet_texts = [info[2] for header in all_headers for info in header['bullets_info']]
+    texts = list(dict.fromkeys(header_texts + bullet_texts))
+    text_rows = {text: row for row, text in enumerate(texts)}
+    logging.info("Generating embeddings for headers and bullets...")
+    if metrics is not None:
+        local_hits = sum(text in embedding_cache for text in texts)
+        metrics.count('embedding_cache_hits', local_hits)
+        metrics.count('embedding_cache_misses', len(texts) - local_hits)
+        persistent_cache = get_embedding_cache()
+        if persistent_cache is not None:
+            persistent_hits, persistent_misses = persistent_cache.hits, persistent_cache.misses
+    with metrics_stage(metrics, 'embedding'):
+        embeddings = build_embedding_matrix(texts)
+    if metrics is not None and persistent_cache is not None:
+        metrics.count('persistent_embedding_cache_hits', persistent_cache.hits - persistent_hits)
+        metrics.count('persistent_embedding_cache_misses', persistent_cache.misses - persistent_misses)
+
+    if not all_headers:
         logging.info("No headers to process after parsing.")
-        return "", [], {}
+        return
 
-    # Compute similarity matrix
-    similarity_matrix = np.dot(header_embeddings, header_embeddings.T)
+    # Unique header names occupy the first rows of the matrix, so this slice is a view, not a copy.
+    # Similarity is computed between unique names; headers refer to it by row.
+    header_matrix = embeddings[:len(header_texts)]
+    header_rows = [text_rows[header['header_name'].strip()] for header in all_headers]
+    for header, row in zip(all_headers, header_rows):
+        header['embedding_row'] = row
 
-    # Initialize Union-Find data structure
-    parent = [i for i in range(len(all_headers))]  # Initially, each header is its own parent
+    # Link header names that pass both thresholds, then group headers by connected components
+    logging.info("Comparing headers for similarity and overlap...")
+    with metrics_stage(metrics, 'header_grouping'):
+        rows, cols, similarities = linked_name_pairs(
+            header_texts, header_matrix, header_similarity_threshold, header_overlap_threshold, similarity_memory
+        )
+        header_groups = connected_header_groups(header_rows, len(header_texts), rows, cols)
+    if metrics is not None:
+        metrics.count('header_groups', len(header_groups))
+    # Only linked pairs can produce header conflicts, so their similarities are all that is kept
+    linked_similarity = {(row, col): sim for row, col, sim in zip(rows.tolist(), cols.tolist(), similarities.tolist())}
+
+    if dedup_engine == 'sequential':
+        deduplicate = deduplicate_sentences
+    elif dedup_engine == 'batched':
+        deduplicate = deduplicate_sentences_batched
+    else:
+        raise ValueError(f"Unknown dedup_engine '{dedup_engine}'. Use 'sequential' or 'batched'.")
 
-    def find(u):
-        while parent[u] != u:
-            parent[u] = parent[parent[u]]  # Path compression
-            u = parent[u]
-        return u
+    # Now, for each header group, process bullets
+    dedup_kwargs = {
+        'similarity_threshold': similarity_threshold,
+        'overlap_threshold': overlap_threshold,
+        'index_kind': index_kind,
+        'index_options': index_options
+    }
+    merged_headers = deque()
+
+    trace = tracing.tracer_for('deduplication')
+
+    def dedup_tasks():
+        for group_idx, group in enumerate(header_groups, 1):
+            # Collect headers in the group
+            group_headers = [all_headers[idx] for idx in group]
+            # Sort headers in the group by note_num to have a consistent accepted header
+            group_headers.sort(key=lambda h: h['note_num'])
+            accepted_header = group_headers[0]['header_name']
+            accepted_header_id = group_headers[0]['header_id']
+            accepted_note_num = group_headers[0]['note_num']
+
+            # Collect conflicts for headers in this group
+            conflicts = []
+            for header in group_headers[1:]:
+                conflict_header = header['header_name']
+                pair = tuple(sorted((header['embedding_row'], group_headers[0]['embedding_row'])))
+                sim = linked_similarity.get(pair)
+                # Compute overlap ratio
+                overlap_ratio = calculate_overlap_ratio_headers(group_headers[0]['header_name'], header['header_name'])
+                if sim is not None and sim >= header_similarity_threshold and overlap_ratio >= header_overlap_threshold:
+                    conflicts.append({
+                        "note_id": header['note_num'],
+                        "header_id": header['header_id'],
+                        "header_name": conflict_header,
+                        "similarity": sim,
+                        "overlap_ratio": overlap_ratio
+                    })
 
-    def union(u, v):
-        pu = find(u)
-        pv = find(v)
-        if pu != pv:
-            parent[pu] = pv
+            # Collect bullets from all headers in the group; embeddings are referenced by row id
+            bullets_info = []
+            for header in group_headers:
+                note_num = header['note_num']
+                for bullet_idx, bullet, pre_bullet, avg_word_length in header['bullets_info']:
+                    bullets_info.append((note_num, bullet_idx, bullet, pre_bullet, avg_word_length, text_rows[pre_bullet]))
+            if trace:
+                trace('group', header=accepted_header, bullets=len(bullets_info), group=group_idx, groups=len(header_groups))
+
+            # Collect the header and its conflicts; bullets are filled in after deduplication
+            merged_headers.append({
+                'header_name': accepted_header,
+                'header_id': accepted_header_id,
+                'note_id': accepted_note_num,
+                'bullets': None,
+                'bullet_to_sources': None,
+                'conflicts': conflicts,
+                'bullets_in': len(bullets_info)
+            })
+            yield deduplicate, bullets_info, embeddings, dedup_kwargs
+
+    # Deduplicate bullets, possibly in parallel; results arrive in group order. Tasks are built
+    # lazily, so merged_headers only holds the groups that are queued or running.
+    # The deduplication stage is timed per group so the time spent by the consumer is not included.
+    groups = iter_deduplicated_groups(dedup_tasks(), group_workers, group_executor)
+    while True:
+        with metrics_stage(metrics, 'deduplication', per_group=True):
+            result = next(groups, None)
+        if result is None:
+            break
+        merged_bullets, bullet_to_sources, stats = result
+        merged_header = merged_headers.popleft()
+        merged_header['bullets'] = merged_bullets
+        merged_header['bullet_to_sources'] = bullet_to_sources
+        if metrics is not None:
+            metrics.count('merged_bullets', len(merged_bullets))
+            metrics.count('faiss_searches', stats['faiss_searches'])
+            metrics.count('faiss_queries', stats['faiss_queries'])
+            metrics.add_item('header_groups', {
+                'header_id': merged_header['header_id'],
+                'header_name': merged_header['header_name'],
+                'bullets_in': merged_header['bullets_in'],
+                'bullets_out': len(merged_bullets),
+                **stats
+            })
+        del merged_header['bullets_in']
+        yield merged_header
 
-    # For each pair of headers, check similarity and overlap, and union if both thresholds are met
-    logging.info("Comparing headers for similarity and overlap...")
-    for i in range(len(all_headers)):
-        for j in range(i + 1, len(all_headers)):
-            sim = similarity_matrix[i, j]
-            # Compute overlap ratio between headers
-            overlap_ratio = calculate_overlap_ratio_headers(all_headers[i]['header_name'], all_headers[j]['header_name'])
-            # Output the similarity and overlap scores to debug log
-            logging.debug(f"Headers '{all_headers[i]['header_name']}' and '{all_headers[j]['header_name']}' have similarity {sim:.4f} and overlap ratio {overlap_ratio:.4f}")
-            if sim >= header_similarity_threshold and overlap_ratio >= header_overlap_threshold:
-                union(i, j)
-
-    # Now, group headers by their parent
-    groups = {}
-    for idx in range(len(all_headers)):
-        p = find(idx)
-        if p not in groups:
-            groups[p] = []
-        groups[p].append(idx)
-
-    header_groups = list(groups.values())
+def merged_header_text(merged_header):
+    """
+    Returns the lines of the merged text for one header: the header name, then its bullets.
+    """
+    lines = [f"{merged_header['header_name']}:"]
+    for bullet in merged_header['bullets']:
+        lines.append(f"- {bullet[2]}")  # bullet[2] is the bullet text
+    return lines
 
-    # Now, for each header group, process bullets
-    merged_headers = []
-    sentence_to_sources = {}
+def merge_multiple_notes(notes, similarity_threshold=0.7, overlap_threshold=0.4,
+                         header_similarity_threshold=0.75, header_overlap_threshold=0.3,
+                         dedup_engine='sequential', index_kind='flat', index_options=None,
+                         similarity_memory=DEFAULT_SIMILARITY_MEMORY, group_workers=1, group_executor='thread',
+                         metrics=None):
+    """
+    Merges multiple notes by deduplicating their bullets under similar headers.
 
-    for group_idx, group in enumerate(header_groups, 1):
-        # Collect headers in the group
-        group_headers = [all_headers[idx] for idx in group]
-        # Sort headers in the group by note_num to have a consistent accepted header
-        group_headers.sort(key=lambda h: h['note_num'])
-        accepted_header = group_headers[0]['header_name']
-        accepted_header_id = group_headers[0]['header_id']
-        accepted_note_num = group_headers[0]['note_num']
-
-        # Collect bullets from all headers in the group
-        group_bullets_info = []  # Will be similar to sentences_info before
-
-        # Collect conflicts for headers in this group
-        conflicts = []
-        for header in group_headers[1:]:
-            conflict_header = header['header_name']
-            sim = float(np.dot(header['embedding'], group_headers[0]['embedding']))
-            # Compute overlap ratio
-            overlap_ratio = calculate_overlap_ratio_headers(group_headers[0]['header_name'], header['header_name'])
-            if sim >= header_similarity_threshold and overlap_ratio >= header_overlap_threshold:
-                conflicts.append({
-                    "note_id": header['note_num'],
-                    "header_id": header['header_id'],
-                    "header_name": conflict_header,
-                    "similarity": sim,
-                    "overlap_ratio": overlap_ratio
-                })
-
-        for header in group_headers:
-            note_num = header['note_num']
-            header_name = header['header_name']
-            bullets = header['bullets']
-            for bullet_idx, bullet in enumerate(bullets):
-                pre_bullet, avg_word_length = preprocess_sentence(bullet)
-                group_bullets_info.append((
-                    note_num,
-                    bullet_idx + 1,
-                    bullet,
-                    pre_bullet,
-                    avg_word_length
-                ))
-
-        # Deduplicate bullets in this group
-        # Preprocess bullets and generate embeddings
-        preprocessed_bullets = [info[3] for info in group_bullets_info]
-
-        # Identify unique preprocessed bullets
-        unique_pre_bullets = list(set(preprocessed_bullets))
-        logging.debug(f"Found {len(unique_pre_bullets)} unique preprocessed bullets in header group '{accepted_header}'.")
-        
-        # Generate embeddings for bullets
-        logging.info(f"Generating embeddings for bullets in header '{accepted_header}' (Group {group_idx}/{len(header_groups)})...")
-        bullet_embeddings_list = []
-        for pre_bullet in unique_pre_bullets:
-            if pre_bullet in embedding_cache:
-                embedding = embedding_cache[pre_bullet]
-                logging.debug(f"Retrieved embedding from cache for bullet: '{pre_bullet}'")
-            else:
-                embedding = generate_embeddings([pre_bullet], normalize=True)[0]
-                embedding_cache[pre_bullet] = embedding
-                logging.debug(f"Generated and cached embedding for bullet: '{pre_bullet}'")
-            bullet_embeddings_list.append(embedding)
-        if bullet_embeddings_list:
-            bullet_embeddings = np.vstack(bullet_embeddings_list)
-        else:
-            bullet_embeddings = np.array([])
-
-        pre_bullet_to_emb = {pre: emb for pre, emb in zip(unique_pre_bullets, bullet_embeddings)}
-
-        # Assign embeddings to bullets
-        bullets_info = []
-        for info in group_bullets_info:
-            note_num, bullet_idx, bullet, pre_bullet, avg_word_length = info
-            embedding = pre_bullet_to_emb[pre_bullet]
-            bullets_info.append((note_num, bullet_idx, bullet, pre_bullet, avg_word_length, embedding))
-
-        # Deduplicate bullets
-        merged_bullets, bullet_to_sources = deduplicate_sentences(
-            bullets_info,
-            similarity_threshold,
-            overlap_threshold
-        )
+    Parameters:
+        notes (list): List of notes with headers and bullets.
+        similarity_threshold (float): Cosine similarity threshold to consider duplicate bullets.
+        overlap_threshold (float): Overlap ratio threshold to consider duplicate bullets.
+        header_similarity_threshold (float): Cosine similarity threshold to consider duplicate headers.
+        header_overlap_threshold (float): Overlap ratio threshold to consider duplicate headers.
+        dedup_engine (str): 'sequential' scores bullets one at a time; 'batched' scores them in
+            blocks (see deduplicate_sentences_batched). Both give the same result.
+        index_kind (str): FAISS index used for bullet deduplication: 'flat' (exact), 'hnsw', 'ivf',
+            or 'auto' to pick by group size. Approximate indexes trade a little recall for speed.
+        index_options (dict): Index tunables such as nprobe or ef_search (see faiss_util.create_faiss_index).
+        similarity_memory (int): Approximate bytes of header similarity scores held at once; header
+            names are compared in row blocks of this size instead of one dense matrix.
+        group_workers (int): Workers that deduplicate header groups in parallel; 1 (the default)
+            runs serially and None uses all cores. The result is the same as a serial run.
+        group_executor (str): 'thread' or 'process' pool for group_workers > 1.
+        metrics (PipelineMetrics): If given, receives stage timings, item counts, cache hits,
+            FAISS search counts and a record per header group (see pipeline_metrics.py).
 
-        # Collect merged bullets and their conflicts
-        merged_header = {
-            'header_name': accepted_header,
-            'header_id': accepted_header_id,
-            'note_id': accepted_note_num,
-            'bullets': merged_bullets,
-            'bullet_to_sources': bullet_to_sources,
-            'conflicts': conflicts
-        }
-        merged_headers.append(merged_header)
-        # Update sentence_to_sources
-        sentence_to_sources.update(bullet_to_sources)
+    Returns:
+        merged_text (str): The merged text of all notes.
+        merged_headers (list): Detailed information about merged headers and bullets.
+        sentence_to_sources (dict): Mapping of retained sentences to their sources and conflicts.
+    """
+    merged_headers = list(iter_merged_headers(
+        notes, similarity_threshold, overlap_threshold, header_similarity_threshold, header_overlap_threshold,
+        dedup_engine, index_kind, index_options, similarity_memory, group_workers, group_executor, metrics
+    ))
 
-    # Construct the merged text
+    sentence_to_sources = {}
     merged_text_lines = []
     for merged_header in merged_headers:
-        merged_text_lines.append(f"{merged_header['header_name']}:")
-        for bullet in merged_header['bullets']:
-            bullet_text = bullet[2]  # bullet[2] is the bullet text
-            merged_text_lines.append(f"- {bullet_text}")
+        # Update sentence_to_sources
+        sentence_to_sources.update(merged_header['bullet_to_sources'])
+        merged_text_lines.extend(merged_header_text(merged_header))
 
     merged_text = '\n'.join(merged_text_lines)
 
     return merged_text, merged_headers, sentence_to_sources
+
+def format_merged_header(merged_header):
+    """
+    Structures one merged header as an entry of merged_results.json, with conflicts listed
+    for manual resolution.
+    """
+    bullets_output = []
+    for bullet_info in merged_header['bullets']:
+        bullet_note_id, bullet_id, bullet_text, _ = bullet_info
+        data = merged_header['bullet_to_sources'][bullet_text]
+        bullets_output.append({
+            "bullet_id": f"{bullet_note_id}_{bullet_id}",
+            "accepted_bullet_text": data["text"],
+            "conflicting_bullets": data["conflicts"]
+        })
+    return {
+        "header_id": merged_header['header_id'],
+        "accepted_header_name": merged_header['header_name'],
+        "note_id": merged_header['note_id'],
+        "conflicting_headers": merged_header['conflicts'],
+        "bullets": bullets_output
+    }
+
+def format_merged_results(merged_headers, metrics=None):
+    """
+    Structures merged headers as the JSON written to merged_results.json.
+
+    Parameters:
+        merged_headers (list): Merged headers as returned by merge_multiple_notes.
+        metrics (PipelineMetrics): If given, added to the output under "metrics".
+
+    Returns:
+        merged_results (dict): {"headers": [...]} with accepted and conflicting headers and bullets.
+    """
+    merged_results = {"headers": [format_merged_header(merged_header) for merged_header in merged_headers]}
+    if metrics is not None:
+        merged_results["metrics"] = metrics.to_dict()
+    return merged_results
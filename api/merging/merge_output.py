@@ -0,0 +1,101 @@
+# merge_output.py
+#
+# Streaming writers for merge results. Each writer takes merged headers one at a time (as
+# iter_merged_headers yields them) and writes them out immediately, so the files are produced
+# without holding the whole merge in memory.
+
+import json
+from merge_logic import format_merged_header, merged_header_text
+from pipeline_metrics import metrics_stage
+
+
+class MergedResultsJSONWriter:
+    """
+    Writes merged_results.json, byte for byte what json.dump({"headers": [...]}, indent=indent)
+    writes, one header at a time. If metrics (a PipelineMetrics) is given, it is written after
+    the headers on close, once the merge has filled it in, as format_merged_results would.
+    """
+    def __init__(self, f, indent=4, metrics=None):
+        self.f = f
+        self.indent = indent
+        self.metrics = metrics
+        self.count = 0
+        self.f.write('{\n' + ' ' * indent + '"headers": [')
+
+    def write_header(self, merged_header):
+        # json.dumps escapes newlines inside strings, so every line break is structural
+        # and the entry can be indented line by line
+        prefix = ' ' * (2 * self.indent)
+        entry = json.dumps(format_merged_header(merged_header), indent=self.indent)
+        self.f.write((',\n' if self.count else '\n') + prefix + entry.replace('\n', '\n' + prefix))
+        self.count += 1
+
+    def close(self):
+        if self.count:
+            self.f.write('\n' + ' ' * self.indent)
+        self.f.write(']')
+        if self.metrics is not None:
+            prefix = ' ' * self.indent
+            entry = json.dumps(self.metrics.to_dict(), indent=self.indent)
+            self.f.write(',\n' + prefix + '"metrics": ' + entry.replace('\n', '\n' + prefix))
+        self.f.write('\n}')
+
+
+class MergedResultsNDJSONWriter:
+    """
+    Writes one merged_results.json header entry per line, so readers can parse each header
+    as soon as it is written.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write_header(self, merged_header):
+        self.f.write(json.dumps(format_merged_header(merged_header)) + '\n')
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+class MergedTextWriter:
+    """
+    Writes defaultmerge.txt, the same text merge_multiple_notes returns as merged_text.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write_header(self, merged_header):
+        self.f.write(('\n' if self.count else '') + '\n'.join(merged_header_text(merged_header)))
+        self.count += 1
+
+    def close(self):
+        pass
+
+
+def write_merge_stream(merged_headers, writers, flush=False, metrics=None):
+    """
+    Passes every merged header to every writer, then closes the writers.
+
+    Parameters:
+        merged_headers (iterable): Merged headers, e.g. from iter_merged_headers.
+        writers (list): Writers with write_header(merged_header) and close().
+        flush (bool): Flush each writer's file after every header, for readers tailing it.
+        metrics (PipelineMetrics): If given, the writes are timed as the 'write' stage. Producing
+            the headers is not included, so streamed merges report their own stages separately.
+
+    Returns:
+        count (int): Number of headers written.
+    """
+    count = 0
+    for merged_header in merged_headers:
+        with metrics_stage(metrics, 'write', per_group=True):
+            for writer in writers:
+                writer.write_header(merged_header)
+                if flush:
+                    writer.f.flush()
+        count += 1
+    for writer in writers:
+        writer.close()
+    return count
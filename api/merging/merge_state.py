@@ -0,0 +1,541 @@
+# merge_state.py
+
+import os
+import json
+import logging
+import numpy as np
+from preprocess import preprocess_sentence
+from deduplication import SentenceDeduplicator
+from faiss_util import create_faiss_index_inner_product, get_faiss
+from merge_logic import build_embedding_matrix, calculate_overlap_ratio_headers, load_notes_from_file, list_note_files
+
+MERGE_STATE_VERSION = 2
+
+
+class MergeState:
+    """
+    A merge result that notes can be added to and removed from without re-merging the corpus.
+
+    Headers are kept in groups (the connected components of merge_multiple_notes), and every
+    group keeps its own deduplicator: retained bullets, their conflicts and a FAISS index.
+    Adding a note only compares its headers with the existing header names and deduplicates
+    its bullets into the groups they join. A group is re-deduplicated from scratch only when
+    the result would otherwise depend on order: when groups are joined, when a note sorts
+    before notes already in the group, or when a note is removed from it.
+
+    result() matches merge_multiple_notes on the notes sorted by note_num (notes sharing a
+    note_num in the order they were added), except that header ids stay the ones assigned
+    when each note was added.
+    """
+    def __init__(self, similarity_threshold=0.7, overlap_threshold=0.4,
+                 header_similarity_threshold=0.75, header_overlap_threshold=0.3):
+        self.config = {
+            'similarity_threshold': similarity_threshold,
+            'overlap_threshold': overlap_threshold,
+            'header_similarity_threshold': header_similarity_threshold,
+            'header_overlap_threshold': header_overlap_threshold
+        }
+        self.notes = {}  # note_num -> {'header_ids': [...], 'signature': ...}
+        self.headers = {}  # header_id -> header record
+        self.groups = {}  # group_id -> {'header_ids': [...], 'conflicts': [...], 'deduplicator': ...}
+        self.name_headers = {}  # header name -> set of header ids
+        self.name_rows = {}  # header name -> row in name_vectors
+        self.name_vectors = None
+        self.next_header_id = 0
+        self.next_note_seq = 0
+        self.next_group_id = 0
+        self.dirty_groups = set()  # Groups to write on the next save
+        self.deleted_groups = set()  # Groups to delete on the next save
+
+    # Header names
+
+    def _name_vectors_for(self, names):
+        """
+        Makes sure every name has a row in name_vectors and returns the rows.
+        """
+        missing = [name for name in dict.fromkeys(names) if name not in self.name_rows]
+        if missing:
+            vectors = build_embedding_matrix(missing)
+            used = len(self.name_rows)
+            capacity = 0 if self.name_vectors is None else self.name_vectors.shape[0]
+            if used + len(missing) > capacity:
+                # Kept as float64 so similarities round to float32 like header_grouping.similar_name_pairs
+                grown = np.empty((max(2 * capacity, used + len(missing), 64), vectors.shape[1]), dtype=np.float64)
+                if used:
+                    grown[:used] = self.name_vectors[:used]
+                self.name_vectors = grown
+            self.name_vectors[used:used + len(missing)] = vectors
+            for offset, name in enumerate(missing):
+                self.name_rows[name] = used + offset
+        return [self.name_rows[name] for name in names]
+
+    def _name_similarity(self, name1, name2):
+        return float(np.float32(self.name_vectors[self.name_rows[name1]] @ self.name_vectors[self.name_rows[name2]]))
+
+    def _names_linked(self, name1, name2, similarity=None):
+        """
+        Whether headers with these names are merged, using the thresholds of merge_multiple_notes.
+        """
+        if similarity is None:
+            similarity = self._name_similarity(name1, name2)
+        return (similarity >= self.config['header_similarity_threshold'] and
+                calculate_overlap_ratio_headers(name1, name2) >= self.config['header_overlap_threshold'])
+
+    def _linked_names(self, name):
+        """
+        Returns the known names that headers called name are merged with, possibly including itself.
+        """
+        rows = np.array(self._name_vectors_for([name]))
+        names = list(self.name_rows)
+        similarities = (self.name_vectors[:len(names)] @ self.name_vectors[rows[0]]).astype(np.float32)
+        candidates = np.nonzero(similarities >= self.config['header_similarity_threshold'])[0]
+        return [names[row] for row in candidates if self._names_linked(name, names[row], similarities[row])]
+
+    # Groups
+
+    def _sentences_info(self, header_ids):
+        """
+        Builds deduplication input for the bullets of headers, embedding all of them in one batch.
+        """
+        headers = [self.headers[header_id] for header_id in header_ids]
+        texts = list(dict.fromkeys(info[2] for header in headers for info in header['bullets_info']))
+        if not texts:
+            return [], None
+        embeddings = build_embedding_matrix(texts)
+        rows = {text: row for row, text in enumerate(texts)}
+        sentences_info = [
+            (header['note_num'], bullet_idx, bullet, pre_bullet, avg_word_length, rows[pre_bullet])
+            for header in headers
+            for bullet_idx, bullet, pre_bullet, avg_word_length in header['bullets_info']
+        ]
+        return sentences_info, embeddings
+
+    def _header_conflicts(self, accepted, header_ids):
+        """
+        Conflict records of headers against the accepted header of their group.
+        """
+        conflicts = []
+        for header_id in header_ids:
+            header = self.headers[header_id]
+            sim = self._name_similarity(header['embedding_text'], accepted['embedding_text'])
+            overlap_ratio = calculate_overlap_ratio_headers(accepted['header_name'], header['header_name'])
+            if sim >= self.config['header_similarity_threshold'] and overlap_ratio >= self.config['header_overlap_threshold']:
+                conflicts.append({
+                    "note_id": header['note_num'],
+                    "header_id": header_id,
+                    "header_name": header['header_name'],
+                    "similarity": sim,
+                    "overlap_ratio": overlap_ratio
+                })
+        return conflicts
+
+    def _build_group(self, header_ids):
+        """
+        Creates a group from headers and deduplicates all of its bullets.
+        """
+        header_ids = sorted(header_ids, key=lambda header_id: self.headers[header_id]['sort_key'])
+        group_id = self.next_group_id
+        self.next_group_id += 1
+        deduplicator = SentenceDeduplicator(
+            create_faiss_index_inner_product(self.name_vectors.shape[1]),
+            self.config['similarity_threshold'],
+            self.config['overlap_threshold']
+        )
+        sentences_info, embeddings = self._sentences_info(header_ids)
+        if sentences_info:
+            deduplicator.add(sentences_info, embeddings)
+        self.groups[group_id] = {
+            'header_ids': header_ids,
+            'conflicts': self._header_conflicts(self.headers[header_ids[0]], header_ids[1:]),
+            'deduplicator': deduplicator
+        }
+        for header_id in header_ids:
+            self.headers[header_id]['group'] = group_id
+        self.dirty_groups.add(group_id)
+        return group_id
+
+    def _extend_group(self, group_id, header_ids):
+        """
+        Appends headers that sort after every header in the group, deduplicating only their bullets.
+        """
+        group = self.groups[group_id]
+        header_ids = sorted(header_ids, key=lambda header_id: self.headers[header_id]['sort_key'])
+        sentences_info, embeddings = self._sentences_info(header_ids)
+        if sentences_info:
+            group['deduplicator'].add(sentences_info, embeddings)
+        group['conflicts'].extend(self._header_conflicts(self.headers[group['header_ids'][0]], header_ids))
+        group['header_ids'].extend(header_ids)
+        for header_id in header_ids:
+            self.headers[header_id]['group'] = group_id
+        self.dirty_groups.add(group_id)
+
+    def _drop_group(self, group_id):
+        del self.groups[group_id]
+        self.dirty_groups.discard(group_id)
+        self.deleted_groups.add(group_id)
+
+    # Notes
+
+    def add_note(self, note, signature=None):
+        """
+        Adds a note and updates only the header groups it touches.
+
+        Parameters:
+            note (dict): A note as returned by load_notes_from_files ('note_num' and 'headers').
+            signature: Optional value identifying the note's source version, used by sync_directory.
+
+        Returns:
+            group_ids (list): Ids of the groups that were created or changed.
+        """
+        note_num = note['note_num']
+        seq = self.next_note_seq
+        self.next_note_seq += 1
+
+        new_ids = []
+        for header_idx, header in enumerate(note['headers']):
+            header_name = header['header_name'].strip().strip(':')
+            bullets_info = []
+            for bullet_idx, bullet in enumerate(header['bullets']):
+                pre_bullet, avg_word_length = preprocess_sentence(bullet)
+                bullets_info.append((bullet_idx + 1, bullet, pre_bullet, avg_word_length))
+            header_id = self.next_header_id
+            self.next_header_id += 1
+            self.headers[header_id] = {
+                'note_num': note_num,
+                'header_name': header_name,
+                'embedding_text': header_name.strip(),
+                'sort_key': (note_num, seq, header_idx),
+                'bullets_info': bullets_info,
+                'group': None
+            }
+            new_ids.append(header_id)
+
+        record = self.notes.setdefault(note_num, {'header_ids': [], 'signature': None})
+        record['header_ids'].extend(new_ids)
+        if signature is not None:
+            record['signature'] = signature
+        if not new_ids:
+            return []
+
+        new_names = [self.headers[header_id]['embedding_text'] for header_id in new_ids]
+        self._name_vectors_for(new_names)
+        for header_id, name in zip(new_ids, new_names):
+            self.name_headers.setdefault(name, set()).add(header_id)
+
+        # Union-find over the new headers and the existing groups they link to
+        parent = {}
+
+        def find(u):
+            parent.setdefault(u, u)
+            while parent[u] != u:
+                parent[u] = parent[parent[u]]  # Path compression
+                u = parent[u]
+            return u
+
+        def union(u, v):
+            pu = find(u)
+            pv = find(v)
+            if pu != pv:
+                parent[pu] = pv
+
+        new_set = set(new_ids)
+        for name in dict.fromkeys(new_names):
+            name_new_ids = [header_id for header_id in self.name_headers[name] if header_id in new_set]
+            for header_id in name_new_ids:
+                find(('header', header_id))
+            for linked_name in self._linked_names(name):
+                for other_id in self.name_headers.get(linked_name, ()):
+                    if other_id in new_set:
+                        other = ('header', other_id)
+                    else:
+                        other = ('group', self.headers[other_id]['group'])
+                    for header_id in name_new_ids:
+                        if other != ('header', header_id):
+                            union(('header', header_id), other)
+
+        components = {}
+        for node in list(parent):
+            components.setdefault(find(node), []).append(node)
+
+        changed = []
+        for nodes in components.values():
+            group_ids = [node[1] for node in nodes if node[0] == 'group']
+            header_ids = [node[1] for node in nodes if node[0] == 'header']
+            if len(group_ids) == 1:
+                group = self.groups[group_ids[0]]
+                last_key = self.headers[group['header_ids'][-1]]['sort_key']
+                if all(self.headers[header_id]['sort_key'] > last_key for header_id in header_ids):
+                    self._extend_group(group_ids[0], header_ids)
+                    changed.append(group_ids[0])
+                    continue
+            for group_id in group_ids:
+                header_ids.extend(self.groups[group_id]['header_ids'])
+                self._drop_group(group_id)
+            changed.append(self._build_group(header_ids))
+        logging.info(f"Added note {note_num}: {len(new_ids)} headers, {len(changed)} groups updated")
+        return changed
+
+    def remove_note(self, note_num):
+        """
+        Removes every header of a note. Groups that contained it are split into their
+        remaining connected components and re-deduplicated.
+
+        Returns:
+            group_ids (list): Ids of the groups created in place of the affected ones.
+        """
+        record = self.notes.pop(note_num, None)
+        if record is None:
+            return []
+        affected = set()
+        for header_id in record['header_ids']:
+            header = self.headers.pop(header_id)
+            self.name_headers[header['embedding_text']].discard(header_id)
+            if not self.name_headers[header['embedding_text']]:
+                del self.name_headers[header['embedding_text']]
+            affected.add(header['group'])
+
+        changed = []
+        for group_id in affected:
+            remaining = [header_id for header_id in self.groups[group_id]['header_ids'] if header_id in self.headers]
+            self._drop_group(group_id)
+            if not remaining:
+                continue
+            # Headers of one group only link to each other, so components can be found within it
+            parent = {header_id: header_id for header_id in remaining}
+
+            def find(u):
+                while parent[u] != u:
+                    parent[u] = parent[parent[u]]  # Path compression
+                    u = parent[u]
+                return u
+
+            by_name = {}
+            for header_id in remaining:
+                by_name.setdefault(self.headers[header_id]['embedding_text'], []).append(header_id)
+            names = list(by_name)
+            for i, name1 in enumerate(names):
+                for name2 in names[i:]:
+                    if self._names_linked(name1, name2):
+                        ids = by_name[name1] + by_name[name2]
+                        for header_id in ids[1:]:
+                            pu, pv = find(header_id), find(ids[0])
+                            if pu != pv:
+                                parent[pu] = pv
+
+            components = {}
+            for header_id in remaining:
+                components.setdefault(find(header_id), []).append(header_id)
+            for header_ids in components.values():
+                changed.append(self._build_group(header_ids))
+        logging.info(f"Removed note {note_num}: {len(record['header_ids'])} headers, {len(changed)} groups rebuilt")
+        return changed
+
+    def sync_directory(self, directory):
+        """
+        Brings the state in line with the JSON and .notes files in a directory: new files are added,
+        changed files are replaced and deleted files are removed. As in load_notes_from_files, a
+        JSON file with a .notes copy is skipped.
+
+        Returns:
+            group_ids (list): Ids of the groups that were created or changed.
+        """
+        changed = []
+        files = {}
+        for file_name in list_note_files(directory):
+            file_path = os.path.join(directory, file_name)
+            stat = os.stat(file_path)
+            files[file_name] = (file_path, [stat.st_mtime_ns, stat.st_size])
+        for note_num in [note_num for note_num in self.notes if note_num not in files]:
+            changed.extend(self.remove_note(note_num))
+        for note_num, (file_path, signature) in files.items():
+            record = self.notes.get(note_num)
+            if record is not None and record['signature'] == signature:
+                continue
+            changed.extend(self.add_file(file_path, signature))
+        return [group_id for group_id in dict.fromkeys(changed) if group_id in self.groups]
+
+    def add_file(self, file_path, signature=None):
+        """
+        Adds the notes of a JSON or .notes file, replacing those of an earlier version of it.
+
+        Returns:
+            group_ids (list): Ids of the groups that were created or changed.
+        """
+        if signature is None:
+            stat = os.stat(file_path)
+            signature = [stat.st_mtime_ns, stat.st_size]
+        note_num = os.path.basename(file_path)
+        changed = self.remove_note(note_num)
+        notes = load_notes_from_file(file_path)
+        for note in notes:
+            changed.extend(self.add_note(note, signature))
+        if not notes:
+            self.notes[note_num] = {'header_ids': [], 'signature': signature}
+        return [group_id for group_id in dict.fromkeys(changed) if group_id in self.groups]
+
+    def merged_header(self, group_id):
+        """
+        One group in the form of an entry of merge_multiple_notes' merged_headers.
+        """
+        group = self.groups[group_id]
+        accepted = self.headers[group['header_ids'][0]]
+        deduplicator = group['deduplicator']
+        return {
+            'header_name': accepted['header_name'],
+            'header_id': group['header_ids'][0],
+            'note_id': accepted['note_num'],
+            'bullets': list(deduplicator.retained_sentences),
+            'bullet_to_sources': deduplicator.sentence_to_sources,
+            'conflicts': group['conflicts']
+        }
+
+    def ordered_group_ids(self, group_ids=None):
+        """
+        Group ids (all of them by default) in the order result() lists the groups.
+        """
+        group_ids = self.groups if group_ids is None else group_ids
+        return sorted(group_ids, key=lambda group_id: self.headers[self.groups[group_id]['header_ids'][0]]['sort_key'])
+
+    def result(self):
+        """
+        Returns the merge in the same form as merge_multiple_notes. The returned
+        structures share data with the state and should be treated as read-only.
+
+        Returns:
+            merged_text (str): The merged text of all notes.
+            merged_headers (list): Detailed information about merged headers and bullets.
+            sentence_to_sources (dict): Mapping of retained sentences to their sources and conflicts.
+        """
+        merged_headers = []
+        sentence_to_sources = {}
+        for group_id in self.ordered_group_ids():
+            merged_header = self.merged_header(group_id)
+            merged_headers.append(merged_header)
+            sentence_to_sources.update(merged_header['bullet_to_sources'])
+
+        merged_text_lines = []
+        for merged_header in merged_headers:
+            merged_text_lines.append(f"{merged_header['header_name']}:")
+            for bullet in merged_header['bullets']:
+                merged_text_lines.append(f"- {bullet[2]}")
+        return '\n'.join(merged_text_lines), merged_headers, sentence_to_sources
+
+    # Persistence
+
+    def save(self, directory):
+        """
+        Writes the state to a directory. Only groups changed since the last save are written,
+        one JSON file and one FAISS index per group.
+        """
+        groups_dir = os.path.join(directory, 'groups')
+        os.makedirs(groups_dir, exist_ok=True)
+        for group_id in self.deleted_groups:
+            for extension in ('json', 'faiss'):
+                path = os.path.join(groups_dir, f"{group_id}.{extension}")
+                if os.path.exists(path):
+                    os.remove(path)
+        for group_id in self.dirty_groups:
+            group = self.groups[group_id]
+            deduplicator = group['deduplicator']
+            data = {
+                'header_ids': group['header_ids'],
+                'conflicts': group['conflicts'],
+                'bullets_info': {header_id: self.headers[header_id]['bullets_info'] for header_id in group['header_ids']},
+                'retained_sentences': deduplicator.retained_sentences,
+                'retained_preprocessed': deduplicator.retained_preprocessed,
+                'retained_sources': deduplicator.retained_sources
+            }
+            index_path = os.path.join(groups_dir, f"{group_id}.faiss")
+            get_faiss().write_index(deduplicator.faiss_index, f"{index_path}.tmp")
+            os.replace(f"{index_path}.tmp", index_path)
+            write_json_atomic(os.path.join(groups_dir, f"{group_id}.json"), data)
+
+        state = {
+            'version': MERGE_STATE_VERSION,
+            'config': self.config,
+            'next_header_id': self.next_header_id,
+            'next_note_seq': self.next_note_seq,
+            'next_group_id': self.next_group_id,
+            'notes': [[note_num, record] for note_num, record in self.notes.items()],
+            'headers': [
+                [header_id, {key: value for key, value in header.items() if key != 'bullets_info'}]
+                for header_id, header in self.headers.items()
+            ]
+        }
+        write_json_atomic(os.path.join(directory, 'state.json'), state)
+        self.dirty_groups.clear()
+        self.deleted_groups.clear()
+        logging.debug(f"Saved merge state to {directory}")
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Loads a state written by save, or returns None if there is none (or it is outdated).
+        """
+        state_path = os.path.join(directory, 'state.json')
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('version') != MERGE_STATE_VERSION:
+            logging.info(f"Ignoring merge state in {directory}: version changed.")
+            return None
+
+        merge_state = cls(**state['config'])
+        merge_state.next_header_id = state['next_header_id']
+        merge_state.next_note_seq = state['next_note_seq']
+        merge_state.next_group_id = state['next_group_id']
+        merge_state.notes = {note_num: record for note_num, record in state['notes']}
+        for header_id, header in state['headers']:
+            header['sort_key'] = tuple(header['sort_key'])
+            merge_state.headers[header_id] = header
+            merge_state.name_headers.setdefault(header['embedding_text'], set()).add(header_id)
+        merge_state._name_vectors_for(list(merge_state.name_headers))
+
+        group_ids = {header['group'] for header in merge_state.headers.values()}
+        for group_id in group_ids:
+            with open(os.path.join(directory, 'groups', f"{group_id}.json"), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            for header_id, bullets_info in data['bullets_info'].items():
+                merge_state.headers[int(header_id)]['bullets_info'] = [tuple(info) for info in bullets_info]
+            deduplicator = SentenceDeduplicator(
+                get_faiss().read_index(os.path.join(directory, 'groups', f"{group_id}.faiss")),
+                merge_state.config['similarity_threshold'],
+                merge_state.config['overlap_threshold']
+            )
+            deduplicator.retained_sentences = [tuple(sentence) for sentence in data['retained_sentences']]
+            deduplicator.retained_preprocessed = data['retained_preprocessed']
+            deduplicator.retained_sources = data['retained_sources']
+            merge_state.groups[group_id] = {
+                'header_ids': data['header_ids'],
+                'conflicts': data['conflicts'],
+                'deduplicator': deduplicator
+            }
+        return merge_state
+
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def load_or_create_merge_state(directory, **config):
+    """
+    Loads the merge state saved in directory, or creates an empty one with the given thresholds.
+    A saved state with different thresholds is discarded, since its groups would be wrong.
+    """
+    merge_state = MergeState.load(directory)
+    if merge_state is not None:
+        expected = MergeState(**config).config
+        if merge_state.config == expected:
+            return merge_state
+        logging.info(f"Discarding merge state in {directory}: thresholds changed.")
+    merge_state = MergeState(**config)
+    if os.path.isdir(os.path.join(directory, 'groups')):
+        # Old group files would otherwise be left behind
+        merge_state.deleted_groups.update(
+            int(name.split('.')[0]) for name in os.listdir(os.path.join(directory, 'groups')) if name.split('.')[0].isdigit()
+        )
+    return merge_state
@@ -0,0 +1,221 @@
+# merge_worker.py
+#
+# Long-running merge process for server.js. Instead of starting Python for every merge, the
+# server starts this worker once and sends it requests as JSON lines on stdin; responses are
+# written as JSON lines on stdout. NLTK, FAISS, the embedding backend and the preprocessing
+# and embedding caches stay loaded between requests.
+#
+# Request:  {"id": 1, "method": "merge_multiple_notes", "params": {"directory": "test_files"}}
+# Response: {"id": 1, "result": {...}}  or  {"id": 1, "error": {"type": "...", "message": "..."}}
+#
+# Methods:
+#   ping                   -> "pong"
+#   load_notes_from_files  -> notes; params: directory
+#   merge_multiple_notes   -> {"merged_text", "merged_results"}; params: notes or directory, plus
+#                             any keyword argument of merge_logic.merge_multiple_notes. With
+#                             "metrics": true, merged_results also has the merge's "metrics"
+#   stream_merge           -> same params; sends {"id": 1, "header": {...}} as each header group
+#                             is deduplicated, then {"id": 1, "result": {"headers": count}}
+#                             (plus "metrics" if requested)
+#   sync_directory         -> {"changed_headers", "headers"}; params: directory. Brings the directory's
+#                             merge state in line with its note files: new and changed files are
+#                             merged in and deleted ones taken out, without re-merging the rest
+#   add_note               -> same result; params: directory, file (a note file in directory, e.g. one
+#                             just uploaded; replaces an earlier version of the file)
+#   remove_note            -> same result; params: directory, note_num (the note's file name)
+#   merge_state_result     -> {"merged_text", "merged_results"} of the directory's merge state
+#   stats                  -> cache sizes and request counts
+#   shutdown               -> stops reading requests and exits once queued requests are done
+#
+# The merge state of a directory is kept in memory and saved to <directory>/.merge_state after
+# each change, so it is loaded rather than rebuilt when the worker restarts. "changed_headers"
+# lists only the header groups the change created or altered, in merged_results form, so the
+# time to answer depends on the size of the note rather than of the corpus; "headers" is the
+# total number of header groups.
+#
+# Requests may be sent without waiting for earlier responses. Merges run one at a time, in
+# the order received, because the preprocessing and embedding caches are shared module state;
+# responses carry the request id so callers can match them.
+#
+# Per-sentence diagnostics are off by default; set MERGE_TRACE (see tracing.py) in the
+# server's environment to trace them to MERGE_TRACE_FILE.
+#
+# Usage: python merge_worker.py
+
+import os
+import sys
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from merge_logic import (load_notes_from_files, merge_multiple_notes, iter_merged_headers,
+                         format_merged_results, format_merged_header)
+from preprocess import preprocess_cache_info
+from pipeline_metrics import PipelineMetrics, metrics_stage
+from merge_state import load_or_create_merge_state
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Where a notes directory's merge state is saved, inside that directory
+MERGE_STATE_DIR = '.merge_state'
+
+
+def resolve_directory(directory):
+    """
+    Resolves a notes directory relative to this file, as test_client does.
+    """
+    return directory if os.path.isabs(directory) else os.path.join(HERE, directory)
+
+
+class MergeWorker:
+    """
+    Reads requests from a stream of JSON lines and writes one JSON response per request,
+    preceded by one message per header group for stream_merge.
+    """
+    def __init__(self, output):
+        self.output = output
+        self.write_lock = threading.Lock()
+        # A single thread keeps merges serial while the reader keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.requests = 0
+        self.errors = 0
+        self.merge_states = {}  # Resolved notes directory -> MergeState
+
+    def send(self, message):
+        line = json.dumps(message)
+        with self.write_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def respond(self, request_id, result=None, error=None):
+        response = {'id': request_id}
+        if error is None:
+            response['result'] = result
+        else:
+            response['error'] = {'type': type(error).__name__, 'message': str(error)}
+        self.send(response)
+
+    def load_merge_state(self, directory):
+        """
+        Loads the saved merge state of a notes directory (or creates one), brings it in line
+        with the files in the directory and keeps it for later requests.
+
+        Returns:
+            group_ids (list): Ids of the groups the files changed since the state was saved.
+        """
+        merge_state = load_or_create_merge_state(os.path.join(directory, MERGE_STATE_DIR))
+        changed = merge_state.sync_directory(directory)
+        merge_state.save(os.path.join(directory, MERGE_STATE_DIR))
+        self.merge_states[directory] = merge_state
+        return changed
+
+    def merge_state(self, directory):
+        if directory not in self.merge_states:
+            self.load_merge_state(directory)
+        return self.merge_states[directory]
+
+    def update_merge_state(self, method, params):
+        directory = resolve_directory(params.get('directory', 'test_files'))
+        # Changes found when the state is first loaded are reported with the request's own
+        changed = [] if directory in self.merge_states else self.load_merge_state(directory)
+        merge_state = self.merge_states[directory]
+        if method == 'sync_directory':
+            changed.extend(merge_state.sync_directory(directory))
+        elif method == 'add_note':
+            file_name = os.path.basename(params['file'])
+            changed.extend(merge_state.add_file(os.path.join(directory, file_name)))
+        else:
+            changed.extend(merge_state.remove_note(params['note_num']))
+        merge_state.save(os.path.join(directory, MERGE_STATE_DIR))
+        changed = [group_id for group_id in dict.fromkeys(changed) if group_id in merge_state.groups]
+        return {
+            'changed_headers': [
+                format_merged_header(merge_state.merged_header(group_id))
+                for group_id in merge_state.ordered_group_ids(changed)
+            ],
+            'headers': len(merge_state.groups)
+        }
+
+    def call(self, request_id, method, params):
+        if method == 'load_notes_from_files':
+            return load_notes_from_files(resolve_directory(params.get('directory', 'test_files')))
+        if method in ('merge_multiple_notes', 'stream_merge'):
+            params = dict(params)
+            notes = params.pop('notes', None)
+            directory = params.pop('directory', None)
+            metrics = PipelineMetrics() if params.pop('metrics', False) else None
+            if notes is None:
+                with metrics_stage(metrics, 'load'):
+                    notes = load_notes_from_files(resolve_directory(directory or 'test_files'))
+            if method == 'stream_merge':
+                count = 0
+                for merged_header in iter_merged_headers(notes, metrics=metrics, **params):
+                    self.send({'id': request_id, 'header': format_merged_header(merged_header)})
+                    count += 1
+                if metrics is None:
+                    return {'headers': count}
+                return {'headers': count, 'metrics': metrics.to_dict()}
+            merged_text, merged_headers, _ = merge_multiple_notes(notes, metrics=metrics, **params)
+            return {'merged_text': merged_text, 'merged_results': format_merged_results(merged_headers, metrics)}
+        if method in ('sync_directory', 'add_note', 'remove_note'):
+            return self.update_merge_state(method, params)
+        if method == 'merge_state_result':
+            merge_state = self.merge_state(resolve_directory(params.get('directory', 'test_files')))
+            merged_text, merged_headers, _ = merge_state.result()
+            return {'merged_text': merged_text, 'merged_results': format_merged_results(merged_headers)}
+        if method == 'stats':
+            return {'requests': self.requests, 'errors': self.errors, 'preprocess_cache': preprocess_cache_info()}
+        raise ValueError(f"Unknown method '{method}'.")
+
+    def run_request(self, request_id, method, params):
+        try:
+            result = self.call(request_id, method, params)
+        except Exception as e:
+            logging.exception(f"Request {request_id} ({method}) failed")
+            self.errors += 1
+            self.respond(request_id, error=e)
+            return
+        self.respond(request_id, result)
+
+    def serve(self, lines):
+        """
+        Handles requests until the input ends or a shutdown request arrives.
+        """
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                method = request['method']
+                params = request.get('params') or {}
+            except (ValueError, KeyError, AttributeError) as e:
+                self.errors += 1
+                self.respond(None, error=ValueError(f"Malformed request: {e}"))
+                continue
+            self.requests += 1
+            if method == 'ping':
+                self.respond(request_id, 'pong')
+            elif method == 'shutdown':
+                self.executor.shutdown(wait=True)
+                self.respond(request_id, 'bye')
+                return
+            else:
+                self.executor.submit(self.run_request, request_id, method, params)
+        self.executor.shutdown(wait=True)
+
+
+def main():
+    logging.basicConfig(
+        level=os.environ.get('MERGE_WORKER_LOG_LEVEL', 'INFO'),
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        stream=sys.stderr
+    )
+    # stdout carries the protocol; anything else printed goes to stderr
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    logging.info("Merge worker ready.")
+    MergeWorker(output).serve(sys.stdin)
+
+
+if __name__ == "__main__":
+    main()
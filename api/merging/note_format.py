@@ -0,0 +1,287 @@
+# note_format.py
+#
+# Columnar binary note files (.notes), an alternative to the JSON files written by read_pdfs.
+# A .notes file holds the same notes as one JSON note file, stored as flat arrays that are
+# memory-mapped on load instead of parsed:
+#
+#   strings        every distinct string once: concatenated UTF-8 text (string_data) and
+#                  the character offset where each string starts (string_offsets)
+#   notes          one row per PDF: pdf_id, and the range of its headers
+#   headers        one row per header: name, page number and the range of its bullets
+#   bullets        one row per bullet: text
+#
+# Rows refer to strings by index, and ranges are offset arrays (rows i..i+1 of an offsets
+# array delimit the children of row i). Optionally a file also carries each bullet's
+# preprocessed text and average word length, and normalized embeddings of header names and
+# preprocessed bullets for one embedding model, so a merge can skip that work.
+#
+# Layout: 8-byte magic, little-endian uint64 length of a JSON header describing the arrays,
+# the JSON header, then each array at an offset aligned to ALIGNMENT bytes. The header maps
+# each array name to [offset, dtype, shape].
+
+import os
+import json
+import math
+import mmap
+import struct
+import numpy as np
+
+NOTE_FILE_EXTENSION = '.notes'
+MAGIC = b'GNOTES\x00\x01'
+FORMAT_VERSION = 1
+# Arrays start at multiples of ALIGNMENT bytes, enough for every column's dtype
+ALIGNMENT = 8
+# Column dtypes, by the dtype string stored in the header
+DTYPES = {dtype.str: dtype for dtype in map(np.dtype, ('<i4', '<i8', '<f4', '<f8', '|u1'))}
+# Smaller files are read in one call, which is cheaper than mapping them
+MMAP_MIN_BYTES = 1024 * 1024
+
+
+def notes_from_json_data(data, note_num):
+    """
+    Parses the dictionary read_pdfs writes (pdf_id -> {'pdf_id', 'headers'}) into notes.
+    Each PDF becomes a note numbered note_num.
+
+    Returns:
+        notes (list): Notes with 'note_num', 'pdf_id' and 'headers' ({'header_name', 'bullets'}).
+    """
+    notes = []
+    for pdf_key, pdf_data in data.items():
+        pdf_id = pdf_data.get('pdf_id', pdf_key)
+        headers = []
+        for header in pdf_data.get('headers', []):
+            header_name = header.get('text', 'Default Header')
+            bullets = header.get('section_text', [])
+            if isinstance(bullets, list):
+                bullets_list = bullets
+            elif isinstance(bullets, str):
+                bullets_list = [bullets]
+            else:
+                bullets_list = []
+            bullets_list = [bullet.strip() for bullet in bullets_list if bullet.strip()]
+            parsed = {
+                'header_name': header_name,
+                'bullets': bullets_list
+            }
+            if header.get('page_num') is not None:
+                parsed['page_num'] = header['page_num']
+            headers.append(parsed)
+        notes.append({
+            'note_num': note_num,
+            'pdf_id': pdf_id,
+            'headers': headers
+        })
+    return notes
+
+
+def notes_to_json_data(notes):
+    """
+    Inverse of notes_from_json_data: the dictionary read_pdfs would write for these notes.
+    """
+    data = {}
+    for note in notes:
+        pdf_id = note.get('pdf_id', note['note_num'])
+        headers = []
+        for header in note['headers']:
+            entry = {'text': header['header_name']}
+            if header.get('page_num') is not None:
+                entry['page_num'] = header['page_num']
+            entry['section_text'] = list(header['bullets'])
+            headers.append(entry)
+        data[pdf_id] = {'pdf_id': pdf_id, 'headers': headers}
+    return data
+
+
+class StringTable:
+    """
+    Assigns an index to each distinct string, in first-seen order.
+    """
+    def __init__(self):
+        self.ids = {}
+
+    def add(self, text):
+        return self.ids.setdefault(text, len(self.ids))
+
+    def arrays(self):
+        # Offsets count characters of the decoded text, so a reader decodes the data once
+        # and slices it
+        offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in self.ids], out=offsets[1:])
+        return offsets, np.frombuffer(''.join(self.ids).encode('utf-8'), dtype=np.uint8)
+
+
+def write_note_table(path, notes, preprocessed=None, embeddings=None, model_id=None):
+    """
+    Writes notes to a .notes file. The file is written to a temporary name and renamed, so
+    readers never see a partial file.
+
+    Parameters:
+        path (str): Output path.
+        notes (list): Notes as returned by notes_from_json_data or load_notes_from_file.
+        preprocessed (dict): Optional bullet text -> (preprocessed text, average word length)
+            for every bullet.
+        embeddings (dict): Optional text -> normalized embedding, for header names and
+            preprocessed bullets. Requires model_id.
+        model_id (str): Embedding model the embeddings came from.
+    """
+    strings = StringTable()
+    note_pdf_ids, note_header_offsets = [], [0]
+    header_names, header_pages, header_bullet_offsets = [], [], [0]
+    bullet_texts = []
+    for note in notes:
+        note_pdf_ids.append(strings.add(str(note.get('pdf_id', note['note_num']))))
+        for header in note['headers']:
+            header_names.append(strings.add(header['header_name']))
+            page_num = header.get('page_num')
+            header_pages.append(-1 if page_num is None else page_num)
+            bullet_texts.extend(strings.add(bullet) for bullet in header['bullets'])
+            header_bullet_offsets.append(len(bullet_texts))
+        note_header_offsets.append(len(header_names))
+
+    arrays = {
+        'note_pdf_id': np.array(note_pdf_ids, dtype=np.int32),
+        'note_header_offsets': np.array(note_header_offsets, dtype=np.int64),
+        'header_name': np.array(header_names, dtype=np.int32),
+        'header_page_num': np.array(header_pages, dtype=np.int32),
+        'header_bullet_offsets': np.array(header_bullet_offsets, dtype=np.int64),
+        'bullet_text': np.array(bullet_texts, dtype=np.int32),
+    }
+    if preprocessed is not None:
+        bullets = [header_bullet for note in notes for header in note['headers'] for header_bullet in header['bullets']]
+        arrays['bullet_preprocessed'] = np.array([strings.add(preprocessed[bullet][0]) for bullet in bullets], dtype=np.int32)
+        arrays['bullet_avg_word_length'] = np.array([preprocessed[bullet][1] for bullet in bullets], dtype=np.float64)
+    if embeddings:
+        if model_id is None:
+            raise ValueError("Embeddings need the model_id they were generated with.")
+        texts = list(embeddings)
+        arrays['embedding_text'] = np.array([strings.add(text) for text in texts], dtype=np.int32)
+        arrays['embeddings'] = np.ascontiguousarray(np.stack([embeddings[text] for text in texts]), dtype=np.float32)
+    arrays['string_offsets'], arrays['string_data'] = strings.arrays()
+
+    # Array offsets are relative to the first aligned position after the header
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        layout[name] = [offset, array.dtype.str, list(array.shape)]
+        offset += array.nbytes
+    header = {
+        'version': FORMAT_VERSION,
+        'model_id': model_id if embeddings else None,
+        'arrays': layout
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = -(-(len(MAGIC) + 8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name][0])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class NoteTable:
+    """
+    A .notes file opened for reading. Columns are NumPy views of the file's bytes, which are
+    memory-mapped for files of MMAP_MIN_BYTES or more and read in one call for smaller ones.
+    Strings are decoded when they are first needed.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_MIN_BYTES:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = f.read()
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a .notes file.")
+        (header_length,) = struct.unpack_from('<Q', self.buffer, len(MAGIC))
+        header_end = len(MAGIC) + 8 + header_length
+        header = json.loads(self.buffer[len(MAGIC) + 8:header_end])
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(f"{path} has format version {header['version']}, expected {FORMAT_VERSION}.")
+        self.model_id = header['model_id']
+        data_start = -(-header_end // ALIGNMENT) * ALIGNMENT
+        self.columns = {}
+        for name, (offset, dtype, shape) in header['arrays'].items():
+            column = np.frombuffer(self.buffer, dtype=DTYPES[dtype], count=math.prod(shape), offset=data_start + offset)
+            self.columns[name] = column.reshape(shape) if len(shape) > 1 else column
+        self._strings = None
+
+    def __len__(self):
+        return len(self.columns['note_pdf_id'])
+
+    @property
+    def strings(self):
+        """
+        All strings of the file, decoded once on first use.
+        """
+        if self._strings is None:
+            text = self.columns['string_data'].tobytes().decode('utf-8')
+            offsets = self.columns['string_offsets'].tolist()
+            self._strings = [text[start:end] for start, end in zip(offsets, offsets[1:])]
+        return self._strings
+
+    def to_notes(self, note_num):
+        """
+        Returns the notes in the form of notes_from_json_data, numbered note_num.
+        """
+        strings = self.strings
+        note_pdf_ids = self.columns['note_pdf_id'].tolist()
+        note_header_offsets = self.columns['note_header_offsets'].tolist()
+        header_names = self.columns['header_name'].tolist()
+        header_pages = self.columns['header_page_num'].tolist()
+        header_bullet_offsets = self.columns['header_bullet_offsets'].tolist()
+        bullet_texts = [strings[i] for i in self.columns['bullet_text'].tolist()]
+        notes = []
+        for note_idx, pdf_id in enumerate(note_pdf_ids):
+            headers = []
+            for header_idx in range(note_header_offsets[note_idx], note_header_offsets[note_idx + 1]):
+                header = {
+                    'header_name': strings[header_names[header_idx]],
+                    'bullets': bullet_texts[header_bullet_offsets[header_idx]:header_bullet_offsets[header_idx + 1]]
+                }
+                if header_pages[header_idx] >= 0:
+                    header['page_num'] = header_pages[header_idx]
+                headers.append(header)
+            notes.append({
+                'note_num': note_num,
+                'pdf_id': strings[pdf_id],
+                'headers': headers
+            })
+        return notes
+
+    def preprocessed(self):
+        """
+        Returns bullet text -> (preprocessed text, average word length), or None if the file
+        was written without preprocessed text.
+        """
+        if 'bullet_preprocessed' not in self.columns:
+            return None
+        strings = self.strings
+        return {
+            strings[text]: (strings[pre], avg_word_length)
+            for text, pre, avg_word_length in zip(
+                self.columns['bullet_text'].tolist(),
+                self.columns['bullet_preprocessed'].tolist(),
+                self.columns['bullet_avg_word_length'].tolist()
+            )
+        }
+
+    def embeddings(self):
+        """
+        Returns (texts, matrix) of the stored embeddings, or None if there are none. The
+        matrix is a read-only view of the mapped file.
+        """
+        if 'embeddings' not in self.columns:
+            return None
+        strings = self.strings
+        return [strings[i] for i in self.columns['embedding_text'].tolist()], self.columns['embeddings']
+
+
+def read_note_table(path):
+    return NoteTable(path)
@@ -0,0 +1,272 @@
+# pipeline_metrics.py
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource  # Unix only; peak RSS is reported as None elsewhere
+except ImportError:
+    resource = None
+
+
+class PipelineMetrics:
+    """
+    Timings and counters collected by merge_multiple_notes and read_pdfs.process_pdfs when
+    a PipelineMetrics is passed to them.
+
+    Attributes:
+        stages (dict): Stage name -> {'wall_seconds', 'cpu_seconds', 'calls'}. CPU time is
+            this process's, so work done in worker processes is only in the item records.
+        counters (dict): Counter name -> value, e.g. items processed and cache hits.
+        items (dict): Record kind -> list of dicts, one per header group or per PDF.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.items = {}
+
+    @contextmanager
+    def stage(self, name, per_group=False):
+        """
+        Times the enclosed block and adds it to the named stage. per_group marks stages
+        entered once per header group, which PipelineProfiler does not snapshot per call.
+        """
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+            stage['wall_seconds'] += time.perf_counter() - wall_start
+            stage['cpu_seconds'] += time.process_time() - cpu_start
+            stage['calls'] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_item(self, kind, record):
+        self.items.setdefault(kind, []).append(record)
+
+    def hit_rates(self):
+        """
+        Hit rate for every pair of counters named <cache>_hits and <cache>_misses.
+        """
+        rates = {}
+        for name, hits in self.counters.items():
+            if name.endswith('_hits'):
+                cache = name[:-len('_hits')]
+                total = hits + self.counters.get(f"{cache}_misses", 0)
+                rates[cache] = hits / total if total else None
+        return rates
+
+    def to_dict(self):
+        """
+        JSON-serializable copy of the metrics.
+        """
+        return {
+            'stages': {name: dict(stage) for name, stage in self.stages.items()},
+            'counters': dict(self.counters),
+            'hit_rates': self.hit_rates(),
+            'items': {kind: [dict(record) for record in records] for kind, records in self.items.items()}
+        }
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process so far, or None where it is not available.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Allocation key of the per-group stages, which are snapshotted together
+PER_GROUP = '<per-group stages>'
+
+
+class PipelineProfiler(PipelineMetrics):
+    """
+    PipelineMetrics that also profiles every stage: a cProfile profile per stage, the stage's
+    peak traced memory, the traced memory it still holds, how far it raised the process's
+    peak RSS, and the sites of the blocks it allocated and still holds.
+
+    Allocation sites come from tracemalloc snapshots, taken only at the boundaries of
+    top-level stages. Stages entered per header group (per_group=True) are not snapshotted
+    on each call; what they hold is snapshotted once, at the next top-level stage or at
+    report(), and listed under 'per_group_top_allocators'.
+
+    Only the thread that runs a stage is profiled by cProfile (group_workers threads and
+    processes are not), while tracemalloc sees every thread of this process. Stages should
+    not nest, since entering a top-level stage starts allocation tracking afresh.
+
+    Parameters:
+        top (int): Allocators and functions listed per stage in the report.
+        nframes (int): Frames stored per traced allocation.
+    """
+    def __init__(self, top=10, nframes=1):
+        super().__init__()
+        self.top = top
+        self.profiles = {}
+        self.allocations = {}  # Stage -> {(file, line): [bytes, blocks]}
+        self.memory = {}
+        self.active = []  # (name, traced bytes and peak RSS at entry) of the stages entered
+        self.per_group_traces = False  # Whether per-group stages ran since the last snapshot
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(nframes)
+        self.snapshot_filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ]
+
+    @contextmanager
+    def stage(self, name, per_group=False):
+        with PipelineMetrics.stage(self, name):
+            self.enter(name, per_group)
+            try:
+                yield
+            finally:
+                self.exit(name, per_group)
+
+    def enter(self, name, per_group=False):
+        if self.active:
+            self.profiles[self.active[-1][0]].disable()
+        if not per_group:
+            self.snapshot_per_group()
+            tracemalloc.clear_traces()
+        held, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.active.append((name, held, peak_rss_bytes()))
+        self.profiles.setdefault(name, cProfile.Profile()).enable()
+
+    def exit(self, name, per_group=False):
+        self.profiles[name].disable()
+        _, held_at_entry, rss_at_entry = self.active.pop()
+        held, peak = tracemalloc.get_traced_memory()
+        rss = peak_rss_bytes()
+        memory = self.memory.setdefault(name, {'peak_traced_bytes': 0, 'held_bytes': 0, 'peak_rss_growth_bytes': None})
+        memory['peak_traced_bytes'] = max(memory['peak_traced_bytes'], peak - held_at_entry)
+        memory['held_bytes'] += held - held_at_entry
+        if rss is not None:
+            memory['peak_rss_growth_bytes'] = (memory['peak_rss_growth_bytes'] or 0) + rss - rss_at_entry
+        if per_group:
+            self.per_group_traces = True
+        else:
+            self.add_snapshot(name)
+            # Per-group stages that follow are snapshotted without this stage's blocks
+            tracemalloc.clear_traces()
+        if self.active:
+            self.profiles[self.active[-1][0]].enable()
+
+    def add_snapshot(self, name):
+        # Adds the blocks traced since the last top-level boundary that are still held to the allocations of name
+        snapshot = tracemalloc.take_snapshot().filter_traces(self.snapshot_filters)
+        allocations = self.allocations.setdefault(name, {})
+        for statistic in snapshot.statistics('lineno'):
+            frame = statistic.traceback[0]
+            totals = allocations.setdefault((frame.filename, frame.lineno), [0, 0])
+            totals[0] += statistic.size
+            totals[1] += statistic.count
+
+    def snapshot_per_group(self):
+        if self.per_group_traces and tracemalloc.is_tracing():
+            self.add_snapshot(PER_GROUP)
+            self.per_group_traces = False
+
+    def top_functions(self, name):
+        stats = pstats.Stats(self.profiles[name])
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:self.top]
+        return [
+            {'function': f"{file}:{line}({function})", 'calls': calls, 'self_seconds': self_time,
+             'cumulative_seconds': cumulative}
+            for (file, line, function), (_, calls, self_time, cumulative, _) in rows
+        ]
+
+    def top_allocators(self, name):
+        rows = sorted(self.allocations.get(name, {}).items(), key=lambda item: item[1][0], reverse=True)[:self.top]
+        return [{'location': f"{file}:{line}", 'bytes': size, 'blocks': count} for (file, line), (size, count) in rows]
+
+    def report(self):
+        """
+        Timings and counters of to_dict, plus memory, top allocators and top functions per stage.
+        peak_rss_bytes is the process's peak RSS since it started; each stage reports by how
+        much it raised that peak (peak_rss_growth_bytes).
+        """
+        self.snapshot_per_group()
+        report = self.to_dict()
+        report['peak_rss_bytes'] = peak_rss_bytes()
+        for name, stage in report['stages'].items():
+            stage.update(self.memory.get(name, {}))
+            if name in self.allocations:
+                stage['top_allocators'] = self.top_allocators(name)
+            stage['top_functions'] = self.top_functions(name)
+        if PER_GROUP in self.allocations:
+            report['per_group_top_allocators'] = self.top_allocators(PER_GROUP)
+        return report
+
+    def save(self, directory):
+        """
+        Stops tracemalloc and writes the profile to directory:
+            <stage>.prof      cProfile stats of one stage
+            profile.prof      all stages together
+            profile.json      report()
+        The .prof files are pstats files, which flameprof, snakeviz and tuna render as flame
+        graphs (e.g. flameprof profile.prof > profile.svg).
+
+        Returns:
+            report (dict): As returned by report().
+        """
+        report = self.report()
+        tracemalloc.stop()
+        os.makedirs(directory, exist_ok=True)
+        combined = None
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(directory, f"{name}.prof"))
+            if combined is None:
+                combined = pstats.Stats(profile)
+            else:
+                combined.add(profile)
+        if combined is not None:
+            combined.dump_stats(os.path.join(directory, 'profile.prof'))
+        with open(os.path.join(directory, 'profile.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        return report
+
+
+def format_profile_report(report, top=3):
+    """
+    Short text summary of a PipelineProfiler report: per stage time, memory and the
+    largest allocators.
+    """
+    def mb(size):
+        if size is None:
+            return "n/a"
+        return f"{size / 1e6:.1f} MB" if size >= 1e6 else f"{size / 1e3:.1f} KB"
+
+    lines = [f"Process peak RSS: {mb(report['peak_rss_bytes'])}"]
+    for name, stage in report['stages'].items():
+        lines.append(
+            f"{name}: {stage['wall_seconds']:.3f}s wall, {stage['cpu_seconds']:.3f}s CPU, {stage['calls']} calls, "
+            f"peak traced {mb(stage.get('peak_traced_bytes'))}, peak RSS +{mb(stage.get('peak_rss_growth_bytes'))}"
+        )
+        for allocator in stage.get('top_allocators', [])[:top]:
+            lines.append(f"    {mb(allocator['bytes'])} in {allocator['blocks']} blocks at {allocator['location']}")
+    if report.get('per_group_top_allocators'):
+        lines.append("per-group stages:")
+        for allocator in report['per_group_top_allocators'][:top]:
+            lines.append(f"    {mb(allocator['bytes'])} in {allocator['blocks']} blocks at {allocator['location']}")
+    return '\n'.join(lines)
+
+
+def metrics_stage(metrics, name, per_group=False):
+    """
+    metrics.stage(name, per_group), or a no-op context when no metrics are being collected.
+    """
+    return nullcontext() if metrics is None else metrics.stage(name, per_group)
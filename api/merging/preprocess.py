@@ -1,17 +1,163 @@
 # preprocess.py
 
+import os
 import re
-import logging
-import numpy as np
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
+from collections import OrderedDict
+import tracing
 
-# Initialize lemmatizer and stopwords globally for efficiency
-lemmatizer = WordNetLemmatizer()
-stop_words = set(stopwords.words('english'))
+# Local NLTK data, seeded once with seed_nltk_data.py. Directories in NLTK_DATA are searched
+# first. Corpora are loaded on first use and never downloaded at run time.
+LOCAL_NLTK_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nltk_data')
 
-# Caches to store preprocessed sentences
-preprocess_cache = {}
+# Loaded on first use, since importing NLTK alone takes about a second
+lemmatizer = None
+stop_words = None
+
+class MissingNLTKDataError(LookupError):
+    """
+    Raised when a corpus preprocessing needs is not in any NLTK data directory.
+    """
+    def __init__(self, corpus):
+        super().__init__(
+            f"NLTK corpus '{corpus}' was not found in {os.pathsep.join(nltk_data_dirs())} or NLTK's default "
+            f"directories. Run 'python seed_nltk_data.py' in {os.path.dirname(LOCAL_NLTK_DATA)} once to download it."
+        )
+        self.corpus = corpus
+
+def nltk_data_dirs():
+    return [directory for directory in os.environ.get('NLTK_DATA', '').split(os.pathsep) if directory] + [LOCAL_NLTK_DATA]
+
+def import_nltk():
+    """
+    Imports NLTK with the local data directory on its search path.
+    """
+    import nltk
+    if LOCAL_NLTK_DATA not in nltk.data.path:
+        nltk.data.path.append(LOCAL_NLTK_DATA)
+    return nltk
+
+def load_stop_words():
+    """
+    Returns the English stopwords. The plain-text list is read directly when it is on disk,
+    which avoids importing NLTK; otherwise NLTK's corpus reader is used.
+    """
+    global stop_words
+    if stop_words is None:
+        for directory in nltk_data_dirs():
+            path = os.path.join(directory, 'corpora', 'stopwords', 'english')
+            if os.path.isfile(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    stop_words = {line.strip() for line in f if line.strip()}
+                break
+        else:
+            import_nltk()
+            from nltk.corpus import stopwords
+            try:
+                stop_words = set(stopwords.words('english'))
+            except LookupError:
+                raise MissingNLTKDataError('stopwords') from None
+    return stop_words
+
+def get_lemmatizer():
+    """
+    Returns the WordNet lemmatizer, importing NLTK the first time a token needs lemmatizing.
+    """
+    global lemmatizer
+    if lemmatizer is None:
+        import_nltk()
+        from nltk.corpus import wordnet
+        from nltk.stem import WordNetLemmatizer
+        # WordNet is otherwise loaded by the first lemmatize call, deep inside a merge
+        try:
+            wordnet.ensure_loaded()
+        except LookupError:
+            raise MissingNLTKDataError('wordnet') from None
+        lemmatizer = WordNetLemmatizer()
+    return lemmatizer
+
+WORD_PATTERN = re.compile(r'\b\w+\b')
+
+# Lemma of every token seen so far. Vocabularies are small even when sentences are unique,
+# so this is only cleared if it grows past LEMMA_CACHE_MAX_ENTRIES
+LEMMA_CACHE_MAX_ENTRIES = 500000
+lemma_cache = {}
+
+
+class SentenceCache:
+    """
+    Least-recently-used cache of preprocessed sentences with hit and miss counters.
+    A max_entries of 0 disables sentence caching.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sentence):
+        result = self.entries.get(sentence)
+        if result is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(sentence)
+        self.hits += 1
+        return result
+
+    def put(self, sentence, result):
+        if self.max_entries <= 0:
+            return
+        self.entries[sentence] = result
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def resize(self, max_entries):
+        self.max_entries = max_entries
+        while len(self.entries) > max(0, max_entries):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'max_entries': self.max_entries
+        }
+
+
+# Cache to store preprocessed sentences; size set by PREPROCESS_CACHE_MAX_ENTRIES (0 disables it)
+preprocess_cache = SentenceCache(int(os.environ.get('PREPROCESS_CACHE_MAX_ENTRIES', 100000)))
+
+def configure_preprocess_cache(max_entries):
+    """
+    Sets the size of the sentence cache. Long-running processes can pass 0 to keep only
+    the per-token lemma cache.
+    """
+    preprocess_cache.resize(max_entries)
+
+def preprocess_cache_info():
+    """
+    Returns hit/miss counters and sizes of the sentence and lemma caches.
+    """
+    info = preprocess_cache.info()
+    info['lemmas'] = len(lemma_cache)
+    return info
+
+def lemmatize_token(word):
+    """
+    Lemmatizes a single token, calling the lemmatizer only the first time a token is seen.
+    """
+    lemma = lemma_cache.get(word)
+    if lemma is None:
+        if len(lemma_cache) >= LEMMA_CACHE_MAX_ENTRIES:
+            lemma_cache.clear()
+        lemma = get_lemmatizer().lemmatize(word)
+        lemma_cache[word] = lemma
+    return lemma
 
 def preprocess_sentence(sentence):
     """
@@ -19,17 +165,22 @@ def preprocess_sentence(sentence):
     Utilizes caching to avoid redundant processing.
     Additionally calculates the average word length.
     """
-    if sentence in preprocess_cache:
-        logging.debug(f"Retrieved preprocessed sentence from cache: '{sentence}'")
-        return preprocess_cache[sentence]
-    
-    words = re.findall(r'\b\w+\b', sentence.lower())
-    lemmatized_words = [lemmatizer.lemmatize(word) for word in words if word not in stop_words]
+    cached = preprocess_cache.get(sentence)
+    if cached is not None:
+        if tracing.active:
+            tracing.trace_event('preprocess', 'cache_hit', sentence=sentence)
+        return cached
+
+    words = WORD_PATTERN.findall(sentence.lower())
+    stop = stop_words if stop_words is not None else load_stop_words()
+    lemmatized_words = [lemmatize_token(word) for word in words if word not in stop]
     preprocessed = ' '.join(lemmatized_words)
     # Calculate average word length
-    avg_word_length = np.mean([len(word) for word in lemmatized_words]) if lemmatized_words else 0
-    preprocess_cache[sentence] = (preprocessed, avg_word_length)
-    logging.debug(f"Preprocessed and cached sentence: '{sentence}' -> '{preprocessed}', avg_word_length: {avg_word_length}")
+    avg_word_length = sum(len(word) for word in lemmatized_words) / len(lemmatized_words) if lemmatized_words else 0
+    preprocess_cache.put(sentence, (preprocessed, avg_word_length))
+    if tracing.active:
+        tracing.trace_event('preprocess', 'cache_miss', sentence=sentence, preprocessed=preprocessed,
+                            avg_word_length=avg_word_length)
     return preprocessed, avg_word_length
 
 def preprocess_header(header):
@@ -0,0 +1,27 @@
+# seed_nltk_data.py
+#
+# Downloads the NLTK corpora used by preprocess.py into the local data directory. Run once
+# when setting up a machine; merges load the corpora from disk and never download them.
+#
+# Usage: python seed_nltk_data.py [--dir DIRECTORY]
+
+import argparse
+from preprocess import LOCAL_NLTK_DATA
+
+CORPORA = ['stopwords', 'wordnet']
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download the NLTK corpora used for preprocessing.")
+    parser.add_argument('--dir', default=LOCAL_NLTK_DATA, help="Target data directory (default: %(default)s)")
+    args = parser.parse_args()
+
+    import nltk
+    for corpus in CORPORA:
+        if not nltk.download(corpus, download_dir=args.dir, quiet=True):
+            raise SystemExit(f"Failed to download NLTK corpus '{corpus}'.")
+        print(f"{corpus}: {args.dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# synthetic_notes.py
+#
+# Generates synthetic note corpora for benchmarks, seeded from the sample notes in test_files.
+# Header names and bullets are recombined from the sample text, and a share of the bullets
+# are near-copies of bullets that earlier notes wrote under the same topic, so the corpus has
+# the duplicate structure the merge is built for.
+#
+# Usage: python synthetic_notes.py OUTPUT_DIR [--notes N] [--headers H] [--bullets B]
+#                                  [--duplicate-rate R] [--seed S] [--format json|notes]
+
+import os
+import re
+import json
+import random
+import argparse
+from note_format import NOTE_FILE_EXTENSION, notes_from_json_data, write_note_table
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SEED_DIR = os.path.join(HERE, 'test_files')
+# Words added to a topic name so that notes title the same topic differently
+HEADER_VARIATIONS = ['Introduction to', 'Overview of', 'Common', 'Advanced', 'Basic', 'Key', 'Notes on']
+WORD_PATTERN = re.compile(r'\S+')
+
+
+def load_seed_text(seed_dir=DEFAULT_SEED_DIR):
+    """
+    Collects the header names and bullets of the JSON note files in seed_dir.
+
+    Returns:
+        header_names (list), bullets (list): Distinct header names and bullets, in file order.
+    """
+    header_names, bullets = [], []
+    for file_name in sorted(os.listdir(seed_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(seed_dir, file_name), 'r', encoding='utf-8') as f:
+            notes = notes_from_json_data(json.load(f), file_name)
+        for note in notes:
+            for header in note['headers']:
+                header_names.append(header['header_name'])
+                bullets.extend(header['bullets'])
+    return list(dict.fromkeys(header_names)), list(dict.fromkeys(bullets))
+
+
+def edit_words(rng, words, fraction, vocabulary):
+    """
+    Replaces about fraction of the words with random vocabulary words.
+    """
+    return [rng.choice(vocabulary) if rng.random() < fraction else word for word in words]
+
+
+def generate_notes(num_notes, headers_per_note, bullets_per_header, duplicate_rate=0.3, seed=0,
+                   seed_dir=DEFAULT_SEED_DIR):
+    """
+    Generates the contents of num_notes note files in the format read_pdfs writes.
+
+    Parameters:
+        num_notes (int): Number of notes (one PDF per note file).
+        headers_per_note (int): Headers in each note.
+        bullets_per_header (int): Bullets under each header.
+        duplicate_rate (float): Probability that a bullet is a near-copy of a bullet an earlier
+            note has under the same topic.
+        seed (int): Random seed; the same arguments always give the same corpus.
+        seed_dir (str): Directory of sample JSON notes to take text from.
+
+    Returns:
+        files (list): (file name, data) per note, where data is read_pdfs output for one PDF.
+    """
+    rng = random.Random(seed)
+    sample_headers, sample_bullets = load_seed_text(seed_dir)
+    vocabulary = [word for bullet in sample_bullets for word in WORD_PATTERN.findall(bullet)]
+    header_words = [word for name in sample_headers for word in name.split()]
+
+    # Topics are the sample headers plus recombined ones, enough for notes to differ
+    topics = list(sample_headers)
+    while len(topics) < max(2 * headers_per_note, len(sample_headers)):
+        topics.append(' '.join(rng.sample(header_words, 3)))
+    # Bullets already written under each topic, which later notes may repeat
+    written = {topic: [] for topic in topics}
+
+    files = []
+    for note_idx in range(num_notes):
+        headers = []
+        for header_idx, topic in enumerate(rng.sample(topics, min(headers_per_note, len(topics)))):
+            name = topic if rng.random() < 0.5 else f"{rng.choice(HEADER_VARIATIONS)} {topic}"
+            bullets = []
+            for _ in range(bullets_per_header):
+                if written[topic] and rng.random() < duplicate_rate:
+                    # Near-copy: the same bullet with a word or two changed
+                    words = WORD_PATTERN.findall(rng.choice(written[topic]))
+                    bullet = ' '.join(edit_words(rng, words, 1.5 / max(1, len(words)), vocabulary))
+                else:
+                    words = WORD_PATTERN.findall(rng.choice(sample_bullets))
+                    bullet = ' '.join(edit_words(rng, words, 0.5, vocabulary))
+                    written[topic].append(bullet)
+                bullets.append(bullet)
+            headers.append({'text': name, 'page_num': header_idx // 4 + 1, 'section_text': bullets})
+        pdf_id = f"synthetic_{note_idx:05d}.pdf"
+        files.append((f"note_{note_idx:05d}", {pdf_id: {'pdf_id': pdf_id, 'headers': headers}}))
+    return files
+
+
+def write_corpus(directory, files, file_format='json'):
+    """
+    Writes generated notes to directory as .json or .notes files.
+
+    Returns:
+        paths (list): Paths of the written files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for stem, data in files:
+        if file_format == 'json':
+            path = os.path.join(directory, f"{stem}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+        elif file_format == 'notes':
+            path = os.path.join(directory, f"{stem}{NOTE_FILE_EXTENSION}")
+            write_note_table(path, notes_from_json_data(data, os.path.basename(path)))
+        else:
+            raise ValueError(f"Unknown file_format '{file_format}'. Use 'json' or 'notes'.")
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic note corpus from the sample notes.")
+    parser.add_argument('output_dir')
+    parser.add_argument('--notes', type=int, default=100)
+    parser.add_argument('--headers', type=int, default=8)
+    parser.add_argument('--bullets', type=int, default=6)
+    parser.add_argument('--duplicate-rate', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--format', choices=['json', 'notes'], default='json')
+    args = parser.parse_args()
+
+    files = generate_notes(args.notes, args.headers, args.bullets, args.duplicate_rate, args.seed)
+    paths = write_corpus(args.output_dir, files, args.format)
+    print(f"Wrote {len(paths)} note files to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,25 @@
 # test_client.py
 
 import logging
-import json
 import time
-import nltk
 import os
-from merge_logic import load_notes_from_files, merge_multiple_notes
+import argparse
+from merge_logic import load_notes_from_files, iter_merged_headers
+from merge_output import MergedResultsJSONWriter, MergedTextWriter, write_merge_stream
+from pipeline_metrics import PipelineMetrics, PipelineProfiler, metrics_stage, format_profile_report
+from tracing import configure_tracing
 
 # Adjust the directory to point to the directory where your JSON files are located
 directory = os.path.join(os.path.dirname(__file__), 'test_files')  # Assuming 'test_files' is in the same directory
 
 def configure_logging():
     """
-    Configures logging to write to debug.log with INFO and DEBUG levels.
-    Overwrites the debug.log file each time the script runs.
+    Configures logging to write stage-level messages to debug.log.
+    Overwrites the debug.log file each time the script runs. Per-sentence details are
+    traced instead (see --trace), since formatting them slows the merge down.
     """
     logging.basicConfig(
-        level=logging.DEBUG,  # Set to DEBUG to capture all logs
+        level=logging.INFO,
         format="%(asctime)s - %(levelname)s - %(message)s",
         handlers=[
             logging.FileHandler("debug.log", mode='w')  # Overwrite debug.log each time
@@ -28,12 +31,26 @@ def main():
     """
     Main function to run the complex test by merging multiple notes from JSON files.
     Measures execution time, logs the process, and saves results to 'merged_results.json'.
+    With --metrics, per-stage timings and counters are added to it under "metrics".
     """
-    configure_logging()
+    parser = argparse.ArgumentParser(description="Merge the notes in test_files.")
+    parser.add_argument('--metrics', action='store_true', help="Write pipeline metrics into merged_results.json")
+    parser.add_argument('--trace', default=None, metavar='LEVELS',
+                        help="Stages to trace, e.g. 'deduplication=info,preprocess=debug' or '*=debug'")
+    parser.add_argument('--trace-file', default='merge_trace.ndjson')
+    parser.add_argument('--trace-sample', type=float, default=1.0, help="Fraction of trace records kept")
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help="Profile every stage (cProfile, tracemalloc, peak RSS) and save the results to DIR")
+    args = parser.parse_args()
+    metrics = None
+    if args.profile:
+        metrics = PipelineProfiler()
+    elif args.metrics:
+        metrics = PipelineMetrics()
 
-    # Download necessary NLTK data
-    nltk.download('stopwords', quiet=True)
-    nltk.download('wordnet', quiet=True)
+    configure_logging()
+    if args.trace:
+        configure_tracing(args.trace, args.trace_file, args.trace_sample, truncate=True)
 
     # Start timer
     start_time = time.time()
@@ -41,7 +58,8 @@ def main():
     print("Starting the merging process...")
 
     # Load all notes from JSON files in 'test_files' directory
-    notes = load_notes_from_files(directory)
+    with metrics_stage(metrics, 'load'):
+        notes = load_notes_from_files(directory)
 
     if not notes:
         logging.info("No note files found. Exiting.")
@@ -49,45 +67,13 @@ def main():
 
     output_file = "merged_results.json"
 
-    # Perform deduplication-based merging for multiple notes
-    merged_text, merged_headers, sentence_to_sources = merge_multiple_notes(notes)
-
-    # Structure the merged results to include conflicts for manual resolution
-    headers_output = []
-    for merged_header in merged_headers:
-        header_name = merged_header['header_name']
-        header_id = merged_header['header_id']
-        note_id = merged_header['note_id']
-        conflicts = merged_header['conflicts']
-        bullets_output = []
-        for bullet_info in merged_header['bullets']:
-            bullet_note_id, bullet_id, bullet_text, _ = bullet_info
-            data = merged_header['bullet_to_sources'][bullet_text]
-            bullets_output.append({
-                "bullet_id": f"{bullet_note_id}_{bullet_id}",
-                "accepted_bullet_text": data["text"],
-                "conflicting_bullets": data["conflicts"]
-            })
-        headers_output.append({
-            "header_id": header_id,
-            "accepted_header_name": header_name,
-            "note_id": note_id,
-            "conflicting_headers": conflicts,
-            "bullets": bullets_output
-        })
-
-    # Create the merged_results dictionary
-    merged_results = {
-        "headers": headers_output
-    }
-
-    # Write the comprehensive results to the output JSON file
-    with open(output_file, "w", encoding='utf-8') as f:
-        json.dump(merged_results, f, indent=4)
-
-    # Write the merged text to 'defaultmerge.txt' with actual line breaks
-    with open("defaultmerge.txt", "w", encoding='utf-8') as f:
-        f.write(merged_text)
+    # Merge the notes and write each header group to both files as soon as it is deduplicated:
+    # the results JSON (with conflicts for manual resolution) and 'defaultmerge.txt'
+    with open(output_file, "w", encoding='utf-8') as results_f, open("defaultmerge.txt", "w", encoding='utf-8') as text_f:
+        write_merge_stream(iter_merged_headers(notes, metrics=metrics),
+                           [MergedResultsJSONWriter(results_f, metrics=metrics if args.metrics else None),
+                            MergedTextWriter(text_f)],
+                           metrics=metrics)
 
     # End timer and calculate the duration
     end_time = time.time()
@@ -97,5 +83,9 @@ def main():
     print(f"Merged text saved to defaultmerge.txt")
     print(f"Time taken for the merging process: {time_taken:.4f} seconds")
 
+    if args.profile:
+        print(format_profile_report(metrics.save(args.profile)))
+        print(f"Profile saved to {args.profile}")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,58 @@
+# test_header_grouping.py
+#
+# Tests for the blocked header name comparison: linked_name_pairs must find the same pairs
+# as a dense comparison, and stay near its memory ceiling when most pairs pass the
+# similarity threshold but few share enough words.
+#
+# Usage: python -m pytest test_header_grouping.py
+
+import random
+import tracemalloc
+import numpy as np
+import pytest
+from header_grouping import header_token_matrix, overlap_ratios, linked_name_pairs
+
+
+@pytest.fixture
+def dense_candidates():
+    # Non-negative random vectors have cosine similarity around 0.75, so with a 0.5 threshold
+    # nearly every pair is a candidate; names of 3 words from 2000 rarely share one
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(2000)]
+    names = list(dict.fromkeys(' '.join(rng.sample(words, 3)) for _ in range(1500)))
+    vectors = np.random.RandomState(0).rand(len(names), 32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return names, vectors.astype(np.float32)
+
+
+def dense_linked_pairs(names, vectors, similarity_threshold, overlap_threshold):
+    scores = (vectors.astype(np.float64) @ vectors.astype(np.float64).T).astype(np.float32)
+    rows, cols = np.nonzero(np.triu(scores >= similarity_threshold))
+    tokens, sizes = header_token_matrix(names)
+    keep = overlap_ratios(tokens, sizes, rows, cols) >= overlap_threshold
+    return set(zip(rows[keep].tolist(), cols[keep].tolist()))
+
+
+def test_matches_dense_comparison(dense_candidates):
+    names, vectors = dense_candidates
+    names, vectors = names[:400], vectors[:400]
+    expected = dense_linked_pairs(names, vectors, 0.5, 0.3)
+    for max_memory in (1 << 16, 1 << 20, 1 << 28):
+        rows, cols, _ = linked_name_pairs(names, vectors, 0.5, 0.3, max_memory=max_memory)
+        assert set(zip(rows.tolist(), cols.tolist())) == expected
+
+
+def test_peak_memory_stays_near_ceiling(dense_candidates):
+    names, vectors = dense_candidates
+    max_memory = 1 << 20
+    linked_name_pairs(names[:10], vectors[:10], 0.5, 0.3, max_memory=max_memory)  # imports scipy.sparse
+    tracemalloc.start()
+    try:
+        rows, cols, similarities = linked_name_pairs(names, vectors, 0.5, 0.3, max_memory=max_memory)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # Over a million candidate pairs, of which only the linked ones may be held
+    assert len(rows) < 20000
+    output = rows.nbytes + cols.nbytes + similarities.nbytes
+    assert peak - 2 * output < 4 * max_memory
@@ -0,0 +1,150 @@
+# test_merge_state.py
+#
+# Regression tests for the incremental merge: adding notes to a MergeState in any order, removing
+# them, syncing with a directory or saving and loading the state in between must give the same
+# result as merging the remaining notes all at once with merge_multiple_notes.
+#
+# Usage: python -m pytest test_merge_state.py
+
+import os
+import json
+import random
+import pytest
+from embedding import set_embedding_backend
+from merge_logic import merge_multiple_notes, format_merged_results, load_notes_from_files
+from merge_state import MERGE_STATE_VERSION, MergeState, load_or_create_merge_state
+from note_format import notes_from_json_data
+from preprocess import preprocess_sentence
+from synthetic_notes import generate_notes
+
+
+def comparable(result):
+    """
+    A merge result as JSON, without header ids (MergeState keeps the ids assigned on add).
+    """
+    merged_text, merged_headers, sentence_to_sources = result
+
+    def strip_ids(value):
+        if isinstance(value, dict):
+            return {key: strip_ids(item) for key, item in value.items() if key != 'header_id'}
+        if isinstance(value, list):
+            return [strip_ids(item) for item in value]
+        return value
+    return json.dumps(strip_ids([merged_text, format_merged_results(merged_headers), sentence_to_sources]),
+                      sort_keys=True, default=float)
+
+
+@pytest.fixture
+def synthetic_files(monkeypatch):
+    try:
+        preprocess_sentence("Checking that the NLTK data is available.")
+    except LookupError as e:
+        pytest.skip(str(e))
+    # The random backend, a high duplicate rate and no persistent cache: this corpus retains the
+    # same bullet text in two slots of a group, which used to lose conflicts or raise KeyError
+    monkeypatch.setenv('EMBEDDING_CACHE_DIR', '')
+    set_embedding_backend('random')
+    return [(f"{stem}.json", data) for stem, data in generate_notes(40, 8, 6, duplicate_rate=0.5, seed=3)]
+
+
+@pytest.fixture
+def synthetic_notes(synthetic_files):
+    notes = []
+    for file_name, data in synthetic_files:
+        notes.extend(notes_from_json_data(data, file_name))
+    notes.sort(key=lambda note: note['note_num'])
+    return notes
+
+
+def write_note_files(directory, files):
+    for file_name, data in files:
+        with open(os.path.join(directory, file_name), 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+
+def test_added_in_random_order_matches_batch_merge(synthetic_notes):
+    expected = comparable(merge_multiple_notes(synthetic_notes))
+    rng = random.Random(0)
+    for _ in range(2):
+        order = list(synthetic_notes)
+        rng.shuffle(order)
+        merge_state = MergeState()
+        for note in order:
+            merge_state.add_note(note)
+        assert comparable(merge_state.result()) == expected
+
+
+def test_batched_engine_matches_sequential(synthetic_notes):
+    expected = comparable(merge_multiple_notes(synthetic_notes))
+    assert comparable(merge_multiple_notes(synthetic_notes, dedup_engine='batched')) == expected
+
+
+def test_removed_notes_match_batch_merge_of_the_rest(synthetic_notes):
+    merge_state = MergeState()
+    for note in synthetic_notes:
+        merge_state.add_note(note)
+    note_nums = sorted({note['note_num'] for note in synthetic_notes})
+    removed = set(random.Random(1).sample(note_nums, 8))
+    for note_num in removed:
+        merge_state.remove_note(note_num)
+    remaining = [note for note in synthetic_notes if note['note_num'] not in removed]
+    assert comparable(merge_state.result()) == comparable(merge_multiple_notes(remaining))
+
+
+def test_sync_directory_follows_added_changed_and_deleted_files(synthetic_files, tmp_path):
+    files, later_files = synthetic_files[:30], synthetic_files[30:]
+    write_note_files(tmp_path, files)
+    merge_state = MergeState()
+    merge_state.sync_directory(tmp_path)
+    assert comparable(merge_state.result()) == comparable(merge_multiple_notes(load_notes_from_files(tmp_path)))
+
+    # Replace one file's notes with another note's, delete two files and add the rest
+    write_note_files(tmp_path, [(files[0][0], later_files[0][1])])
+    for file_name, _ in files[1:3]:
+        os.remove(os.path.join(tmp_path, file_name))
+    write_note_files(tmp_path, later_files[1:])
+    changed = merge_state.sync_directory(tmp_path)
+    assert changed and all(group_id in merge_state.groups for group_id in changed)
+    assert comparable(merge_state.result()) == comparable(merge_multiple_notes(load_notes_from_files(tmp_path)))
+    assert merge_state.sync_directory(tmp_path) == []
+
+
+def test_loaded_state_matches_batch_merge_after_more_notes(synthetic_notes, tmp_path):
+    note_nums = sorted({note['note_num'] for note in synthetic_notes})
+    first = set(note_nums[:25])
+    merge_state = MergeState()
+    for note in synthetic_notes:
+        if note['note_num'] in first:
+            merge_state.add_note(note)
+    merge_state.save(tmp_path)
+    # A second save writes only what changed since the first
+    merge_state.remove_note(note_nums[0])
+    merge_state.save(tmp_path)
+
+    loaded = MergeState.load(tmp_path)
+    assert comparable(loaded.result()) == comparable(merge_state.result())
+    for note in synthetic_notes:
+        if note['note_num'] not in first:
+            loaded.add_note(note)
+    remaining = [note for note in synthetic_notes if note['note_num'] != note_nums[0]]
+    assert comparable(loaded.result()) == comparable(merge_multiple_notes(remaining))
+
+
+def test_state_of_another_version_is_not_loaded(synthetic_notes, tmp_path):
+    merge_state = MergeState()
+    for note in synthetic_notes[:20]:
+        merge_state.add_note(note)
+    merge_state.save(tmp_path)
+    state_path = os.path.join(tmp_path, 'state.json')
+    with open(state_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    state['version'] = MERGE_STATE_VERSION - 1
+    with open(state_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+
+    assert MergeState.load(tmp_path) is None
+    merge_state = load_or_create_merge_state(tmp_path)
+    assert not merge_state.notes and not merge_state.groups
+    # The outdated group files are removed on the next save
+    merge_state.save(tmp_path)
+    assert os.listdir(os.path.join(tmp_path, 'groups')) == []
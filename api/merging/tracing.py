@@ -0,0 +1,214 @@
+# tracing.py
+#
+# Structured tracing for the hot loops of the merge (preprocessing, FAISS, deduplication).
+# Records are compact JSON lines such as
+#   {"ts":1700000000.123,"pid":42,"stage":"deduplication","event":"discard","text":"...","similarity":0.91}
+# and are only built for stages and levels that are switched on. A loop looks up its trace
+# function once with tracer_for and tests it before each record, so a disabled stage costs one
+# truth test per iteration and no string formatting.
+#
+# Configured from the environment when first imported, or with configure_tracing:
+#   MERGE_TRACE          Stage levels, e.g. "deduplication=debug,preprocess=info" or "*=info".
+#                        Unset or empty disables tracing.
+#   MERGE_TRACE_FILE     Output file, appended to (default: merge_trace.ndjson)
+#   MERGE_TRACE_SAMPLE   Fraction of records kept, between 0 and 1 (default: 1)
+#
+# Worker processes inherit the configuration and append to the same file. Records are
+# buffered and written in whole lines, so lines from different processes never interleave.
+
+import os
+import json
+import time
+import atexit
+import random
+import threading
+
+DEBUG = 10
+INFO = 20
+LEVELS = {'debug': DEBUG, 'info': INFO}
+DEFAULT_TRACE_FILE = 'merge_trace.ndjson'
+# Records held per process before they are written
+BUFFER_RECORDS = 1024
+
+
+def parse_levels(spec):
+    """
+    Parses "stage=level,..." into {stage: level}. A stage without a level is traced at debug.
+    """
+    levels = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        stage, _, level = item.partition('=')
+        level = level.strip().lower() or 'debug'
+        if level not in LEVELS:
+            raise ValueError(f"Unknown trace level '{level}'. Use {' or '.join(LEVELS)}.")
+        levels[stage.strip()] = LEVELS[level]
+    return levels
+
+
+def json_default(value):
+    # numpy scalars, e.g. FAISS similarities
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+class Tracer:
+    """
+    Buffers trace records and appends them to a file as JSON lines.
+    """
+    def __init__(self, path, levels, sample_rate=1.0, seed=None):
+        self.path = path
+        self.levels = levels
+        self.sample_rate = sample_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.pid = os.getpid()
+
+    def enabled(self, stage, level):
+        threshold = self.levels.get(stage, self.levels.get('*'))
+        return threshold is not None and level >= threshold
+
+    def emit(self, stage, event, fields):
+        if self.sample_rate < 1 and self.random.random() >= self.sample_rate:
+            return
+        record = {'ts': round(time.time(), 6), 'pid': self.pid, 'stage': stage, 'event': event}
+        record.update(fields)
+        line = json.dumps(record, separators=(',', ':'), ensure_ascii=False, default=json_default)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= BUFFER_RECORDS:
+                self.flush_locked()
+
+    def flush_locked(self):
+        if not self.buffer:
+            return
+        data = ('\n'.join(self.buffer) + '\n').encode('utf-8')
+        self.buffer = []
+        # One append per batch of whole lines; os.write may write less than it was given
+        # (e.g. when interrupted by a signal), so the rest is written until none is left
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def reset_after_fork(self):
+        # Records buffered by the parent are the parent's to write
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.pid = os.getpid()
+        # Otherwise every worker would sample the same records as the parent and each other;
+        # with a seed, each process's sample is still repeatable
+        if self.seed is None:
+            self.random.seed(os.urandom(16))
+        else:
+            self.random.seed(f"{self.seed}:{self.pid}")
+
+
+# The active tracer, or None when tracing is off
+tracer = None
+# Whether any stage is traced; hot paths that cannot hold a trace function test this first
+active = False
+# (stage, level) -> trace function or None
+_trace_functions = {}
+
+
+def configure_tracing(levels=None, path=None, sample_rate=1.0, seed=None, truncate=False):
+    """
+    Switches tracing on for the given stages, or off when levels is empty.
+
+    Parameters:
+        levels (dict or str): Stage -> level (DEBUG or INFO), or a MERGE_TRACE string.
+            The stage '*' sets the level of every stage not listed.
+        path (str): File the records are appended to (default: merge_trace.ndjson).
+        sample_rate (float): Fraction of records kept, chosen at random.
+        seed (int): Seed for the sampling, for repeatable samples. Forked processes are
+            reseeded from it and their pid, so they do not repeat the parent's sample.
+        truncate (bool): Empty the file first.
+
+    Returns:
+        tracer (Tracer): The active tracer, or None if tracing is off.
+    """
+    global tracer, active
+    if isinstance(levels, str):
+        levels = parse_levels(levels)
+    if not 0 <= sample_rate <= 1:
+        raise ValueError(f"sample_rate must be between 0 and 1, got {sample_rate}.")
+    if tracer is not None:
+        tracer.flush()
+    _trace_functions.clear()
+    if not levels or sample_rate == 0:
+        tracer, active = None, False
+        return None
+    path = path or DEFAULT_TRACE_FILE
+    if truncate:
+        open(path, 'w').close()
+    tracer, active = Tracer(path, dict(levels), sample_rate, seed), True
+    return tracer
+
+
+def configure_from_environment():
+    return configure_tracing(
+        os.environ.get('MERGE_TRACE', ''),
+        os.environ.get('MERGE_TRACE_FILE') or None,
+        float(os.environ.get('MERGE_TRACE_SAMPLE', 1))
+    )
+
+
+def tracer_for(stage, level=DEBUG):
+    """
+    Returns a function trace(event, **fields) that records events of a stage at a level, or
+    None if they are not traced. Look it up once outside a loop and test it inside:
+
+        trace = tracer_for('deduplication')
+        for ...:
+            if trace:
+                trace('compare', similarity=sim)
+    """
+    key = (stage, level)
+    if key not in _trace_functions:
+        trace = None
+        if tracer is not None and tracer.enabled(stage, level):
+            current = tracer
+
+            def trace(event, **fields):
+                current.emit(stage, event, fields)
+        _trace_functions[key] = trace
+    return _trace_functions[key]
+
+
+def trace_event(stage, event, level=DEBUG, **fields):
+    """
+    Records one event if its stage and level are traced. For call sites outside loops; test
+    tracing.active first so nothing is looked up while tracing is off.
+    """
+    trace = tracer_for(stage, level)
+    if trace:
+        trace(event, **fields)
+
+
+def flush_tracing():
+    """
+    Writes buffered records of this process. Called at exit, and by process pool workers
+    after each task since they may be stopped without running exit handlers.
+    """
+    if tracer is not None:
+        tracer.flush()
+
+
+def _reset_after_fork():
+    if tracer is not None:
+        tracer.reset_after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush_tracing)
+configure_from_environment()
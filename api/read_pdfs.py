@@ -4,80 +4,126 @@ import os
 import asyncio
 import json
 import re
-
-async def extract_headers(words, normal_font_size, size_threshold):
+import bisect
+import numpy as np
+import logging
+import shutil
+import hashlib
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pdfminer.pdftypes import resolve1
+
+# The note file format and pipeline metrics are shared with the merging code. merging/ is
+# imported as a namespace package; both modules depend only on the standard library and NumPy,
+# not on the flat imports the other merging modules use between themselves.
+from merging.pipeline_metrics import PipelineProfiler, metrics_stage, format_profile_report
+
+# Bump when the extraction output changes so stale cache entries are ignored
+EXTRACTION_CACHE_VERSION = 2
+
+# Extraction cache lookups in this process, read before and after a PDF to count its hits
+cache_stats = {'hits': 0, 'misses': 0}
+
+def words_to_arrays(words):
+    """
+    Loads the rounded font sizes and doctops of a page's words into NumPy arrays.
+    Sizes are rounded with Python's round so they match the per-word values exactly.
+    """
+    sizes = np.array([round(word['size'], 1) for word in words], dtype=np.float64)
+    doctops = np.array([word['doctop'] for word in words], dtype=np.float64)
+    return sizes, doctops
+
+
+def most_common_size(sizes):
+    """
+    Returns the most common font size, breaking ties by first occurrence like Counter.most_common.
+    """
+    values, first_index, counts = np.unique(sizes, return_index=True, return_counts=True)
+    best = np.flatnonzero(counts == counts.max())
+    return float(values[best[np.argmin(first_index[best])]])
+
+
+def detect_headers(words, sizes, doctops, normal_font_size, size_threshold):
+    """
+    Finds header runs with array operations instead of a per-word loop.
+
+    A header is a run of consecutive words whose size is at least normal_font_size * size_threshold.
+    A new run starts when the gap to the previous header-sized word is more than 5 points
+    or when the size moves 0.1 or more away from the size of the run's first word.
+
+    Parameters:
+        words (list): Words from page.extract_words.
+        sizes (numpy array): Rounded font size of each word (see words_to_arrays).
+        doctops (numpy array): Doctop of each word.
+        normal_font_size (float): Body font size of the page or document.
+        size_threshold (float): Font size ratio above which a word is treated as a header.
+
+    Returns:
+        headers (list of dicts): {'text', 'doctop'} for each header, in reading order.
+    """
+    candidates = np.flatnonzero(sizes >= normal_font_size * size_threshold)
+    if candidates.size == 0:
+        return []
+    c_sizes = sizes[candidates]
+
+    # A large vertical gap to the previous header-sized word always starts a new header
+    starts = np.empty(candidates.size, dtype=bool)
+    starts[0] = True
+    starts[1:] = np.abs(np.diff(doctops[candidates])) > 5
+
+    # Within a gap-delimited segment the size is compared with the size of the header's first
+    # word, which is sequential; only segments that actually mix sizes need the loop
+    segment_starts = np.flatnonzero(starts)
+    segment_ids = np.cumsum(starts) - 1
+    mixed = np.unique(segment_ids[c_sizes != c_sizes[segment_starts[segment_ids]]])
+    segment_ends = np.append(segment_starts[1:], candidates.size)
+    for segment in mixed:
+        current_size = c_sizes[segment_starts[segment]]
+        for k in range(segment_starts[segment] + 1, segment_ends[segment]):
+            if not abs(c_sizes[k] - current_size) < 0.1:
+                starts[k] = True
+                current_size = c_sizes[k]
+
+    run_starts = np.flatnonzero(starts).tolist()
+    run_ends = run_starts[1:] + [candidates.size]
+    candidates = candidates.tolist()
     headers = []
-    current_header = ''
-    current_size = None
-    current_doctop = None
-    last_doctop = None  # Track the position of the last processed word
-
-    for word in words:
-        text = word['text']
-        size = round(word['size'], 1)
-        doctop = word['doctop']
-
-        # Detect headers based on size
-        if size >= normal_font_size * size_threshold:
-            # If this is the first word of the header or the size is consistent with the current header
-            if current_size is None or abs(size - current_size) < 0.1:
-                # If this is the first word of a new header (detect via significant doctop gap)
-                if current_header == '' or (last_doctop is not None and abs(doctop - last_doctop) > 5):  # Small gap for continuing a header
-                    # Append the previous header if it's already populated
-                    if current_header:
-                        headers.append({
-                            'text': current_header.strip(),
-                            'doctop': current_doctop
-                        })
-                        current_header = ''
-
-                    # Start a new header
-                    current_header = text
-                    current_size = size
-                    current_doctop = doctop
-                else:
-                    # Continue appending words to the current header if on the same line
-                    current_header += ' ' + text
-            else:
-                # Size has changed, so it's likely a new header
-                headers.append({
-                    'text': current_header.strip(),
-                    'doctop': current_doctop
-                })
-                current_header = text
-                current_size = size
-                current_doctop = doctop
-
-            last_doctop = doctop  # Update last word position
-
-    # Append the last header if it exists
-    if current_header:
+    for run_start, run_end in zip(run_starts, run_ends):
         headers.append({
-            'text': current_header.strip(),
-            'doctop': current_doctop
+            'text': ' '.join(words[i]['text'] for i in candidates[run_start:run_end]).strip(),
+            'doctop': words[candidates[run_start]]['doctop']
         })
-
     return headers
 
 
+async def extract_headers(words, normal_font_size, size_threshold):
+    sizes, doctops = words_to_arrays(words)
+    return detect_headers(words, sizes, doctops, normal_font_size, size_threshold)
+
+
 def extract_sections(page, headers):
     sections = []
     # Add a sentinel header at the end to capture text after the last header
     headers.append({'text': None, 'doctop': float('inf')})
 
-    # Get all text elements with their positions
+    # Section text is read in text-flow order, which follows the PDF's content stream, so it
+    # needs its own pass; the characters themselves are already cached by the header pass
     page_words = page.extract_words(use_text_flow=True, extra_attrs=["doctop"])
     text_elements = [{'text': word['text'], 'doctop': word['doctop']} for word in page_words]
 
+    # Sort word positions once so each header range can be found with a binary search
+    order = sorted(range(len(text_elements)), key=lambda k: text_elements[k]['doctop'])
+    sorted_doctops = [text_elements[k]['doctop'] for k in order]
+
     for i in range(len(headers) - 1):
         start_doctop = headers[i]['doctop']
         end_doctop = headers[i + 1]['doctop']
 
-        # Collect text between current header and next header
-        section_text = []
-        for element in text_elements:
-            if start_doctop < element['doctop'] < end_doctop:
-                section_text.append(element['text'])
+        # Collect text strictly between current header and next header, in text-flow order
+        lo = bisect.bisect_right(sorted_doctops, start_doctop)
+        hi = bisect.bisect_left(sorted_doctops, end_doctop)
+        section_text = [text_elements[k]['text'] for k in sorted(order[lo:hi])]
 
         # Combine text and parse bullet points
         combined_text = ' '.join(section_text)
@@ -96,91 +142,245 @@ def extract_sections(page, headers):
     return sections
 
 
-def parse_bullet_points(text):
-    # Bullet patterns including their Unicode equivalents
-    bullet_patterns = [
-        r'(\s*[-]\s+)',               # Matches dash bullet (-) 
-        r'(\s*\u2022\s+)',            # Matches bullet point (•) (Unicode: \u2022)
-        r'(\s*\u25cb\s+)',            # Matches empty bullet point (Unicode: \u25cb)
-        r'(\s*\u25aa\s+)',            # Matches black small square bullet (▪) (Unicode: \u25aa)
-        r'(\s*\u25cf\s+)',            # Matches black circle bullet (●) (Unicode: \u25cf)
-        r'(\s*\d+\.\s+)',             # Matches numbered lists (1. 2. 3.)
-        r'(\s*\u2043\s+)'             # Matches hyphen bullet (⁃) (Unicode: \u2043)
-    ]
-
-    # Combine all bullet patterns into one regex to split the text
-    combined_bullet_pattern = '|'.join(bullet_patterns)
-
-    # Split the text based on bullet points and remove empty strings
-    segments = re.split(combined_bullet_pattern, text)
-
-    # Filter out None or empty segments caused by invalid splits
-    segments = [segment.strip() for segment in segments if segment and segment.strip()]
-
-    parsed_sections = []
-    current_entry = ''
-
-    for segment in segments:
-        # Check if this segment is likely a bullet point starter (including unicode characters)
-        if re.match(r'^[-\u2022\u25cb\u25aa\u25cf\u2043]|^\d+\.', segment):
-            # If we have accumulated text, store it as an entry
+# Bullet markers including their Unicode equivalents, compiled once at import time:
+# dash (-), bullet (\u2022), empty bullet (\u25cb), black small square (\u25aa),
+# black circle (\u25cf), hyphen bullet (\u2043) and numbered lists (1. 2. 3.)
+BULLET_MARKER_RE = re.compile(r'\s*(?:[-\u2022\u25cb\u25aa\u25cf\u2043]|\d+\.)\s+')
+BULLET_START_RE = re.compile(r'[-\u2022\u25cb\u25aa\u25cf\u2043]|\d+\.')
+UNICODE_BULLET_TABLE = str.maketrans('', '', '\u2022\u25cb\u25aa\u25cf\u2043')
+
+# Nesting level reported for each kind of bullet marker; numbered items are top level
+BULLET_LEVELS = {
+    'numbered': 0,
+    '-': 1,
+    '\u2022': 1,
+    '\u25cf': 1,
+    '\u25cb': 2,
+    '\u2043': 2,
+    '\u25aa': 3,
+}
+
+
+def tokenize_bullets(text):
+    """
+    Splits section text into bullet entries in a single pass over the bullet markers.
+
+    Parameters:
+        text (str): Combined text of a section.
+
+    Returns:
+        entries (list of tuples): (level, entry_text) for every non-empty entry, where level
+            is the nesting level of the entry's bullet marker (see BULLET_LEVELS) and 0 for
+            text that does not start with a marker.
+    """
+    entries = []
+    current_entry = None
+    current_level = 0
+    pos = 0
+
+    def add_segment(segment):
+        nonlocal current_entry, current_level
+        segment = segment.strip()
+        if not segment:
+            return
+        start = BULLET_START_RE.match(segment)
+        if start:
+            # A bullet marker starts a new entry
             if current_entry:
-                parsed_sections.append(current_entry.strip())
-                current_entry = ''
+                entries.append((current_level, current_entry))
             current_entry = segment
+            marker = start.group()
+            current_level = BULLET_LEVELS['numbered' if marker[0].isdigit() else marker]
+        elif current_entry is None:
+            current_entry = segment
+            current_level = 0
         else:
-            # If it's part of an ongoing bullet point or subpoint, append it
+            # Part of an ongoing bullet point or subpoint
             current_entry += ' ' + segment
 
+    for match in BULLET_MARKER_RE.finditer(text):
+        add_segment(text[pos:match.start()])
+        add_segment(match.group())
+        pos = match.end()
+    add_segment(text[pos:])
+
     # Add the last accumulated entry
     if current_entry:
-        parsed_sections.append(current_entry.strip())
-
-    # Remove dashes that appear at the start of an entry, but preserve mid-sentence dashes
-    parsed_sections = [re.sub(r'^\s*-\s*', '', entry) for entry in parsed_sections]
-
-    # Remove any Unicode bullet characters that remain in the actual text
-    unicode_bullet_removal = r'[\u2022\u25cb\u25aa\u25cf\u2043]'
-    parsed_sections = [re.sub(unicode_bullet_removal, '', entry) for entry in parsed_sections]
+        entries.append((current_level, current_entry))
 
-    # Filter out headers or entries with no text content
-    parsed_sections = [entry for entry in parsed_sections if entry.strip()]
+    cleaned = []
+    for level, entry in entries:
+        # Remove dashes that appear at the start of an entry, but preserve mid-sentence dashes
+        if entry[0] == '-':
+            entry = entry[1:].lstrip()
+        # Remove any Unicode bullet characters that remain in the actual text
+        entry = entry.translate(UNICODE_BULLET_TABLE)
+        # Filter out headers or entries with no text content
+        if entry.strip():
+            cleaned.append((level, entry))
+    return cleaned
 
-    return parsed_sections
 
-
-async def process_pdf(pdf_path, size_threshold=1.2):
-    hierarchy = []
-
-    with pdfplumber.open(pdf_path) as pdf:
-        for page_number, page in enumerate(pdf.pages):
+def parse_bullet_points(text):
+    return [entry for _, entry in tokenize_bullets(text)]
+
+
+def file_cache_key(pdf_path, size_threshold, body_font_size='page'):
+    """
+    Content hash of the whole PDF file plus the extraction settings.
+    """
+    h = hashlib.sha256()
+    with open(pdf_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(f"|{size_threshold}|{body_font_size}|{EXTRACTION_CACHE_VERSION}".encode())
+    return h.hexdigest()
+
+def page_cache_key(page, size_threshold, normal_font_size=None):
+    """
+    Content hash of a page's content streams plus the extraction settings.
+    Reading the raw streams does not trigger pdfplumber's layout analysis.
+    normal_font_size is only part of the key when a document-wide body size is used.
+    """
+    h = hashlib.sha256()
+    contents = resolve1(page.page_obj.contents) or []
+    for stream in contents:
+        h.update(resolve1(stream).get_data())
+    h.update(f"|{size_threshold}|{EXTRACTION_CACHE_VERSION}".encode())
+    if normal_font_size is not None:
+        h.update(f"|{normal_font_size}".encode())
+    return h.hexdigest()
+
+def cache_entry_path(cache_dir, kind, key):
+    return os.path.join(cache_dir, kind, f"{key}.json")
+
+def load_cache_entry(cache_dir, kind, key):
+    path = cache_entry_path(cache_dir, kind, key)
+    if not os.path.exists(path):
+        cache_stats['misses'] += 1
+        return None
+    cache_stats['hits'] += 1
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_cache_entry(cache_dir, kind, key, data):
+    path = cache_entry_path(cache_dir, kind, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to a temporary file first so concurrent workers never see a partial entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def document_font_size(pdf):
+    """
+    Most common rounded word size across every page of an open PDF.
+    Costs an extra word-extraction pass; each page's cache is released as it goes.
+    """
+    size_counts = Counter()
+    for page in pdf.pages:
+        try:
             words = page.extract_words(extra_attrs=["fontname", "size", "top", "doctop"])
-            if not words:
-                continue  # Skip pages without words
-
-            # Determine normal font size
-            font_sizes = [round(word['size'], 1) for word in words if 'size' in word]
-            if not font_sizes:
-                continue
-            normal_font_size = Counter(font_sizes).most_common(1)[0][0]
-
-            # Extract headers
-            headers = await extract_headers(words, normal_font_size, size_threshold)
-
-            if not headers:
-                continue  # Skip pages without headers
+            size_counts.update(round(word['size'], 1) for word in words)
+        finally:
+            page.close()
+    if not size_counts:
+        return None
+    return size_counts.most_common(1)[0][0]
+
+async def extract_page_sections(page, size_threshold=1.2, normal_font_size=None):
+    """
+    Extracts the sections of a single page. Returns an empty list for pages
+    without words or headers.
+
+    normal_font_size is the body font size to compare header candidates against;
+    if None, the most common size on this page is used.
+    """
+    words = page.extract_words(extra_attrs=["fontname", "size", "top", "doctop"])
+    if not words:
+        return []  # Skip pages without words
+
+    # Load sizes and positions into arrays once for both the body size and header detection
+    sizes, doctops = words_to_arrays(words)
+    if normal_font_size is None:
+        normal_font_size = most_common_size(sizes)
+
+    # Extract headers
+    headers = detect_headers(words, sizes, doctops, normal_font_size, size_threshold)
+
+    if not headers:
+        return []  # Skip pages without headers
+
+    # Extract sections based on headers
+    return extract_sections(page, headers)
+
+async def iter_pdf_sections(pdf_path, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    """
+    Yields the sections of a PDF page by page as they are extracted.
+    Each page's cached layout objects are released as soon as the page is done,
+    so memory use does not grow with the length of the document.
+
+    If cache_dir is given, extraction results are cached on disk by content hash:
+    an unchanged PDF is served without opening it, and a revised PDF only
+    re-extracts the pages whose content streams changed.
+
+    body_font_size selects how the normal font size is estimated: 'page' uses the
+    most common size on each page, 'document' uses the most common size across the
+    whole PDF so the header threshold is stable from page to page.
+    """
+    file_key = None
+    if cache_dir is not None:
+        file_key = file_cache_key(pdf_path, size_threshold, body_font_size)
+        page_keys = load_cache_entry(cache_dir, 'files', file_key)
+        if page_keys is not None and all(
+                os.path.exists(cache_entry_path(cache_dir, 'pages', key)) for key in page_keys):
+            logging.debug(f"Extraction cache hit for {pdf_path}")
+            for page_number, page_key in enumerate(page_keys):
+                for section in load_cache_entry(cache_dir, 'pages', page_key):
+                    yield {
+                        'text': section['header'],
+                        'page_num': page_number + 1,
+                        'section_text': section['section_text'],
+                    }
+            return
+
+    page_keys = []
+    with pdfplumber.open(pdf_path) as pdf:
+        normal_font_size = None
+        if body_font_size == 'document':
+            normal_font_size = document_font_size(pdf)
+            if normal_font_size is None:
+                return  # No words anywhere in the document
 
-            # Extract sections based on headers
-            sections = extract_sections(page, headers)
+        for page_number, page in enumerate(pdf.pages):
+            sections = None
+            if cache_dir is not None:
+                page_key = page_cache_key(page, size_threshold, normal_font_size)
+                page_keys.append(page_key)
+                sections = load_cache_entry(cache_dir, 'pages', page_key)
+
+            if sections is None:
+                try:
+                    sections = await extract_page_sections(page, size_threshold, normal_font_size)
+                finally:
+                    page.close()  # Drop the cached chars, words and layout objects for this page
+                if cache_dir is not None:
+                    save_cache_entry(cache_dir, 'pages', page_key, sections)
 
-            # Build hierarchy
             for section in sections:
-                hierarchy.append({
+                yield {
                     'text': section['header'],
                     'page_num': page_number + 1,
                     'section_text': section['section_text'],
-                })
+                }
 
+    if cache_dir is not None:
+        save_cache_entry(cache_dir, 'files', file_key, page_keys)
+
+async def process_pdf(pdf_path, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    hierarchy = [
+        section async for section in iter_pdf_sections(pdf_path, size_threshold, cache_dir, body_font_size)
+    ]
     return hierarchy
 
 def convert_headers_to_dict(pdf_id, hierarchy):
@@ -194,21 +394,228 @@ def save_dict_to_json(data, output_file="headers_dictionary.json"):
     with open(output_file, 'w') as f:
         json.dump(data, f, indent=4)
 
-async def process_pdfs(pdf_paths, size_threshold=1.2):
+def save_dict_to_notes(data, output_file="headers_dictionary.notes"):
+    """
+    Writes extraction results in the columnar .notes format that merge_logic.load_notes_from_files
+    memory-maps instead of parsing (see merging/note_format.py).
+    """
+    from merging.note_format import notes_from_json_data, write_note_table
+    write_note_table(output_file, notes_from_json_data(data, os.path.basename(output_file)))
+
+def extract_pdf(pdf_path, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    """
+    Synchronous entry point for a single PDF, used by the worker processes.
+    Runs process_pdf in its own event loop and wraps the result with convert_headers_to_dict.
+    """
+    pdf_id = os.path.basename(pdf_path)
+    hierarchy = asyncio.run(process_pdf(pdf_path, size_threshold, cache_dir, body_font_size))
+    return convert_headers_to_dict(pdf_id, hierarchy)
+
+async def extract_with_stats(pdf_path, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    """
+    Extracts one PDF like extract_pdf and measures it.
+
+    Returns:
+        result (dict): As returned by extract_pdf.
+        stats (dict): Wall and CPU seconds, sections, bullets and extraction cache hits and
+            misses of this PDF, measured in the process that extracted it.
+    """
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    hits, misses = cache_stats['hits'], cache_stats['misses']
+    hierarchy = await process_pdf(pdf_path, size_threshold, cache_dir, body_font_size)
+    stats = {
+        'wall_seconds': time.perf_counter() - wall_start,
+        'cpu_seconds': time.process_time() - cpu_start,
+        'sections': len(hierarchy),
+        'bullets': sum(len(section['section_text']) for section in hierarchy),
+        'cache_hits': cache_stats['hits'] - hits,
+        'cache_misses': cache_stats['misses'] - misses
+    }
+    return convert_headers_to_dict(os.path.basename(pdf_path), hierarchy), stats
+
+def extract_pdf_with_stats(pdf_path, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    """
+    Synchronous wrapper around extract_with_stats, used by the worker processes.
+    """
+    return asyncio.run(extract_with_stats(pdf_path, size_threshold, cache_dir, body_font_size))
+
+async def write_pdf_ndjson(pdf_path, output_file, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    """
+    Writes the sections of a PDF to output_file as NDJSON, one line per section,
+    while the PDF is being extracted. Returns the number of sections written.
+    """
+    pdf_id = os.path.basename(pdf_path)
+    count = 0
+    with open(output_file, 'w', encoding='utf-8') as f:
+        async for section in iter_pdf_sections(pdf_path, size_threshold, cache_dir, body_font_size):
+            f.write(json.dumps({'pdf_id': pdf_id, **section}) + '\n')
+            count += 1
+    return count
+
+def extract_pdf_to_ndjson(pdf_path, output_file, size_threshold=1.2, cache_dir=None, body_font_size='page'):
+    """
+    Synchronous wrapper around write_pdf_ndjson, used by the worker processes.
+    """
+    return asyncio.run(write_pdf_ndjson(pdf_path, output_file, size_threshold, cache_dir, body_font_size))
+
+async def map_pdfs(pdf_paths, max_workers, async_func, sync_func, args_for):
+    """
+    Runs one extraction job per PDF, either one at a time in this process (max_workers=1)
+    or in a process pool. Results are returned in input order; a failed job is returned
+    as its exception so the rest of the batch still runs.
+    """
+    if max_workers == 1:
+        results = []
+        for pdf_path in pdf_paths:
+            try:
+                results.append(await async_func(*args_for(pdf_path)))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        tasks = [
+            loop.run_in_executor(executor, sync_func, *args_for(pdf_path))
+            for pdf_path in pdf_paths
+        ]
+        # gather keeps the input order; exceptions are returned instead of cancelling the batch
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+async def stream_pdfs_to_ndjson(pdf_paths, output_file, size_threshold=1.2, max_workers=1, cache_dir=None,
+                                body_font_size='page'):
+    """
+    Extracts every PDF in pdf_paths straight to an NDJSON file without holding the
+    results in memory. Each PDF is written to its own part file and appended to
+    output_file in input order once it succeeds, so failed PDFs leave no partial output.
+
+    Returns:
+        section_counts (dict): Number of sections written, keyed by pdf_id.
+        failures (dict): Error messages keyed by pdf_id for PDFs that could not be processed.
+    """
+    part_files = {pdf_path: f"{output_file}.{i}.part" for i, pdf_path in enumerate(pdf_paths)}
+
+    results = await map_pdfs(
+        pdf_paths, max_workers, write_pdf_ndjson, extract_pdf_to_ndjson,
+        lambda pdf_path: (pdf_path, part_files[pdf_path], size_threshold, cache_dir, body_font_size)
+    )
+
+    section_counts = {}
+    failures = {}
+    with open(output_file, 'w', encoding='utf-8') as out:
+        for pdf_path, result in zip(pdf_paths, results):
+            pdf_id = os.path.basename(pdf_path)
+            part_file = part_files[pdf_path]
+            if isinstance(result, Exception):
+                logging.error(f"Failed to process {pdf_path}: {result}")
+                failures[pdf_id] = str(result)
+            else:
+                with open(part_file, 'r', encoding='utf-8') as part:
+                    shutil.copyfileobj(part, out)
+                section_counts[pdf_id] = result
+            if os.path.exists(part_file):
+                os.remove(part_file)
+    return section_counts, failures
+
+async def process_pdfs(pdf_paths, size_threshold=1.2, max_workers=1, ndjson_file=None, cache_dir=None,
+                       body_font_size='page', notes_file=None, metrics=None):
+    """
+    Extracts headers from every PDF in pdf_paths and saves them to headers_dictionary.json
+    (or to notes_file in the columnar .notes format).
+
+    Parameters:
+        pdf_paths (list): Paths of the PDFs to process.
+        size_threshold (float): Font size ratio above which a word is treated as a header.
+        max_workers (int): Number of worker processes. 1 processes the PDFs one at a time
+            in this process; None uses one worker per CPU core.
+        ndjson_file (str): If given, sections are streamed to this NDJSON file while they
+            are extracted instead of being collected into headers_dictionary.json.
+        cache_dir (str): If given, directory of the content-addressed extraction cache.
+        body_font_size (str): 'page' to estimate the body font size per page,
+            'document' to use one estimate for the whole PDF.
+        notes_file (str): If given, results are written to this .notes file instead of
+            headers_dictionary.json.
+        metrics (PipelineMetrics): If given, receives extract and save stage timings, PDF,
+            section and cache counts, and a record per PDF (see merging/pipeline_metrics.py).
+
+    Returns:
+        header_data (dict): Extraction results keyed by pdf_id, in input order
+            (section counts per pdf_id when streaming to ndjson_file).
+        failures (dict): Error messages keyed by pdf_id for PDFs that could not be processed.
+    """
+    if ndjson_file is not None:
+        with metrics_stage(metrics, 'extract'):
+            section_counts, failures = await stream_pdfs_to_ndjson(
+                pdf_paths, ndjson_file, size_threshold, max_workers, cache_dir, body_font_size
+            )
+        if metrics is not None:
+            metrics.count('pdfs', len(section_counts))
+            metrics.count('failures', len(failures))
+            metrics.count('sections', sum(section_counts.values()))
+        return section_counts, failures
+
+    async def extract(pdf_path, threshold, cache, body_size):
+        hierarchy = await process_pdf(pdf_path, threshold, cache, body_size)
+        return convert_headers_to_dict(os.path.basename(pdf_path), hierarchy)
+
+    with metrics_stage(metrics, 'extract'):
+        if metrics is None:
+            results = await map_pdfs(
+                pdf_paths, max_workers, extract, extract_pdf,
+                lambda pdf_path: (pdf_path, size_threshold, cache_dir, body_font_size)
+            )
+        else:
+            results = await map_pdfs(
+                pdf_paths, max_workers, extract_with_stats, extract_pdf_with_stats,
+                lambda pdf_path: (pdf_path, size_threshold, cache_dir, body_font_size)
+            )
+
     header_data = {}
-    for pdf_path in pdf_paths:
+    failures = {}
+    for pdf_path, result in zip(pdf_paths, results):
         pdf_id = os.path.basename(pdf_path)
-        hierarchy = await process_pdf(pdf_path, size_threshold)
-        header_dict = convert_headers_to_dict(pdf_id, hierarchy)
-        header_data[pdf_id] = header_dict
-    save_dict_to_json(header_data)
+        if isinstance(result, Exception):
+            logging.error(f"Failed to process {pdf_path}: {result}")
+            failures[pdf_id] = str(result)
+            continue
+        if metrics is not None:
+            result, stats = result
+            metrics.count('sections', stats['sections'])
+            metrics.count('bullets', stats['bullets'])
+            metrics.count('extraction_cache_hits', stats['cache_hits'])
+            metrics.count('extraction_cache_misses', stats['cache_misses'])
+            metrics.add_item('pdfs', {'pdf_id': pdf_id, **stats})
+        header_data[pdf_id] = result
+    if metrics is not None:
+        metrics.count('pdfs', len(header_data))
+        metrics.count('failures', len(failures))
+    with metrics_stage(metrics, 'save'):
+        if notes_file is not None:
+            save_dict_to_notes(header_data, notes_file)
+        else:
+            save_dict_to_json(header_data)
+    return header_data, failures
 
 # Testing
 async def main():
+    parser = argparse.ArgumentParser(description="Extract headers and sections from the test PDFs.")
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help="Profile extraction (cProfile, tracemalloc, peak RSS) in this process and save the results to DIR")
+    args = parser.parse_args()
+
     pdf_paths = [
         'data/data_ver1.pdf',
         'data/data_ver2.pdf'
     ]
-    await process_pdfs(pdf_paths, size_threshold=1.2)
-
-asyncio.run(main())
+    if args.profile is None:
+        await process_pdfs(pdf_paths, size_threshold=1.2, max_workers=None, cache_dir='.extraction_cache')
+        return
+
+    # Worker processes are not profiled, so the PDFs are extracted here one at a time
+    profiler = PipelineProfiler()
+    await process_pdfs(pdf_paths, size_threshold=1.2, max_workers=1, cache_dir='.extraction_cache', metrics=profiler)
+    print(format_profile_report(profiler.save(args.profile)))
+    print(f"Profile saved to {args.profile}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
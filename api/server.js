@@ -11,8 +11,11 @@ const PORT = 5001;
 app.use(cors());
 app.use(express.json());
 
+// Uploaded note files, which the merge worker merges as they arrive
+const uploadDir = path.join(__dirname, 'uploads');
+
 // Serve static files from the 'uploads' folder
-app.use('/uploads', express.static(path.join(__dirname, 'uploads')));
+app.use('/uploads', express.static(uploadDir));
 
 // Home Route
 app.get('/', (req, res) => {
@@ -50,7 +53,6 @@ app.get('/api/data', (req, res) => {
 // Set up multer for file uploads
 const storage = multer.diskStorage({
   destination: (req, file, cb) => {
-    const uploadDir = 'uploads/';
     if (!fs.existsSync(uploadDir)) {
       fs.mkdirSync(uploadDir); // Ensure 'uploads' directory exists
     }
@@ -79,7 +81,7 @@ const upload = multer({
 
 // POST route for file upload (only .json files)
 app.post('/upload', (req, res) => {
-  upload(req, res, function (err) {
+  upload(req, res, async function (err) {
     if (err instanceof multer.MulterError) {
       console.error('Multer error during upload:', err);
       return res.status(500).json({ error: 'Multer error occurred during file upload', details: err.message });
@@ -95,60 +97,159 @@ app.post('/upload', (req, res) => {
 
     console.log('File uploaded successfully:', req.file);
 
-    // Return success response after the file is uploaded
-    return res.status(200).json({
-      message: 'File uploaded successfully!',
-      fileName: req.file.originalname,
-    });
+    // Merge only the new note into the uploads' merge state, rather than re-merging every upload
+    try {
+      const result = await callMergeWorker('add_note', { directory: uploadDir, file: req.file.originalname });
+      return res.status(200).json({
+        message: 'File uploaded successfully!',
+        fileName: req.file.originalname,
+        changedHeaders: result.changed_headers,
+        headers: result.headers,
+      });
+    } catch (mergeErr) {
+      console.error('Error merging uploaded file:', mergeErr);
+      return res.status(500).json({ error: `File uploaded but merging it failed: ${mergeErr.message}` });
+    }
   });
 });
 
-// POST route for running the Python script separately
-app.post('/run-test-client', (req, res) => {
-  const pythonScriptPath = path.join(__dirname, 'merging', 'test_client.py');
-  console.log(`Running Python script: ${pythonScriptPath}`);
+// Persistent Python merge worker. It is started once and kept running so NLTK, FAISS and the
+// caches stay loaded; requests and responses are JSON lines matched by id.
+const readline = require('readline');
+const mergeWorkerPath = path.join(__dirname, 'merging', 'merge_worker.py');
+// A request that takes longer than this is failed and the worker restarted, since the worker
+// handles one request at a time and every later request would wait behind it
+const mergeWorkerTimeoutMs = Number(process.env.MERGE_WORKER_TIMEOUT_MS) || 10 * 60 * 1000;
+let mergeWorker = null;
+let nextRequestId = 1;
+const pendingRequests = new Map();
+
+// Fails every request waiting on a worker and stops it; the next call starts a new one
+function failMergeWorker(worker, message) {
+  if (mergeWorker === worker) {
+    mergeWorker = null;
+  }
+  for (const [id, pending] of pendingRequests) {
+    if (pending.worker === worker) {
+      pendingRequests.delete(id);
+      clearTimeout(pending.timer);
+      pending.reject(new Error(message));
+    }
+  }
+  if (worker.exitCode === null && worker.signalCode === null) {
+    worker.kill();
+  }
+}
 
-  const pythonProcess = spawn('python3', [pythonScriptPath]);
+function startMergeWorker() {
+  console.log(`Starting merge worker: ${mergeWorkerPath}`);
+  const worker = spawn('python3', [mergeWorkerPath], { cwd: path.join(__dirname, 'merging') });
 
-  // Capture Python script stdout
-  let pythonOutput = '';
-  pythonProcess.stdout.on('data', (data) => {
-    pythonOutput += data.toString();
+  // e.g. python3 is missing, or the worker cannot be killed
+  worker.on('error', (err) => {
+    console.error('Merge worker error:', err);
+    failMergeWorker(worker, `Merge worker failed: ${err.message}`);
   });
-
-  // Capture Python script stderr (for errors)
-  pythonProcess.stderr.on('data', (data) => {
-    console.error(`Python error: ${data.toString()}`);
-    return res.status(500).json({ error: `Error executing Python script: ${data.toString()}` });
+  // e.g. EPIPE when the worker exits while a request is being written
+  worker.stdin.on('error', (err) => {
+    console.error('Error writing to merge worker:', err);
+    failMergeWorker(worker, `Could not send the request to the merge worker: ${err.message}`);
   });
 
-  // Handle script completion
-  pythonProcess.on('close', (code) => {
-    if (code === 0) {
-      console.log('Python script executed successfully.');
-
-      // Read the merged results from 'merged_results.json'
-      const resultsFile = path.join(__dirname, 'merged_results.json');
-      fs.readFile(resultsFile, 'utf8', (err, data) => {
-        if (err) {
-          console.error('Error reading merged results:', err);
-          return res.status(500).json({ error: 'Error reading merged results.' });
-        }
-
-        console.log('Merged results:', data);
-        return res.status(200).json({
-          message: 'Python script executed and processed successfully!',
-          output: data,
-        });
-      });
+  readline.createInterface({ input: worker.stdout }).on('line', (line) => {
+    let response;
+    try {
+      response = JSON.parse(line);
+    } catch (err) {
+      console.error('Invalid response from merge worker:', line);
+      return;
+    }
+    const pending = pendingRequests.get(response.id);
+    if (!pending) {
+      console.error('Merge worker response without a pending request:', line);
+      return;
+    }
+    // stream_merge sends each header group before its final response
+    if (response.header !== undefined) {
+      if (pending.onHeader) {
+        pending.onHeader(response.header);
+      }
+      return;
+    }
+    pendingRequests.delete(response.id);
+    clearTimeout(pending.timer);
+    if (response.error) {
+      pending.reject(new Error(`${response.error.type}: ${response.error.message}`));
     } else {
-      console.error(`Python script exited with code: ${code}`);
-      return res.status(500).json({ error: 'Error executing Python script.' });
+      pending.resolve(response.result);
     }
   });
+
+  // The worker logs to stderr; only the protocol is written to stdout
+  worker.stderr.on('data', (data) => {
+    console.error(`Merge worker: ${data.toString().trimEnd()}`);
+  });
+
+  worker.on('close', (code) => {
+    console.error(`Merge worker exited with code: ${code}`);
+    failMergeWorker(worker, 'Merge worker exited before responding.');
+  });
+
+  return worker;
+}
+
+// Sends one request to the merge worker and resolves with its result. onHeader, if given,
+// receives each header group of a stream_merge request as soon as it is ready.
+function callMergeWorker(method, params = {}, onHeader = null) {
+  if (!mergeWorker) {
+    mergeWorker = startMergeWorker();
+  }
+  const worker = mergeWorker;
+  const id = nextRequestId++;
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(() => {
+      console.error(`Merge worker request ${id} (${method}) timed out after ${mergeWorkerTimeoutMs} ms`);
+      failMergeWorker(worker, `Merge worker did not respond within ${mergeWorkerTimeoutMs} ms.`);
+    }, mergeWorkerTimeoutMs);
+    pendingRequests.set(id, { resolve, reject, worker, onHeader, timer });
+    worker.stdin.write(JSON.stringify({ id, method, params }) + '\n');
+  });
+}
+
+// POST route for running the merge on the uploaded test files
+app.post('/run-test-client', async (req, res) => {
+  try {
+    const result = await callMergeWorker('merge_multiple_notes', { directory: 'test_files', metrics: true });
+    // Stage timings and counters are returned next to the output rather than inside it
+    const { metrics, ...mergedResults } = result.merged_results;
+    const data = JSON.stringify(mergedResults, null, 4);
+    console.log('Merged results:', data);
+    return res.status(200).json({
+      message: 'Python script executed and processed successfully!',
+      output: data,
+      metrics,
+    });
+  } catch (err) {
+    console.error('Error running merge:', err);
+    return res.status(500).json({ error: `Error executing Python script: ${err.message}` });
+  }
+});
+
+// GET route for the merge of every uploaded note, kept up to date as files are uploaded
+app.get('/merged-uploads', async (req, res) => {
+  try {
+    fs.mkdirSync(uploadDir, { recursive: true }); // Nothing uploaded yet merges to nothing
+    const result = await callMergeWorker('merge_state_result', { directory: uploadDir });
+    return res.status(200).json({ output: result.merged_text, mergedResults: result.merged_results });
+  } catch (err) {
+    console.error('Error reading merged uploads:', err);
+    return res.status(500).json({ error: `Error reading merged uploads: ${err.message}` });
+  }
 });
 
 // Start the server
 app.listen(PORT, () => {
   console.log(`Server is running on http://localhost:${PORT}`);
+  // Start the worker now so the first merge does not pay for Python startup
+  mergeWorker = startMergeWorker();
 });